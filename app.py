@@ -1,16 +1,13 @@
 """
-Streamlit dashboard for STDF DB: lot-to-lot, wafer-to-wafer, die-to-die analysis,
+Streamlit dashboard for STDF DB: lot-to-lot, wafer-to-wafer, die-to-die analysis, composite wafer map,
 fail pareto, TestSuite→TestItem mapping, wafer diff comparison, bin summary, equipment, LLM assistant.
 """
 import io
-import os
 import json
-import re
-import tempfile
 from pathlib import Path
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, date, timedelta
-from typing import List, Dict, Any
+from typing import List, Dict
 
 import pandas as pd
 import numpy as np
@@ -21,11 +18,21 @@ from plotly.subplots import make_subplots
 from sqlalchemy import text, func
 from sqlalchemy.orm import Session
 
-from config import DATABASE_URL
+from entity_index import entity_index
+from intent_parser import fast_path
+from llm_gateway import get_llm_gateway, tool_calls
+from pareto import test_pareto, bin_pareto
+from query_cache import cache_stats, cached_builder
+from wafer_composite import CompositeMap
+from wafer_diff import WaferDiff
+from stream_stats import StreamStats, group_stats, merged
+from wafer_matrix import iter_lot_test_values, wafer_matrix
+from wafer_map import bin_map_figure, rasterize, value_map_figure, wafer_bin_grid
+from config import DATABASE_URL, LLM_TOOL_WORKERS, SQL_PROFILE, WAFER_DIFF_TOLERANCE
 from db_models import (
-    get_engine, init_db,
-    Lot, Wafer, Die, Bin, TestItem, TestProgram, TestSuite, TestDefinition, SiteEquipment,
-    Company, Product, Stage,
+    get_shared_engine, ensure_db, get_data_version,
+    Lot, Wafer, Die, Bin, TestItem, TestKey, TestProgram, TestSuite, TestDefinition, SiteEquipment,
+    Company, Product, Stage, LotSummary, WaferSummary, BinCount,
 )
 
 
@@ -93,6 +100,34 @@ def _p_chart(subgroup_labels, defect_counts, total_counts, title="p-Chart (Propo
     return fig
 
 
+def _stats_box_figure(stats_by_label: Dict[str, StreamStats], title: str):
+    """Box plot drawn from StreamStats (precomputed quartiles / fences) instead of raw values."""
+    labels = list(stats_by_label)
+    boxes = [s.box() for s in stats_by_label.values()]
+    fig = go.Figure(go.Box(
+        x=labels, name="Result", boxmean=True,
+        **{k: [b[k] for b in boxes] for k in ("q1", "median", "q3", "lowerfence", "upperfence", "mean", "sd")},
+    ))
+    outliers = [(label, v) for label, b in zip(labels, boxes) for v in b["outliers"]]
+    if outliers:
+        fig.add_trace(go.Scatter(
+            x=[o[0] for o in outliers], y=[o[1] for o in outliers], mode="markers", name="min / max",
+            marker=dict(symbol="circle-open", color="#636efa"),
+        ))
+    fig.update_layout(title=title, xaxis_title="Lot", yaxis_title="Result", showlegend=False)
+    return fig
+
+
+@cached_builder
+def build_lot_test_stats(session: Session, lot_pks: List[int], test_num):
+    """
+    {lot pk: StreamStats} of one PTR test (lots with values only), streamed in STDF_STATS_CHUNK_ROWS chunks
+    so memory stays bounded per lot whatever the die count. Used by the Lot-to-Lot page.
+    """
+    return group_stats(iter_lot_test_values(session, lot_pks, test_num))
+
+
+@cached_builder
 def build_lot_pchart_figure(session: Session, lot_ids: List[str]):
     """
     Build p-chart figure for given lot_ids (proportion defective per lot).
@@ -100,27 +135,18 @@ def build_lot_pchart_figure(session: Session, lot_ids: List[str]):
     """
     if not lot_ids:
         return None
-    lots = session.query(Lot).filter(Lot.lot_id.in_(lot_ids)).all()
-    if not lots:
-        return None
-    labels: List[str] = []
-    total_counts: List[int] = []
-    fail_counts: List[int] = []
-    for lot in lots:
-        total = session.query(Die).filter_by(lot_id=lot.id).count()
-        if total == 0:
-            continue
-        fails = session.query(Die.id).join(TestItem, TestItem.die_id == Die.id).filter(
-            Die.lot_id == lot.id, TestItem.pass_fail == 1
-        ).distinct().count()
-        labels.append(lot.lot_id)
-        total_counts.append(total)
-        fail_counts.append(fails)
+    rows = session.query(Lot.lot_id, LotSummary.die_count, LotSummary.fail_die_count).join(
+        LotSummary, LotSummary.lot_id == Lot.id
+    ).filter(Lot.lot_id.in_(lot_ids), LotSummary.die_count > 0).order_by(Lot.id).all()
+    labels: List[str] = [r[0] for r in rows]
+    total_counts: List[int] = [r[1] for r in rows]
+    fail_counts: List[int] = [r[2] for r in rows]
     if not labels:
         return None
     return _p_chart(labels, fail_counts, total_counts, title="p-Chart: Proportion defective per Lot")
 
 
+@cached_builder
 def build_wafer_map_figure(session: Session, lot_id: str, wafer_id: str):
     """
     Build wafer map (by hard_bin) for given lot_id and wafer_id.
@@ -128,135 +154,62 @@ def build_wafer_map_figure(session: Session, lot_id: str, wafer_id: str):
     """
     if not lot_id or not wafer_id:
         return None
-    lot = session.query(Lot).filter_by(lot_id=lot_id).first()
+    lot = entity_index(session).lot(lot_id)
     if not lot:
         return None
-    w = session.query(Wafer).filter_by(lot_id=lot.id, wafer_id=wafer_id).first()
+    w = _resolve_wafer(session, lot, wafer_id)
     if not w:
-        # 嘗試寬鬆比對（去空白）
-        wafer_id_stripped = wafer_id.strip()
-        w = session.query(Wafer).filter(Wafer.lot_id == lot.id, Wafer.wafer_id.like(f"%{wafer_id_stripped}%")).first()
-        if not w:
-            return None
-    dies = session.query(Die).filter_by(wafer_id=w.id).all()
-    if not dies:
         return None
-    df = pd.DataFrame(
-        [{"x": d.x_coord, "y": d.y_coord, "hard_bin": d.hard_bin} for d in dies if d.x_coord is not None]
-    )
-    if df.empty:
+    grid = wafer_bin_grid(session, w[0])
+    if grid is None:
         return None
-    return _wafer_map_bin_fig(df, f"Wafer map (bin): Lot {lot.lot_id}, Wafer {w.wafer_id}", show_bin_label=(len(df) <= 150))
+    return bin_map_figure(grid, f"Wafer map (bin): Lot {lot[1]}, Wafer {w[1]}", show_bin_label=grid.n_dies <= 150)
 
 
+@cached_builder
 def build_top_fail_pareto_figure(session: Session, level: str, k: int, lot_id: str):
     """
     Build top-k fail Pareto figure for a given lot and level ('Die' or 'Wafer').
     Returns (figure, dataframe) so caller can顯示表格與圖。
     """
-    lot = session.query(Lot).filter_by(lot_id=lot_id).first()
+    lot = entity_index(session).lot(lot_id)
     if not lot:
         return None, None
     k = max(1, int(k or 5))
-    if level.lower() == "die":
-        fails = session.query(TestItem.test_num, TestItem.test_txt, TestItem.test_type).filter(
-            TestItem.pass_fail == 1
-        ).join(Die).filter(Die.lot_id == lot.id).all()
-        if not fails:
-            return None, None
-        cnt = defaultdict(int)
-        for tn, tt, typ in fails:
-            key = tt or f"Test#{tn}"
-            cnt[key] += 1
-        df = pd.DataFrame(
-            [{"Test": k_, "Fail count": v} for k_, v in sorted(cnt.items(), key=lambda x: -x[1])]
-        ).head(k)
-        if df.empty:
-            return None, None
-        fig = px.bar(df, x="Test", y="Fail count", title=f"Die-level Fail Pareto (top {k})")
-        fig.update_xaxes(tickangle=-45)
-        return fig, df
-    else:
-        wafers = session.query(Wafer).filter_by(lot_id=lot.id).all()
-        if not wafers:
-            return None, None
-        wafer_ids = [w.id for w in wafers]
-        fail_by_test = defaultdict(int)
-        for wid in wafer_ids:
-            dies = session.query(Die.id).filter_by(wafer_id=wid).all()
-            die_ids = [d.id for d in dies]
-            if not die_ids:
-                continue
-            for ti in session.query(TestItem).filter(
-                TestItem.die_id.in_(die_ids), TestItem.pass_fail == 1
-            ).all():
-                key = ti.test_txt or f"Test#{ti.test_num}"
-                fail_by_test[key] += 1
-        df = pd.DataFrame(
-            [{"Test": k_, "Fail count": v} for k_, v in sorted(fail_by_test.items(), key=lambda x: -x[1])]
-        ).head(k)
-        if df.empty:
-            return None, None
-        fig = px.bar(df, x="Test", y="Fail count", title=f"Wafer-level Fail Pareto (top {k})")
-        fig.update_xaxes(tickangle=-45)
-        return fig, df
+    level_name = "Die" if level.lower() == "die" else "Wafer"
+    df = test_pareto(session, [lot[0]], level=level_name, k=k)
+    if df.empty:
+        return None, None
+    df = df[["Test", "Fail count"]]
+    fig = px.bar(df, x="Test", y="Fail count", title=f"{level_name}-level Fail Pareto (top {k})")
+    fig.update_xaxes(tickangle=-45)
+    return fig, df
 
 
-def _resolve_wafer(session: Session, lot: Lot, wafer_id: str):
-    """Resolve wafer_id string to Wafer record (exact or like match)."""
-    w = session.query(Wafer).filter_by(lot_id=lot.id, wafer_id=wafer_id.strip()).first()
-    if w:
-        return w
-    w = session.query(Wafer).filter(
-        Wafer.lot_id == lot.id,
-        Wafer.wafer_id.like(f"%{wafer_id.strip()}%"),
-    ).first()
-    return w
+def _resolve_wafer(session: Session, lot, wafer_id: str):
+    """(wafer pk, WAFER_ID) of a lot (entity_index entry) by WAFER_ID: exact, same number or contained."""
+    return entity_index(session).wafer(lot[0], wafer_id)
 
 
+@cached_builder
 def build_wafer_to_wafer_diff(session: Session, lot_id: str, wafer_id_left: str, wafer_id_right: str):
     """
     Build multi-wafer diff: left wafer map, right wafer map, diff-only map (bin differs).
     Returns dict: left_fig, right_fig, diff_fig, diff_count (or None entries on error).
     """
-    lot = session.query(Lot).filter_by(lot_id=lot_id).first()
+    lot = entity_index(session).lot(lot_id)
     if not lot:
         return {"left_fig": None, "right_fig": None, "diff_fig": None, "diff_count": 0}
     w_left = _resolve_wafer(session, lot, wafer_id_left)
     w_right = _resolve_wafer(session, lot, wafer_id_right)
     if not w_left or not w_right:
         return {"left_fig": None, "right_fig": None, "diff_fig": None, "diff_count": 0}
-    left_id, right_id = w_left.id, w_right.id
-    wafer_ids = [left_id, right_id]
-    data_by_wafer = {}
-    for wid in wafer_ids:
-        dies = session.query(Die).filter_by(wafer_id=wid).all()
-        dmap = {}
-        for d in dies:
-            if d.x_coord is not None and d.y_coord is not None:
-                dmap[(d.x_coord, d.y_coord)] = d.hard_bin
-        data_by_wafer[wid] = dmap
-    all_xy = set()
-    for dmap in data_by_wafer.values():
-        all_xy.update(dmap.keys())
-    diff_xy = []
-    for xy in all_xy:
-        b1 = data_by_wafer[left_id].get(xy)
-        b2 = data_by_wafer[right_id].get(xy)
-        if str(b1) != str(b2):
-            diff_xy.append(xy)
-    dies_left = session.query(Die).filter_by(wafer_id=left_id).all()
-    df_left = pd.DataFrame([
-        {"x": d.x_coord, "y": d.y_coord, "hard_bin": d.hard_bin}
-        for d in dies_left if d.x_coord is not None
-    ])
-    dies_right = session.query(Die).filter_by(wafer_id=right_id).all()
-    df_right = pd.DataFrame([
-        {"x": d.x_coord, "y": d.y_coord, "hard_bin": d.hard_bin}
-        for d in dies_right if d.x_coord is not None
-    ])
-    left_fig = _wafer_map_bin_fig(df_left, f"Left: {w_left.wafer_id}", show_bin_label=False, highlight_xy=diff_xy)
-    right_fig = _wafer_map_bin_fig(df_right, f"Right: {w_right.wafer_id}", show_bin_label=False, highlight_xy=diff_xy)
+    diff = WaferDiff(session, [w_left[0], w_right[0]], include_tests=False)
+    diff_xy = diff.bin_diff_positions()
+    df_left = diff.wafer_map_frame(w_left[0])
+    df_right = diff.wafer_map_frame(w_right[0])
+    left_fig = _wafer_map_bin_fig(df_left, f"Left: {w_left[1]}", show_bin_label=False, highlight_xy=diff_xy)
+    right_fig = _wafer_map_bin_fig(df_right, f"Right: {w_right[1]}", show_bin_label=False, highlight_xy=diff_xy)
     diff_fig = None
     if diff_xy:
         df_diff = pd.DataFrame([{"x": x, "y": y} for x, y in diff_xy])
@@ -270,67 +223,74 @@ def build_wafer_to_wafer_diff(session: Session, lot_id: str, wafer_id_left: str,
     return {"left_fig": left_fig, "right_fig": right_fig, "diff_fig": diff_fig, "diff_count": len(diff_xy)}
 
 
+@cached_builder
 def build_test_value_heatmap_figure(session: Session, lot_id: str, wafer_id: str, test_identifier):
     """
     Build wafer map colored by a PTR test value (heatmap style).
     test_identifier: test number (int) or test name (str). Used by LLM assistant.
     """
-    lot = session.query(Lot).filter_by(lot_id=lot_id).first()
+    lot = entity_index(session).lot(lot_id)
     if not lot:
         return None
     w = _resolve_wafer(session, lot, wafer_id)
     if not w:
         return None
-    # Resolve test: by number or by name
-    try:
-        test_num = int(test_identifier)
-    except (TypeError, ValueError):
-        test_num = None
-    if test_num is not None:
-        rows = session.query(Die.x_coord, Die.y_coord, TestItem.result).join(
-            TestItem, TestItem.die_id == Die.id
-        ).filter(
-            Die.wafer_id == w.id,
-            TestItem.test_num == test_num,
-            TestItem.test_type == "PTR",
-            TestItem.result != None,
-        ).all()
-        test_name = f"Test#{test_num}"
-    else:
-        # Match by test_txt (contains or equals)
-        t = session.query(TestItem.test_num, TestItem.test_txt).join(Die).filter(
-            Die.wafer_id == w.id,
-            TestItem.test_type == "PTR",
-            TestItem.result != None,
-        ).all()
-        needle = str(test_identifier).strip()
-        match = next((x for x in t if (x[1] or "").strip() == needle or (needle in (x[1] or ""))), None)
-        if not match:
-            return None
-        test_num, test_name = match[0], (match[1] or f"Test#{match[0]}").strip()
-        rows = session.query(Die.x_coord, Die.y_coord, TestItem.result).join(
-            TestItem, TestItem.die_id == Die.id
-        ).filter(
-            Die.wafer_id == w.id,
-            TestItem.test_num == test_num,
-            TestItem.test_type == "PTR",
-            TestItem.result != None,
-        ).all()
-    if not rows:
+    resolved = _resolve_ptr_test(session, [lot[2]], test_identifier)
+    if resolved is None:
+        return None
+    test_num, test_name = resolved
+    df = _test_xy_frame(wafer_matrix(session, w[0], [test_num]), test_num)
+    if df.empty:
         return None
-    df = pd.DataFrame(rows, columns=["x", "y", "result"])
-    fig = px.scatter(
-        df, x="x", y="y", color="result",
-        title=f"Test value heatmap: {test_name} (Lot {lot_id}, Wafer {w.wafer_id})",
-        color_continuous_scale="Viridis",
+    return value_map_figure(
+        rasterize(df["x"], df["y"], df["result"]), f"Test value heatmap: {test_name} (Lot {lot[1]}, Wafer {w[1]})",
     )
-    fig.update_layout(yaxis=dict(scaleanchor="x", scaleratio=1), height=450)
-    return fig
 
 
-def _lots_query(session: Session, company_id=None, product_id=None, stage_id=None, test_program_id=None, time_start=None, time_end=None):
-    """Build Lot query filtered by Company/Product/Stage/TestProgram and optional lot start_t time range."""
-    q = session.query(Lot)
+def _resolve_ptr_test(session: Session, program_pks, test_identifier):
+    """(test_num, name) of a PTR test given by number or by name (equal, contained, close spelling) in the given programs."""
+    return entity_index(session).test(program_pks, test_identifier)
+
+
+@cached_builder
+def build_composite_map(session: Session, wafer_pks: List[int], test_num=None, test_name=None):
+    """
+    Composite wafer map over wafers: fail-rate, bin-mode and (with test_num) mean-value figures plus the
+    per-position frame. Used by the Composite Map page and the LLM assistant.
+    """
+    if not wafer_pks:
+        return None
+    comp = CompositeMap(session, wafer_pks, test_num)
+    if not len(comp):
+        return None
+    label = f"{comp.n_wafers} wafers"
+    return {
+        "fail_fig": value_map_figure(
+            comp.fail_rate_grid(), f"Fail rate per position ({label})", colorscale="Reds", value_label="fail rate",
+        ),
+        "bin_fig": bin_map_figure(comp.bin_mode_grid(), f"Most frequent hard bin ({label})"),
+        "value_fig": value_map_figure(
+            comp.value_grid(), f"Mean {test_name or f'Test#{test_num}'} ({label})", value_label="mean",
+        ) if test_num is not None else None,
+        "frame": comp.frame(),
+        "n_wafers": comp.n_wafers,
+        "n_dies": comp.n_dies,
+    }
+
+
+def _test_xy_frame(matrix, test_num):
+    """x, y, result of one test from a WaferMatrix (measured dies with coordinates only)."""
+    values = matrix.column(test_num)
+    if values is None:
+        return pd.DataFrame(columns=["x", "y", "result"])
+    keep = matrix.xy_valid() & ~np.isnan(values)
+    return pd.DataFrame({"x": matrix.x[keep], "y": matrix.y[keep], "result": values[keep].astype(np.float64)})
+
+
+@cached_builder
+def _filtered_lot_ids(session: Session, company_id=None, product_id=None, stage_id=None, test_program_id=None, time_start=None, time_end=None):
+    """Lot primary keys matching Company/Product/Stage/TestProgram and optional lot start_t time range."""
+    q = session.query(Lot.id)
     if test_program_id is not None:
         q = q.filter(Lot.test_program_id == test_program_id)
     elif stage_id is not None:
@@ -347,7 +307,79 @@ def _lots_query(session: Session, company_id=None, product_id=None, stage_id=Non
         if isinstance(time_end, date) and not isinstance(time_end, datetime):
             time_end = datetime.combine(time_end, datetime.max.time())
         q = q.filter(Lot.start_t <= time_end)
-    return q
+    return [r[0] for r in q.order_by(Lot.id)]
+
+
+def _lots_query(session: Session, **filters):
+    """Lot query filtered by Company/Product/Stage/TestProgram and time range (lot ids cached per data version)."""
+    if not any(v is not None for v in filters.values()):
+        return session.query(Lot)
+    return session.query(Lot).filter(Lot.id.in_(_filtered_lot_ids(session, **filters)))
+
+
+def _wafer_counts(session: Session):
+    return session.query(Wafer.lot_id.label("lot_id"), func.count(Wafer.id).label("n_wafer")).group_by(Wafer.lot_id).subquery()
+
+
+@cached_builder
+def build_hierarchy_overview(session: Session):
+    """Company → Product → Stage → TestProgram rows with lot / wafer / die counts per program (one grouped query)."""
+    wc = _wafer_counts(session)
+    q = (
+        session.query(
+            Company.id, Company.name, Product.name, Stage.name, TestProgram.name, TestProgram.revision,
+            func.count(Lot.id), func.coalesce(func.sum(wc.c.n_wafer), 0), func.coalesce(func.sum(LotSummary.die_count), 0),
+        )
+        .select_from(Company)
+        .outerjoin(Product, Product.company_id == Company.id)
+        .outerjoin(Stage, Stage.product_id == Product.id)
+        .outerjoin(TestProgram, TestProgram.stage_id == Stage.id)
+        .outerjoin(Lot, Lot.test_program_id == TestProgram.id)
+        .outerjoin(wc, wc.c.lot_id == Lot.id)
+        .outerjoin(LotSummary, LotSummary.lot_id == Lot.id)
+        .group_by(Company.id, Product.id, Stage.id, TestProgram.id)
+        .order_by(Company.name, Product.name, Stage.name, TestProgram.name)
+    )
+    return pd.DataFrame(
+        q.all(), columns=["company_id", "Company", "Product", "Stage", "Test program", "Revision", "Lots", "Wafers", "Dies"]
+    )
+
+
+@cached_builder
+def build_lot_overview(session: Session, limit: int = 50, **filters):
+    """Totals (lots, wafers, dies) of the filtered lots and the first `limit` lots with counts and test time from lot_summary."""
+    wc = _wafer_counts(session)
+    n_wafer = func.coalesce(wc.c.n_wafer, 0)
+    n_die = func.coalesce(LotSummary.die_count, 0)
+    q = (
+        session.query(Lot.lot_id, Lot.part_typ, n_wafer, n_die, func.coalesce(LotSummary.test_time_sum, 0), Lot.start_t)
+        .outerjoin(wc, wc.c.lot_id == Lot.id)
+        .outerjoin(LotSummary, LotSummary.lot_id == Lot.id)
+    )
+    if any(v is not None for v in filters.values()):
+        q = q.filter(Lot.id.in_(_filtered_lot_ids(session, **filters)))
+    n_lot, wafers, dies = q.with_entities(func.count(Lot.id), func.sum(n_wafer), func.sum(n_die)).one()
+    rows = [
+        {
+            "Lot": lot_id,
+            "Part type": part_typ or "-",
+            "Wafers": w,
+            "Dies": d,
+            "Total test time (ms)": t,
+            "Lot start": start_t.strftime("%Y-%m-%d %H:%M") if start_t else "-",
+        }
+        for lot_id, part_typ, w, d, t, start_t in q.order_by(Lot.id).limit(limit)
+    ]
+    return {"lots": n_lot, "wafers": wafers or 0, "dies": dies or 0}, pd.DataFrame(rows)
+
+
+def _lazy_expander(label: str, key: str):
+    """(expander, is_open): with Streamlit's on_change="rerun" the body only needs to run while open; older versions always run it."""
+    try:
+        exp = st.expander(label, key=key, on_change="rerun")
+    except TypeError:
+        return st.expander(label), True
+    return exp, bool(exp.open)
 
 
 def _sidebar_filters(session: Session):
@@ -357,8 +389,8 @@ def _sidebar_filters(session: Session):
     for key in ["filter_company_id", "filter_product_id", "filter_stage_id", "filter_test_program_id", "filter_time_start", "filter_time_end"]:
         if key not in st.session_state:
             st.session_state[key] = None
-    companies = session.query(Company).order_by(Company.name).all()
-    company_options = [(None, "— All —")] + [(c.id, c.name) for c in companies]
+    index = entity_index(session)   # hierarchy lists held in memory until the data version changes
+    company_options = [(None, "— All —")] + list(index.companies)
     sel_company = st.sidebar.selectbox(
         "Company",
         range(len(company_options)),
@@ -368,20 +400,20 @@ def _sidebar_filters(session: Session):
     company_id = company_options[sel_company][0] if company_options else None
     st.session_state["filter_company_id"] = company_id
 
-    products = session.query(Product).filter(Product.company_id == company_id).order_by(Product.name).all() if company_id else session.query(Product).order_by(Product.name).all()
-    product_options = [(None, "— All —")] + [(p.id, p.name) for p in products]
+    products = [p for p in index.products if not company_id or p[2] == company_id]
+    product_options = [(None, "— All —")] + [(p[0], p[1]) for p in products]
     sel_product = st.sidebar.selectbox("Product", range(len(product_options)), format_func=lambda i: product_options[i][1], key="sb_product")
     product_id = product_options[sel_product][0] if product_options else None
     st.session_state["filter_product_id"] = product_id
 
-    stages = session.query(Stage).filter(Stage.product_id == product_id).order_by(Stage.name).all() if product_id else session.query(Stage).order_by(Stage.name).all()
-    stage_options = [(None, "— All —")] + [(s.id, s.name) for s in stages]
+    stages = [s for s in index.stages if not product_id or s[2] == product_id]
+    stage_options = [(None, "— All —")] + [(s[0], s[1]) for s in stages]
     sel_stage = st.sidebar.selectbox("Stage", range(len(stage_options)), format_func=lambda i: stage_options[i][1], key="sb_stage")
     stage_id = stage_options[sel_stage][0] if stage_options else None
     st.session_state["filter_stage_id"] = stage_id
 
-    progs = session.query(TestProgram).filter(TestProgram.stage_id == stage_id).order_by(TestProgram.name).all() if stage_id else session.query(TestProgram).order_by(TestProgram.name).all()
-    prog_options = [(None, "— All —")] + [(p.id, f"{p.name} ({p.revision or '-'})") for p in progs]
+    progs = [p for p in index.programs if not stage_id or p[3] == stage_id]
+    prog_options = [(None, "— All —")] + [(p[0], f"{p[1]} ({p[2] or '-'})") for p in progs]
     sel_prog = st.sidebar.selectbox("Test Program", range(len(prog_options)), format_func=lambda i: prog_options[i][1], key="sb_prog")
     test_program_id = prog_options[sel_prog][0] if prog_options else None
     st.session_state["filter_test_program_id"] = test_program_id
@@ -419,169 +451,65 @@ def _get_filters():
     }
 
 
-def call_llm_online(messages: List[Dict[str, Any]]) -> Dict[str, Any]:
-    """
-    Online LLM call (OpenAI).
-    Expect LLM to return pure JSON like:
-      {"tool": "lot_pchart", "params": {"lots": ["LOT1","LOT2"]}}
-    """
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        raise RuntimeError("OPENAI_API_KEY is not set in environment.")
-    try:
-        from openai import OpenAI  # type: ignore
-    except ImportError as exc:
-        raise RuntimeError("openai package not installed. Run: pip install openai") from exc
-    client = OpenAI(api_key=api_key)
-    model = os.getenv("OPENAI_MODEL", "gpt-4.1-mini")
-    resp = client.chat.completions.create(
-        model=model,
-        messages=messages,
-        temperature=0,
-    )
-    content = resp.choices[0].message.content or ""
-    try:
-        data = json.loads(content)
-    except json.JSONDecodeError as exc:
-        raise RuntimeError(f"LLM 回傳非 JSON 格式：{content}") from exc
-    if not isinstance(data, dict):
-        raise RuntimeError(f"LLM 回傳格式錯誤：{data}")
-    return data
+def _llm_backend(label: str) -> str:
+    """Gateway backend name of a Backend radio label."""
+    if label.startswith("Online"):
+        return "online"
+    return "ollama" if "Ollama" in label else "offline"
 
 
-def call_llm_offline(messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+def ask_llm(session: Session, backend_label: str, question: str):
     """
-    Offline LLM placeholder.
-    - 若環境變數 OFFLINE_LLM_URL 設定為本地 HTTP 伺服器，則以 JSON 格式呼叫該端點。
-      預期回傳內容為 JSON: {"tool": "...", "params": {...}}。
-    - 若未設定，則用簡單規則從問題文字中抓取類似 LOT 名稱，直接回傳 lot_pchart 指令。
-    之後可在此函式內接 HuggingFace / Ollama / vLLM 並支援 fine-tune 後的模型。
+    (tool call, source) for a question: the rule-based intent parser when it is confident ("rules"),
+    else the LLM gateway ("cache" for a cached answer, "llm" for a model call).
     """
-    offline_url = os.getenv("OFFLINE_LLM_URL")
-    if offline_url:
-        try:
-            import requests  # type: ignore
-        except ImportError as exc:
-            raise RuntimeError("requests package not installed. Run: pip install requests") from exc
-        # 將 messages 壓成簡單 prompt 給本地服務
-        prompt_parts = []
-        for m in messages:
-            role = m.get("role")
-            content = m.get("content", "")
-            prompt_parts.append(f"[{role}]\n{content}")
-        prompt = "\n\n".join(prompt_parts)
-        r = requests.post(offline_url, json={"prompt": prompt}, timeout=60)
-        r.raise_for_status()
-        data = r.json()
-        # 若本地模型已直接回傳 JSON，則使用；否則嘗試從 data["output"] 中解析
-        if isinstance(data, dict) and "tool" in data:
-            return data
-        if isinstance(data, dict) and "output" in data:
-            try:
-                parsed = json.loads(data["output"])
-                if isinstance(parsed, dict):
-                    return parsed
-            except Exception:
-                pass
-        raise RuntimeError(f"Offline LLM 回傳格式錯誤：{data}")
-
-    # 簡單 fallback：嘗試從問題文字中抓 LOT 名稱，組成 lot_pchart 工具呼叫
-    user_text = ""
-    for m in reversed(messages):
-        if m.get("role") == "user":
-            user_text = str(m.get("content", ""))
-            break
-    # 抓取類似 LOT 名稱的 token（含英數與 -/_）
-    tokens = re.findall(r"[A-Za-z0-9_-]+", user_text)
-    # 過濾掉太短的 token
-    lots = [t for t in tokens if len(t) >= 3]
-    if not lots:
-        raise RuntimeError("離線模式下無法從問題中推斷 LOT 名稱，請明確輸入 LOT ID。")
-    return {"tool": "lot_pchart", "params": {"lots": lots}}
-
-
-def _extract_json_from_llm_content(content: str) -> dict:
-    """Parse LLM response: pure JSON or ```json ... ``` block."""
-    content = (content or "").strip()
-    # 嘗試直接解析
-    try:
-        return json.loads(content)
-    except json.JSONDecodeError:
-        pass
-    # 嘗試從 markdown 程式碼區塊取出
-    m = re.search(r"```(?:json)?\s*([\s\S]*?)```", content)
-    if m:
-        try:
-            return json.loads(m.group(1).strip())
-        except json.JSONDecodeError:
-            pass
-    # 嘗試找第一個 { ... } 區塊
-    m = re.search(r"\{[\s\S]*\}", content)
-    if m:
-        try:
-            return json.loads(m.group(0))
-        except json.JSONDecodeError:
-            pass
-    raise RuntimeError(f"無法從 LLM 回傳中解析 JSON：{content[:200]}...")
-
-
-def call_llm_ollama(messages: List[Dict[str, Any]]) -> Dict[str, Any]:
-    """
-    與本機 Ollama 互動。需先安裝並啟動 Ollama（預設 http://localhost:11434）。
-    環境變數：OLLAMA_BASE_URL（預設 http://localhost:11434）、OLLAMA_MODEL（預設 llama3.2）。
-    要求 Ollama 回傳純 JSON：{"tool": "...", "params": {...}}。
-    """
-    try:
-        import requests  # type: ignore
-    except ImportError as exc:
-        raise RuntimeError("請安裝 requests：pip install requests") from exc
-    base = (os.getenv("OLLAMA_BASE_URL") or os.getenv("OLLAMA_HOST") or "http://localhost:11434").rstrip("/")
-    # model = os.getenv("OLLAMA_MODEL", "llama3.2")
-    model = os.getenv("OLLAMA_MODEL", "gemma3:4b")
-    url = f"{base}/api/chat"
-    payload = {"model": model, "messages": messages, "stream": False}
-    try:
-        r = requests.post(url, json=payload, timeout=120)
-        r.raise_for_status()
-    except requests.exceptions.ConnectionError as exc:
-        raise RuntimeError(
-            f"無法連線至 Ollama（{base}）。請確認已安裝並啟動 Ollama（例如終端執行 ollama serve）。"
-        ) from exc
-    except requests.exceptions.Timeout as exc:
-        raise RuntimeError("Ollama 回應逾時，請稍後再試或換較小模型。") from exc
-    except requests.exceptions.HTTPError as exc:
-        raise RuntimeError(f"Ollama 回傳錯誤：{r.status_code} {r.text[:200]}") from exc
-    data = r.json()
-    content = (data.get("message") or {}).get("content") or ""
-    parsed = _extract_json_from_llm_content(content)
-    if not isinstance(parsed, dict) or "tool" not in parsed:
-        raise RuntimeError(f"Ollama 回傳格式須為 {{\"tool\": \"...\", \"params\": {{...}}}}：{parsed}")
-    return parsed
+    data = fast_path(session, question)
+    if data is not None:
+        return data, "rules"
+    messages = [
+        {"role": "system", "content": _llm_system_prompt()},
+        {"role": "user", "content": question},
+    ]
+    data, cached = get_llm_gateway().ask(_llm_backend(backend_label), messages)
+    return data, "cache" if cached else "llm"
 
 
 def get_session():
-    engine = get_engine()
-    init_db(engine)
+    """Session on the process-wide read-only engine (schema created once through the writer engine)."""
+    ensure_db(get_shared_engine())
     from sqlalchemy.orm import sessionmaker
-    return sessionmaker(bind=engine)()
+    return sessionmaker(bind=get_shared_engine(read_only=True))()
 
 
 def load_stdf_ui():
     st.subheader("Load STDF file")
-    stdf_file = st.file_uploader("Choose STDF file", type=["stdf", "std"])
+    stdf_file = st.file_uploader(
+        "Choose STDF file (.stdf / .std, or compressed .gz / .bz2 / .zip)", type=["stdf", "std", "gz", "bz2", "zip"]
+    )
     if stdf_file:
         company = st.text_input("Company (optional)", value="DefaultCompany")
         product = st.text_input("Product (optional)", value="")
         stage = st.text_input("Stage (optional)", value="")
+        force = st.checkbox("Re-load even if unchanged", value=False, help="The load registry skips an upload with the same name and content.")
+        replace = st.checkbox(
+            "Replace the previous upload with this name", value=False,
+            help="Uploads are matched by name and content: without this, a different file with the same name is loaded "
+            "alongside the earlier one; with it, the earlier upload's data is deleted.",
+        )
         if st.button("Load into DB"):
             try:
-                with tempfile.NamedTemporaryFile(suffix=".stdf", delete=False) as tmp:
-                    tmp.write(stdf_file.getvalue())
-                    tmp_path = tmp.name
                 from stdf_loader import load_stdf
-                load_stdf(tmp_path, company_name=company or None, product_name=product or None, stage_name=stage or None)
-                Path(tmp_path).unlink(missing_ok=True)
-                st.success("STDF loaded successfully.")
+                # the uploaded bytes are parsed in memory (decompressed on the fly), no temp file
+                report = load_stdf(
+                    stdf_file, company_name=company or None, product_name=product or None, stage_name=stage or None, force=force,
+                    replace_upload=replace,
+                )
+                if report["action"] == "skip":
+                    st.info("This file was already loaded with the same content; skipped.")
+                elif report["action"] == "replace":
+                    st.success("STDF loaded successfully (replaced the previous upload of this file).")
+                else:
+                    st.success("STDF loaded successfully.")
             except Exception as e:
                 st.error(str(e))
 
@@ -614,52 +542,44 @@ def _get_filters():
 def dashboard_home(session: Session):
     st.subheader("Overview")
     try:
-        filters = _get_filters()
-        lots_q = _lots_query(session, **{k: v for k, v in filters.items() if v is not None})
-        lots_list = lots_q.all()
-        lots = len(lots_list)
-        wafers = session.query(Wafer).filter(Wafer.lot_id.in_([l.id for l in lots_list])).count() if lots_list else 0
-        dies = session.query(Die).filter(Die.lot_id.in_([l.id for l in lots_list])).count() if lots_list else 0
+        filters = {k: v for k, v in _get_filters().items() if v is not None}
+        totals, lots_df = build_lot_overview(session, 50, **filters)
         col1, col2, col3 = st.columns(3)
-        col1.metric("Lots", lots)
-        col2.metric("Wafers", wafers)
-        col3.metric("Dies", dies)
+        col1.metric("Lots", totals["lots"])
+        col2.metric("Wafers", totals["wafers"])
+        col3.metric("Dies", totals["dies"])
 
         st.markdown("#### Hierarchy (Company → Product → Stage → Test Program)")
-        companies = session.query(Company).order_by(Company.name).all()
-        for c in companies:
-            with st.expander(f"**{c.name}** (Company)"):
-                products = session.query(Product).filter_by(company_id=c.id).order_by(Product.name).all()
-                for p in products:
-                    with st.expander(f"  {p.name} (Product)", expanded=False):
-                        stages = session.query(Stage).filter_by(product_id=p.id).order_by(Stage.name).all()
-                        for s in stages:
-                            progs = session.query(TestProgram).filter_by(stage_id=s.id).order_by(TestProgram.name).all()
-                            for prog in progs:
-                                n_lot = session.query(Lot).filter_by(test_program_id=prog.id).count()
-                                n_wafer = session.query(Wafer).join(Lot).filter(Lot.test_program_id == prog.id).count()
-                                n_die = session.query(Die).join(Lot).filter(Lot.test_program_id == prog.id).count()
-                                st.caption(f"  {s.name} → **{prog.name}** ({prog.revision or '-'}): {n_lot} lots, {n_wafer} wafers, {n_die} dies")
+        tree = build_hierarchy_overview(session)
+        for company_id, g in tree.groupby("company_id", sort=False):
+            label = f"**{g['Company'].iloc[0]}** (Company): {g['Lots'].sum()} lots, {g['Wafers'].sum()} wafers, {g['Dies'].sum()} dies"
+            exp, is_open = _lazy_expander(label, key=f"dash_company_{company_id}")
+            if not is_open:
+                continue
+            with exp:
+                progs = g.dropna(subset=["Test program"]).drop(columns=["company_id", "Company"])
+                if progs.empty:
+                    st.caption("No test programs.")
+                    continue
+                progs["Revision"] = progs["Revision"].replace("", "-").fillna("-")
+                st.dataframe(progs, use_container_width=True, hide_index=True)
+                lots = (
+                    session.query(Lot.lot_id, TestProgram.name, Lot.start_t)
+                    .join(TestProgram).join(Stage).join(Product)
+                    .filter(Product.company_id == int(company_id))
+                    .order_by(Lot.start_t.desc(), Lot.id.desc())
+                    .limit(200)
+                    .all()
+                )
+                if lots:
+                    st.caption("Latest lots")
+                    st.dataframe(pd.DataFrame(lots, columns=["Lot", "Test program", "Lot start"]), use_container_width=True, hide_index=True)
 
         st.markdown("#### Test time summary (filtered)")
-        if lots_list:
-            rows = []
-            for l in lots_list[:50]:
-                die_times = session.query(Die.test_t).filter_by(lot_id=l.id).all()
-                total_ms = sum((d[0] or 0) for d in die_times)
-                n_wafer = session.query(Wafer).filter_by(lot_id=l.id).count()
-                rows.append({
-                    "Lot": l.lot_id,
-                    "Part type": l.part_typ or "-",
-                    "Wafers": n_wafer,
-                    "Dies": len(die_times),
-                    "Total test time (ms)": total_ms,
-                    "Lot start": l.start_t.strftime("%Y-%m-%d %H:%M") if l.start_t else "-",
-                })
-            df = pd.DataFrame(rows)
-            st.dataframe(df, use_container_width=True)
-            if len(lots_list) > 50:
-                st.caption(f"Showing first 50 of {len(lots_list)} lots.")
+        if totals["lots"]:
+            st.dataframe(lots_df, use_container_width=True)
+            if totals["lots"] > 50:
+                st.caption(f"Showing first 50 of {totals['lots']} lots.")
         else:
             st.info("No lots match current filters.")
     except Exception as e:
@@ -679,15 +599,15 @@ def lot_to_lot(session: Session):
     if not selected:
         return
     rows = []
-    for lot in session.query(Lot).filter(Lot.lot_id.in_(selected)):
-        dies_in_lot = session.query(Die).filter_by(lot_id=lot.id)
-        total = dies_in_lot.count()
-        total_ms = session.query(func.coalesce(func.sum(Die.test_t), 0)).filter_by(lot_id=lot.id).scalar() or 0
+    lot_summaries = session.query(Lot, LotSummary).outerjoin(LotSummary, LotSummary.lot_id == Lot.id).filter(
+        Lot.lot_id.in_(selected)
+    ).order_by(Lot.id).all()
+    for lot, summ in lot_summaries:
         rows.append({
             "Lot": lot.lot_id,
-            "Total dies": total,
+            "Total dies": summ.die_count if summ else 0,
             "Part type": lot.part_typ or "-",
-            "Total test time (ms)": total_ms,
+            "Total test time (ms)": summ.test_time_sum if summ else 0,
             "Lot start": lot.start_t.strftime("%Y-%m-%d %H:%M") if lot.start_t else "-",
         })
     df = pd.DataFrame(rows)
@@ -703,16 +623,12 @@ def lot_to_lot(session: Session):
         lot_fail = []
         lot_total = []
         lot_labels = []
-        for lot in session.query(Lot).filter(Lot.lot_id.in_(selected)):
-            total = session.query(Die).filter_by(lot_id=lot.id).count()
-            if total == 0:
+        for lot, summ in lot_summaries:
+            if not summ or not summ.die_count:
                 continue
-            fails = session.query(Die.id).join(TestItem, TestItem.die_id == Die.id).filter(
-                Die.lot_id == lot.id, TestItem.pass_fail == 1
-            ).distinct().count()
             lot_labels.append(lot.lot_id)
-            lot_total.append(total)
-            lot_fail.append(fails)
+            lot_total.append(summ.die_count)
+            lot_fail.append(summ.fail_die_count)
         if lot_labels and lot_total:
             pfig = _p_chart(lot_labels, lot_fail, lot_total, title="p-Chart: Proportion defective per Lot")
             if pfig:
@@ -722,9 +638,9 @@ def lot_to_lot(session: Session):
         st.warning(f"p-Chart (lot): {e}")
 
     # Test item dropdown: select which parametric test to compare
-    ptr_tests = session.query(TestItem.test_num, TestItem.test_txt).filter(
-        TestItem.test_type == "PTR", TestItem.result != None
-    ).distinct().limit(200).all()
+    ptr_tests = session.query(TestKey.test_num, TestKey.test_txt).join(
+        Lot, Lot.test_program_id == TestKey.test_program_id
+    ).filter(Lot.lot_id.in_(selected), TestKey.test_type == "PTR").distinct().order_by(TestKey.test_num).limit(200).all()
     if not ptr_tests:
         st.caption("No PTR test results for comparison.")
         return
@@ -739,28 +655,24 @@ def lot_to_lot(session: Session):
         return
     test_num, test_name = ptr_tests[sel_test_idx][0], test_options[sel_test_idx][1]
     try:
-        q = session.query(Lot.lot_id.label("lot_id_str"), TestItem.result).join(Die, Die.lot_id == Lot.id).join(
-            TestItem, TestItem.die_id == Die.id
-        ).filter(
-            TestItem.test_num == test_num, TestItem.test_type == "PTR", Lot.lot_id.in_(selected), TestItem.result != None
-        )
-        rows_pt = [(r.lot_id_str, r.result) for r in q]
-        if not rows_pt:
+        sel_lot_names = {l.id: l.lot_id for l in session.query(Lot).filter(Lot.lot_id.in_(selected)).order_by(Lot.id)}
+        stats = build_lot_test_stats(session, list(sel_lot_names), test_num)
+        if not stats:
             st.info(f"No data for {test_name} in selected lots.")
             return
-        dfp = pd.DataFrame(rows_pt, columns=["Lot", "Result"])
-        fig2 = px.box(dfp, x="Lot", y="Result", title=f"Lot-to-Lot: {test_name}")
-        st.plotly_chart(fig2, use_container_width=True)
+        by_lot = {}   # a LOT_ID repeated across programs is one box, as before
+        for pk, lot in sel_lot_names.items():
+            if pk in stats:
+                by_lot.setdefault(lot, []).append(stats[pk])
+        by_lot = {lot: group[0] if len(group) == 1 else merged(group) for lot, group in by_lot.items()}
+        st.plotly_chart(_stats_box_figure(by_lot, f"Lot-to-Lot: {test_name}"), use_container_width=True)
+        st.caption("Quartiles from a streaming quantile sketch (exact for small lots); whiskers at 1.5 IQR, min / max beyond them as points.")
         # Statistics per lot for selected test
         st.markdown("#### Statistical summary (selected test per lot)")
-        stats_df = _stats_table(dfp, "Result", "Lot")
-        if stats_df is not None and not stats_df.empty:
-            st.dataframe(stats_df, use_container_width=True)
+        st.dataframe(pd.DataFrame([{"Lot": lot, **s.summary()} for lot, s in by_lot.items()]), use_container_width=True)
         # Overall stats
         st.markdown("#### Overall statistics (all selected lots)")
-        overall = _stats_table(dfp, "Result", None)
-        if overall is not None:
-            st.dataframe(overall, use_container_width=True)
+        st.dataframe(pd.DataFrame([merged(stats.values()).summary()]), use_container_width=True)
     except Exception as e:
         st.error(f"Lot-to-Lot test plot: {e}")
 
@@ -768,71 +680,63 @@ def lot_to_lot(session: Session):
 # ---------- Fail Pareto ----------
 def fail_pareto(session: Session):
     st.subheader("Fail Pareto Analysis")
-    level = st.radio("Level", ["Die", "Wafer"], horizontal=True)
+    level = st.radio("Level", ["Die", "Wafer", "Cross-lot"], horizontal=True)
     filters = _get_filters()
     lots_q = _lots_query(session, **{k: v for k, v in filters.items() if v is not None})
     lots = lots_q.all()
     if not lots:
         st.info("No lot data (or none match filters). Adjust Company/Product/Stage/Test Program / Time range.")
         return
+    if level == "Cross-lot":
+        # All lots matching the sidebar filters, broken down per lot
+        st.caption(f"{len(lots)} lots match current filters.")
+        df = test_pareto(session, lots_q, k=20, group_by="lot")
+        if df.empty:
+            st.info("No failing dies in these lots.")
+            return
+        totals = df.groupby(["Test #", "Type", "Test"], as_index=False, sort=False)["Fail count"].sum()
+        st.dataframe(totals, use_container_width=True)
+        fig = px.bar(df, x="Test", y="Fail count", color="Lot", title="Cross-lot Fail Pareto (top 20)")
+        fig.update_xaxes(tickangle=-45)
+        st.plotly_chart(fig, use_container_width=True)
+        dfb = bin_pareto(session, lots_q, k=15, group_by="lot")
+        if not dfb.empty:
+            figb = px.bar(dfb, x="Bin", y="Count", color="Lot", title="Cross-lot Bin Pareto (top 15)")
+            st.plotly_chart(figb, use_container_width=True)
+        return
     lot_ids = [l.lot_id for l in lots]
     sel_lot = st.selectbox("Lot", lot_ids)
     lot = session.query(Lot).filter_by(lot_id=sel_lot).first()
     if not lot:
         return
     if level == "Die":
-        # Pareto by failing test (test_txt + pass_fail=1)
-        fails = session.query(TestItem.test_num, TestItem.test_txt, TestItem.test_type).filter(
-            TestItem.pass_fail == 1
-        ).join(Die).filter(Die.lot_id == lot.id).all()
-        if not fails:
+        # Pareto by failing test (pass_fail=1)
+        df = test_pareto(session, [lot.id], level="Die")
+        if df.empty:
             st.info("No failing dies in this lot.")
             return
-        cnt = defaultdict(int)
-        for tn, tt, typ in fails:
-            key = tt or f"Test#{tn}"
-            cnt[key] += 1
-        df = pd.DataFrame([{"Test": k, "Fail count": v} for k, v in sorted(cnt.items(), key=lambda x: -x[1])])
-        st.dataframe(df, use_container_width=True)
+        st.dataframe(df[["Test", "Fail count"]], use_container_width=True)
         fig = px.bar(df.head(20), x="Test", y="Fail count", title="Die-level Fail Pareto (top 20)")
         fig.update_xaxes(tickangle=-45)
         st.plotly_chart(fig, use_container_width=True)
         # Pareto by bin
-        bins = session.query(Die.hard_bin, Bin.hard_bin_name).select_from(Die).outerjoin(Bin, Bin.die_id == Die.id).filter(
-            Die.lot_id == lot.id, Die.hard_bin != None
-        ).all()
-        bin_cnt = defaultdict(lambda: (0, ""))
-        for hb, hn in bins:
-            bin_cnt[hb] = (bin_cnt[hb][0] + 1, hn or f"Bin{hb}")
-        dfb = pd.DataFrame([{"Bin": v[1] or f"Bin{k}", "Count": v[0]} for k, v in sorted(bin_cnt.items(), key=lambda x: -x[1][0])])
+        dfb = bin_pareto(session, [lot.id], level="Die", k=15)
         if not dfb.empty:
-            figb = px.bar(dfb.head(15), x="Bin", y="Count", title="Die-level Bin Pareto (top 15)")
+            figb = px.bar(dfb, x="Bin", y="Count", title="Die-level Bin Pareto (top 15)")
             st.plotly_chart(figb, use_container_width=True)
     else:
         # Wafer-level: which tests fail most across wafers, which bins dominate
-        wafers = session.query(Wafer).filter_by(lot_id=lot.id).all()
-        if not wafers:
+        df = test_pareto(session, [lot.id], k=20, group_by="wafer")
+        dfb = bin_pareto(session, [lot.id], k=15, group_by="wafer")
+        if df.empty and dfb.empty:
             st.info("No wafers.")
             return
-        wafer_ids = [w.id for w in wafers]
-        fail_by_test = defaultdict(int)
-        fail_by_bin = defaultdict(int)
-        for wid in wafer_ids:
-            dies = session.query(Die.id, Die.hard_bin).filter_by(wafer_id=wid).all()
-            die_ids = [d.id for d in dies]
-            for ti in session.query(TestItem).filter(TestItem.die_id.in_(die_ids), TestItem.pass_fail == 1).all():
-                fail_by_test[ti.test_txt or f"Test#{ti.test_num}"] += 1
-            for d in dies:
-                if d.hard_bin is not None:
-                    fail_by_bin[f"Bin{d.hard_bin}"] += 1
-        df = pd.DataFrame([{"Test": k, "Fail count": v} for k, v in sorted(fail_by_test.items(), key=lambda x: -x[1])]).head(20)
         if not df.empty:
-            fig = px.bar(df, x="Test", y="Fail count", title="Wafer-level Fail Pareto (top 20)")
+            fig = px.bar(df, x="Test", y="Fail count", color="Wafer", title="Wafer-level Fail Pareto (top 20)")
             fig.update_xaxes(tickangle=-45)
             st.plotly_chart(fig, use_container_width=True)
-        dfb = pd.DataFrame([{"Bin": k, "Count": v} for k, v in sorted(fail_by_bin.items(), key=lambda x: -x[1])]).head(15)
         if not dfb.empty:
-            figb = px.bar(dfb, x="Bin", y="Count", title="Wafer-level Bin Pareto")
+            figb = px.bar(dfb, x="Bin", y="Count", color="Wafer", title="Wafer-level Bin Pareto")
             st.plotly_chart(figb, use_container_width=True)
 
 
@@ -856,7 +760,9 @@ def test_suite_items(session: Session):
         } for d in defs])
         st.dataframe(df, use_container_width=True)
     # TestItems belonging to this suite (sample)
-    items = session.query(TestItem).filter(TestItem.test_suite_id == suite_id).limit(500).all()
+    items = session.query(
+        TestItem.die_id, TestKey.test_num, TestKey.test_type, TestItem.result, TestItem.pass_fail
+    ).join(TestKey, TestKey.id == TestItem.test_key_id).filter(TestKey.test_suite_id == suite_id).limit(500).all()
     st.caption(f"TestItem count in suite (sample 500): {len(items)}")
     if items:
         dfi = pd.DataFrame([{
@@ -867,46 +773,14 @@ def test_suite_items(session: Session):
 
 
 def _wafer_map_bin_fig(df_die, title, show_bin_label=True, highlight_xy=None):
-    """Draw a single wafer map with bin color and optional bin labels / highlight."""
+    """Bin wafer map of a die frame (x, y, hard_bin), rasterized by the wafer_map engine."""
     if df_die is None or df_die.empty:
         return None
-    try:
-        df = df_die.copy()
-        df["x"] = pd.to_numeric(df["x"], errors="coerce").fillna(0)
-        df["y"] = pd.to_numeric(df["y"], errors="coerce").fillna(0)
-        df["bin_str"] = df["hard_bin"].astype(str)
-        fig = go.Figure()
-        bins = df["hard_bin"].dropna().unique()
-        colors = px.colors.qualitative.Set2 + px.colors.qualitative.Pastel
-        if len(bins) == 0:
-            fig.add_trace(go.Scatter(
-                x=df["x"], y=df["y"], mode="markers", name="Die",
-                marker=dict(size=8, symbol="square", color="lightblue"),
-            ))
-        else:
-            for i, b in enumerate(bins):
-                sub = df[df["hard_bin"] == b]
-                if sub.empty:
-                    continue
-                fig.add_trace(go.Scatter(
-                    x=sub["x"], y=sub["y"], mode="markers" + ("+text" if show_bin_label and len(sub) <= 200 else ""),
-                    name=f"Bin {b}", marker=dict(size=10, symbol="square", color=colors[i % len(colors)]),
-                    text=sub["bin_str"] if show_bin_label and len(sub) <= 200 else None,
-                    textposition="top center", textfont=dict(size=8),
-                ))
-        if highlight_xy:
-            hx, hy = zip(*highlight_xy) if highlight_xy else ([], [])
-            fig.add_trace(go.Scatter(
-                x=list(hx), y=list(hy), mode="markers", name="Diff",
-                marker=dict(size=14, symbol="x-open", color="red", line=dict(width=2)),
-            ))
-        fig.update_layout(
-            title=title, xaxis_title="X", yaxis_title="Y",
-            showlegend=True, height=400, yaxis=dict(scaleanchor="x", scaleratio=1),
-        )
-        return fig
-    except Exception:
-        return None
+    grid = rasterize(
+        pd.to_numeric(df_die["x"], errors="coerce"), pd.to_numeric(df_die["y"], errors="coerce"),
+        pd.to_numeric(df_die["hard_bin"], errors="coerce"), bins=True,
+    )
+    return bin_map_figure(grid, title, show_bin_label=show_bin_label, highlight_xy=highlight_xy)
 
 
 # ---------- Wafer-to-Wafer with diff comparison ----------
@@ -927,11 +801,14 @@ def wafer_to_wafer(session: Session):
     if not wafers_in_lot:
         st.info("No wafers in this lot.")
         return
+    wafer_summ = {
+        ws.wafer_id: ws for ws in session.query(WaferSummary).filter(WaferSummary.lot_id == chosen_lot_id)
+    }
     rows = []
     for w in wafers_in_lot:
         part_cnt = w.part_cnt or 0
         good_cnt = w.good_cnt or 0
-        total_ms = session.query(func.coalesce(func.sum(Die.test_t), 0)).filter_by(wafer_id=w.id).scalar() or 0
+        total_ms = wafer_summ[w.id].test_time_sum if w.id in wafer_summ else 0
         rows.append({
             "Wafer": w.wafer_id, "Parts": part_cnt, "Good": good_cnt,
             "Yield %": _safe_div(good_cnt, part_cnt, 0) * 100,
@@ -949,12 +826,10 @@ def wafer_to_wafer(session: Session):
     try:
         w_labels, w_fail, w_total = [], [], []
         for w in wafers_in_lot:
-            total = session.query(Die).filter_by(wafer_id=w.id).count()
-            if total == 0:
+            ws = wafer_summ.get(w.id)
+            if not ws or not ws.die_count:
                 continue
-            fails = session.query(Die.id).join(TestItem, TestItem.die_id == Die.id).filter(
-                Die.wafer_id == w.id, TestItem.pass_fail == 1
-            ).distinct().count()
+            total, fails = ws.die_count, ws.fail_die_count
             w_labels.append(w.wafer_id)
             w_total.append(total)
             w_fail.append(fails)
@@ -971,12 +846,10 @@ def wafer_to_wafer(session: Session):
     try:
         stat_rows = []
         for w in wafers_in_lot:
-            total = session.query(Die).filter_by(wafer_id=w.id).count()
-            if total == 0:
+            ws = wafer_summ.get(w.id)
+            if not ws or not ws.die_count:
                 continue
-            fails = session.query(Die.id).join(TestItem, TestItem.die_id == Die.id).filter(
-                Die.wafer_id == w.id, TestItem.pass_fail == 1
-            ).distinct().count()
+            total, fails = ws.die_count, ws.fail_die_count
             stat_rows.append({
                 "Wafer": w.wafer_id, "N": total, "Fail": fails,
                 "p": _safe_div(fails, total), "Yield%": _safe_div(w.good_cnt, w.part_cnt, 0) * 100,
@@ -986,64 +859,44 @@ def wafer_to_wafer(session: Session):
     except Exception as e:
         st.warning(f"Stats: {e}")
 
-    # Multi-wafer comparison: side-by-side wafer maps with bin marked
+    # Multi-wafer comparison: wafer maps with differing dies marked, computed by WaferDiff for N wafers at once
     st.markdown("---")
-    st.subheader("Multi-Wafer comparison (left vs right)")
+    st.subheader("Multi-Wafer comparison")
     wafer_choices = [(w.id, w.wafer_id) for w in wafers_in_lot]
     # multiselect returns list of selected items (tuples)
     selected_wafers = st.multiselect(
-        "Select 2 wafers to compare (left = first, right = second)",
+        "Select 2 or more wafers to compare",
         options=wafer_choices,
         default=wafer_choices[:2] if len(wafer_choices) >= 2 else wafer_choices,
         format_func=lambda x: x[1],
     )
+    tolerance = st.number_input(
+        "Numeric tolerance (PTR value / mean)", min_value=0.0, value=float(WAFER_DIFF_TOLERANCE),
+        format="%.3g", key="w2w_tolerance",
+    )
     if len(selected_wafers) >= 2:
-        # Use first two as left/right
-        left_id, left_label = selected_wafers[0][0], selected_wafers[0][1]
-        right_id, right_label = selected_wafers[1][0], selected_wafers[1][1]
-        wafer_ids = [left_id, right_id]
-
-        # Build (x,y) -> bin per wafer
-        data_by_wafer = {}
-        for wid in wafer_ids:
-            dies = session.query(Die).filter_by(wafer_id=wid).all()
-            dmap = {}
-            for d in dies:
-                if d.x_coord is not None and d.y_coord is not None:
-                    dmap[(d.x_coord, d.y_coord)] = {"hard_bin": d.hard_bin, "die_id": d.id}
-            data_by_wafer[wid] = dmap
-        all_xy = set()
-        for dmap in data_by_wafer.values():
-            all_xy.update(dmap.keys())
-
-        # Differing dies (bin differs)
-        diff_xy = []
-        for xy in all_xy:
-            b1 = data_by_wafer[left_id].get(xy, {}).get("hard_bin")
-            b2 = data_by_wafer[right_id].get(xy, {}).get("hard_bin")
-            if str(b1) != str(b2):
-                diff_xy.append(xy)
+        wafer_ids = [wid for wid, _ in selected_wafers]
+        wafer_label = dict(selected_wafers)
+        diff = WaferDiff(session, wafer_ids)
 
+        # Differing dies: bin not identical on every selected wafer
+        diff_xy = diff.bin_diff_positions()
         st.markdown(f"**Differing die count (bin):** {len(diff_xy)}")
 
-        # Side-by-side wafer maps with bin marked
-        col_left, col_right = st.columns(2)
-        with col_left:
-            dies_left = session.query(Die).filter_by(wafer_id=left_id).all()
-            df_left = pd.DataFrame([{"x": d.x_coord, "y": d.y_coord, "hard_bin": d.hard_bin} for d in dies_left if d.x_coord is not None])
-            fig_left = _wafer_map_bin_fig(df_left, f"Left: {left_label}", show_bin_label=False, highlight_xy=diff_xy)
-            if fig_left:
-                st.plotly_chart(fig_left, use_container_width=True)
-        with col_right:
-            dies_right = session.query(Die).filter_by(wafer_id=right_id).all()
-            df_right = pd.DataFrame([{"x": d.x_coord, "y": d.y_coord, "hard_bin": d.hard_bin} for d in dies_right if d.x_coord is not None])
-            fig_right = _wafer_map_bin_fig(df_right, f"Right: {right_label}", show_bin_label=False, highlight_xy=diff_xy)
-            if fig_right:
-                st.plotly_chart(fig_right, use_container_width=True)
+        # Wafer maps with bin marked, two per row
+        for row_start in range(0, len(wafer_ids), 2):
+            cols = st.columns(2)
+            for col, wid in zip(cols, wafer_ids[row_start:row_start + 2]):
+                with col:
+                    fig_w = _wafer_map_bin_fig(
+                        diff.wafer_map_frame(wid), wafer_label[wid], show_bin_label=False, highlight_xy=diff_xy
+                    )
+                    if fig_w:
+                        st.plotly_chart(fig_w, use_container_width=True)
 
         # Diff-only map (simple: red = differing position)
         if diff_xy:
-            df_diff = pd.DataFrame([{"x": x, "y": y} for x, y in diff_xy])
+            df_diff = pd.DataFrame(diff_xy, columns=["x", "y"])
             fig_diff = px.scatter(
                 df_diff, x="x", y="y", title="Positions where bin differs (red = diff)",
                 labels={"x": "X", "y": "Y"},
@@ -1055,90 +908,52 @@ def wafer_to_wafer(session: Session):
         # Table: selected wafers — common vs different TestItems (value or pass/fail)
         st.markdown("#### TestItem comparison (selected wafers)")
         try:
-            # All tests present on any of the selected wafers
-            tests_in_wafers = session.query(TestItem.test_num, TestItem.test_txt, TestItem.test_type).join(Die).filter(
-                Die.wafer_id.in_(wafer_ids)
-            ).distinct().all()
-            wafer_labels_sel = [selected_wafers[i][1] for i in range(len(selected_wafers))]
-            table_rows = []
-            pchart_data = {}  # test_key -> (wafer_labels, fail_counts, total_counts)
-            for (tnum, ttxt, ttyp) in tests_in_wafers:
-                tname = (ttxt or f"Test#{tnum}").strip() or f"Test#{tnum}"
-                per_wafer_total = []
-                per_wafer_fail = []
-                per_wafer_mean = []
-                for wid in wafer_ids:
-                    q = session.query(Die.id, TestItem.pass_fail, TestItem.result).join(TestItem, TestItem.die_id == Die.id).filter(
-                        Die.wafer_id == wid, TestItem.test_num == tnum, TestItem.test_type == ttyp
-                    ).all()
-                    total = len(q)
-                    fails = sum(1 for _ in q if _[1] == 1)
-                    vals = [r[2] for r in q if r[2] is not None]
-                    per_wafer_total.append(total)
-                    per_wafer_fail.append(fails)
-                    per_wafer_mean.append(float(np.mean(vals)) if vals else None)
-                if not per_wafer_total or sum(per_wafer_total) == 0:
-                    continue
-                pchart_data[(tnum, tname, ttyp)] = (wafer_labels_sel[: len(wafer_ids)], per_wafer_fail, per_wafer_total)
-                # Same = same pass/fail rate and (if PTR) same mean value within tolerance
-                fail_rates = [_safe_div(f, n) for f, n in zip(per_wafer_fail, per_wafer_total)]
-                same_pf = len(set(round(r, 4) for r in fail_rates)) <= 1
-                same_val = True
-                if ttyp == "PTR" and all(m is not None for m in per_wafer_mean):
-                    if max(per_wafer_mean) - min(per_wafer_mean) > 1e-9:
-                        same_val = False
-                status = "Same" if (same_pf and same_val) else "Different"
-                summary = "; ".join([f"{wafer_labels_sel[i]} p={fail_rates[i]:.3f}" + (f" μ={per_wafer_mean[i]:.4f}" if per_wafer_mean[i] is not None else "") for i in range(len(wafer_ids))])
-                table_rows.append({"Test #": tnum, "Test name": tname, "Type": ttyp, "Status": status, "Per-wafer (p=fail rate, μ=mean)": summary[:80] + "…" if len(summary) > 80 else summary})
-            if table_rows:
-                df_comp = pd.DataFrame(table_rows)
+            comp, stats = diff.test_comparison(tolerance)
+            if not comp.empty:
+                labels = [wafer_label[wid] for wid in wafer_ids]
+                rate, mean = stats["fail_rate"].to_numpy(), stats["mean"].to_numpy(dtype=float)
+                summaries = []
+                for i in range(len(comp)):
+                    s = "; ".join(
+                        f"{labels[j]} p={rate[i, j]:.3f}" + (f" μ={mean[i, j]:.4f}" if not np.isnan(mean[i, j]) else "")
+                        for j in range(len(labels))
+                    )
+                    summaries.append(s[:80] + "…" if len(s) > 80 else s)
+                df_comp = pd.DataFrame({
+                    "Test #": comp["test_num"], "Test name": comp["test_name"], "Type": comp["test_type"],
+                    "Status": comp["Status"], "Δp (max-min)": comp["fail_rate_delta"],
+                    "Δμ (max-min)": comp["mean_delta"], "Per-wafer (p=fail rate, μ=mean)": summaries,
+                })
                 st.dataframe(df_comp, use_container_width=True)
                 # p-Chart selector: pick a test to show p-chart across selected wafers
-                test_choices = [(k[0], k[1], k[2]) for k in pchart_data.keys()]
-                test_options_fmt = [f"{t[1]} (#{t[0]}, {t[2]})" for t in test_choices]
-                sel_test_idx = st.selectbox("Show p-Chart for test (proportion defective per wafer)", range(len(test_choices)), format_func=lambda i: test_options_fmt[i], key="w2w_pchart_test")
-                if sel_test_idx is not None and test_choices:
-                    key = (test_choices[sel_test_idx][0], test_choices[sel_test_idx][1], test_choices[sel_test_idx][2])
-                    if key in pchart_data:
-                        wl, fc, tc = pchart_data[key]
-                        pfig = _p_chart(wl, fc, tc, title=f"p-Chart: {test_choices[sel_test_idx][1]} (per selected wafer)")
-                        if pfig:
-                            st.plotly_chart(pfig, use_container_width=True)
+                test_options_fmt = [f"{n} (#{t}, {ty})" for t, n, ty in zip(comp["test_num"], comp["test_name"], comp["test_type"])]
+                sel_test_idx = st.selectbox("Show p-Chart for test (proportion defective per wafer)", range(len(comp)), format_func=lambda i: test_options_fmt[i], key="w2w_pchart_test")
+                if sel_test_idx is not None:
+                    fc = stats["fails"].iloc[sel_test_idx].astype(int).tolist()
+                    tc = stats["n"].iloc[sel_test_idx].astype(int).tolist()
+                    pfig = _p_chart(labels, fc, tc, title=f"p-Chart: {comp['test_name'].iloc[sel_test_idx]} (per selected wafer)")
+                    if pfig:
+                        st.plotly_chart(pfig, use_container_width=True)
             else:
                 st.caption("No shared TestItems across selected wafers.")
         except Exception as e:
             st.warning(f"TestItem comparison table: {e}")
 
         # Test value comparison (optional)
-        ptr_tests = session.query(TestItem.test_num, TestItem.test_txt).join(Die).filter(
-            Die.wafer_id.in_(wafer_ids), TestItem.test_type == "PTR", TestItem.result != None
-        ).distinct().limit(20).all()
+        ptr_tests = sorted({int(t) for t in diff.tests.loc[diff.tests["test_type"] == "PTR", "test_num"]})[:20]
         if ptr_tests:
             tsel = st.selectbox(
-                "Choose a parametric test to see which die positions have different values (left vs right wafer)",
-                range(len(ptr_tests)), format_func=lambda i: ptr_tests[i][1] or f"Test#{ptr_tests[i][0]}",
-                help="Scatter plot shows (x,y) positions where the selected test’s result differs between the two wafers.",
+                "Choose a parametric test to see which die positions have different values across the selected wafers",
+                range(len(ptr_tests)), format_func=lambda i: diff.test_name(ptr_tests[i], "PTR"),
+                help="Scatter plot shows (x,y) positions where the selected test’s result differs (beyond the tolerance) between wafers.",
             )
             if tsel is not None:
-                tnum = ptr_tests[tsel][0]
-                val_by_wafer = {}
-                for wid in wafer_ids:
-                    rows_v = session.query(Die.x_coord, Die.y_coord, TestItem.result).join(TestItem, TestItem.die_id == Die.id).filter(
-                        Die.wafer_id == wid, TestItem.test_num == tnum, TestItem.test_type == "PTR", TestItem.result != None
-                    ).all()
-                    val_by_wafer[wid] = {(r[0], r[1]): r[2] for r in rows_v if r[0] is not None}
-                all_xy_val = set()
-                for v in val_by_wafer.values():
-                    all_xy_val.update(v.keys())
-                diff_val = []
-                for xy in all_xy_val:
-                    v1, v2 = val_by_wafer[left_id].get(xy), val_by_wafer[right_id].get(xy)
-                    if v1 is not None and v2 is not None and abs(v1 - v2) > 1e-9:
-                        diff_val.append(xy)
-                st.write(f"**Die positions where this test’s measured value differs between left and right wafer:** {len(diff_val)}")
+                tnum = ptr_tests[tsel]
+                diff_val = diff.value_diff_positions(tnum, tolerance)
+                st.write(f"**Die positions where this test’s measured value differs between the selected wafers:** {len(diff_val)}")
                 if diff_val:
-                    dfv = pd.DataFrame([{"x": x, "y": y} for x, y in diff_val])
-                    figv = px.scatter(dfv, x="x", y="y", title=f"Wafer map: die positions with different {ptr_tests[tsel][1] or tnum} value (left vs right)")
+                    dfv = pd.DataFrame(diff_val, columns=["x", "y"])
+                    figv = px.scatter(dfv, x="x", y="y", title=f"Wafer map: die positions with different {diff.test_name(tnum, 'PTR')} value")
                     figv.update_traces(marker=dict(size=10, color="darkorange"))
                     st.plotly_chart(figv, use_container_width=True)
 
@@ -1159,25 +974,24 @@ def die_to_die(session: Session):
         return
     wafer_id = wafer_options[sel][0]
     wafer_label = wafer_options[sel][1]
-    dies = session.query(Die).filter_by(wafer_id=wafer_id).all()
-    if not dies:
+    wsumm = session.get(WaferSummary, wafer_id)
+    grid = wafer_bin_grid(session, wafer_id)   # None: no dies with coordinates
+    if grid is None and not (wsumm and wsumm.die_count):
         st.info("No dies on this wafer.")
         return
-    df = pd.DataFrame([{"x": d.x_coord, "y": d.y_coord, "hard_bin": d.hard_bin, "soft_bin": d.soft_bin} for d in dies])
-    # Wafer map with bin marked (simpler: color by bin, optional labels)
-    if df["x"].notna().any() and df["y"].notna().any():
-        fig_bin = _wafer_map_bin_fig(df, f"Wafer map (bin): {wafer_label}", show_bin_label=(len(df) <= 150))
-        if fig_bin:
-            st.plotly_chart(fig_bin, use_container_width=True)
+    # Wafer map colored by hard bin (bin labels on small wafers)
+    if grid is not None:
+        st.plotly_chart(
+            bin_map_figure(grid, f"Wafer map (bin): {wafer_label}", show_bin_label=grid.n_dies <= 150),
+            use_container_width=True,
+        )
 
     # p-Chart: proportion defective per "subgroup" — for single wafer we use spatial regions or just overall p
     st.markdown("#### p-Chart (Pass/Fail on this wafer)")
     try:
-        total = len(dies)
+        total = wsumm.die_count if wsumm else grid.n_dies
         if total > 0:
-            fail_count = session.query(Die.id).join(TestItem, TestItem.die_id == Die.id).filter(
-                Die.wafer_id == wafer_id, TestItem.pass_fail == 1
-            ).distinct().count()
+            fail_count = wsumm.fail_die_count if wsumm else 0
             pfig = _p_chart([wafer_label], [fail_count], [total], title=f"p-Chart: {wafer_label} (proportion defective)")
             if pfig:
                 st.plotly_chart(pfig, use_container_width=True)
@@ -1187,16 +1001,14 @@ def die_to_die(session: Session):
     # Statistics: bin counts, pass/fail, parametric summary
     st.markdown("#### Statistics (this wafer)")
     try:
-        bin_counts = session.query(Die.hard_bin, func.count(Die.id)).filter(
-            Die.wafer_id == wafer_id, Die.hard_bin != None
-        ).group_by(Die.hard_bin).all()
+        bin_counts = session.query(BinCount.hard_bin, BinCount.die_count).filter(
+            BinCount.wafer_id == wafer_id
+        ).order_by(BinCount.hard_bin).all()
         stat_rows = [{"Bin": f"Bin{hb}", "Count": c} for hb, c in bin_counts]
         if stat_rows:
             st.dataframe(pd.DataFrame(stat_rows), use_container_width=True)
-        fail_count = session.query(Die.id).join(TestItem, TestItem.die_id == Die.id).filter(
-            Die.wafer_id == wafer_id, TestItem.pass_fail == 1
-        ).distinct().count()
-        total_test_ms = session.query(func.coalesce(func.sum(Die.test_t), 0)).filter_by(wafer_id=wafer_id).scalar() or 0
+        fail_count = wsumm.fail_die_count if wsumm else 0
+        total_test_ms = wsumm.test_time_sum if wsumm else 0
         mean_test_ms = _safe_div(total_test_ms, total, 0)
         st.metric("Total dies", total)
         st.metric("Failing dies", fail_count)
@@ -1207,9 +1019,11 @@ def die_to_die(session: Session):
         st.warning(f"Stats: {e}")
 
     # Test item dropdown: wafer map by selected test
-    ptr_tests = session.query(TestItem.test_num, TestItem.test_txt).join(Die).filter(
-        Die.wafer_id == wafer_id, TestItem.test_type == "PTR", TestItem.result != None
-    ).distinct().limit(100).all()
+    ptr_tests = session.query(TestKey.test_num, TestKey.test_txt).join(
+        Lot, Lot.test_program_id == TestKey.test_program_id
+    ).join(Wafer, Wafer.lot_id == Lot.id).filter(
+        Wafer.id == wafer_id, TestKey.test_type == "PTR"
+    ).order_by(TestKey.test_num).limit(100).all()
     if ptr_tests:
         test_options = [(t[0], (t[1] or f"Test#{t[0]}").strip() or f"Test#{t[0]}") for t in ptr_tests]
         tsel = st.selectbox(
@@ -1219,18 +1033,90 @@ def die_to_die(session: Session):
         )
         if tsel is not None:
             test_num, test_name = ptr_tests[tsel][0], test_options[tsel][1]
-            results = session.query(Die.x_coord, Die.y_coord, TestItem.result).join(TestItem, TestItem.die_id == Die.id).filter(
-                Die.wafer_id == wafer_id, TestItem.test_num == test_num, TestItem.test_type == "PTR", TestItem.result != None
-            ).all()
-            if results:
-                dfr = pd.DataFrame(results, columns=["x", "y", "result"])
-                fig2 = px.scatter(dfr, x="x", y="y", color="result", title=f"Wafer map: {test_name}", color_continuous_scale="Viridis")
-                fig2.update_layout(yaxis=dict(scaleanchor="x", scaleratio=1))
+            dfr = _test_xy_frame(wafer_matrix(session, wafer_id, [test_num]), test_num)
+            if not dfr.empty:
+                fig2 = value_map_figure(rasterize(dfr["x"], dfr["y"], dfr["result"]), f"Wafer map: {test_name}")
                 st.plotly_chart(fig2, use_container_width=True)
                 # Stats for this test on this wafer
                 stats_df = _stats_table(dfr, "result", None)
                 if stats_df is not None:
                     st.dataframe(stats_df, use_container_width=True)
+        # Correlation of selected tests across the dies of this wafer
+        st.markdown("#### Test correlation (this wafer)")
+        corr_sel = st.multiselect(
+            "Tests to correlate", range(len(test_options)), default=list(range(min(5, len(test_options)))),
+            format_func=lambda i: test_options[i][1],
+            help="Pearson correlation of the measured values across dies (dies missing a test are skipped pairwise).",
+        )
+        if len(corr_sel) >= 2:
+            try:
+                tests, corr = wafer_matrix(session, wafer_id, [ptr_tests[i][0] for i in corr_sel]).correlation()
+                names = {t[0]: t[1] for t in test_options}
+                labels = [names.get(int(t), f"Test#{t}") for t in tests]
+                figc = px.imshow(corr, x=labels, y=labels, zmin=-1, zmax=1, color_continuous_scale="RdBu_r", text_auto=".2f")
+                st.plotly_chart(figc, use_container_width=True)
+            except Exception as e:
+                st.warning(f"Test correlation: {e}")
+
+
+# ---------- Composite wafer map (many wafers stacked) ----------
+def _show_composite_map(out, top_k: int = 20):
+    """Display build_composite_map output: fail-rate and bin-mode maps side by side, value map, worst positions."""
+    st.caption(f"{out['n_wafers']} wafers, {out['n_dies']} dies, {len(out['frame'])} positions")
+    col_a, col_b = st.columns(2)
+    with col_a:
+        if out["fail_fig"]:
+            st.plotly_chart(out["fail_fig"], use_container_width=True)
+    with col_b:
+        if out["bin_fig"]:
+            st.plotly_chart(out["bin_fig"], use_container_width=True)
+    if out["value_fig"]:
+        st.plotly_chart(out["value_fig"], use_container_width=True)
+    worst = out["frame"].sort_values(["fail_rate", "n"], ascending=False).head(top_k)
+    st.dataframe(worst.round({"fail_rate": 4, "bin_share": 3}), use_container_width=True, hide_index=True)
+
+
+def composite_map(session: Session):
+    st.subheader("Composite wafer map")
+    st.caption("Stack many wafers: per (X, Y) fail rate, most frequent hard bin and mean of a parametric test.")
+    filters = _get_filters()
+    lots_q = _lots_query(session, **{k: v for k, v in filters.items() if v is not None})
+    lots = lots_q.join(Wafer).distinct().order_by(Lot.id).all()
+    if not lots:
+        st.info("No wafer data (or none match filters). Adjust Company/Product/Stage/Test Program / Time range.")
+        return
+    lot_label = {l.id: l.lot_id for l in lots}
+    sel_lots = st.multiselect(
+        "Lots", list(lot_label), default=list(lot_label)[:1], format_func=lambda pk: lot_label[pk], key="cmp_lots",
+    )
+    if not sel_lots:
+        return
+    wafers = session.query(Wafer.id, Wafer.wafer_id, Wafer.lot_id).filter(Wafer.lot_id.in_(sel_lots)).order_by(Wafer.id).all()
+    if st.checkbox(f"All wafers of the selected lots ({len(wafers)})", value=True, key="cmp_all_wafers"):
+        wafer_pks = [w[0] for w in wafers]
+    else:
+        wafer_label = {w[0]: f"{w[1]} (lot: {lot_label[w[2]]})" for w in wafers}
+        wafer_pks = st.multiselect(
+            "Wafers", list(wafer_label), default=list(wafer_label)[:2], format_func=lambda pk: wafer_label[pk],
+            key="cmp_wafers",
+        )
+    if not wafer_pks:
+        return
+    programs = {l.test_program_id for l in lots if l.id in sel_lots}
+    ptr_tests = session.query(TestKey.test_num, TestKey.test_txt).filter(
+        TestKey.test_program_id.in_(programs), TestKey.test_type == "PTR"
+    ).group_by(TestKey.test_num, TestKey.test_txt).order_by(TestKey.test_num).limit(200).all()
+    test_options = [(None, "(none)")] + [(t[0], (t[1] or "").strip() or f"Test#{t[0]}") for t in ptr_tests]
+    tsel = st.selectbox(
+        "Parametric test (mean value map)", range(len(test_options)), format_func=lambda i: test_options[i][1],
+        key="cmp_test",
+    )
+    test_num, test_name = test_options[tsel or 0]
+    out = build_composite_map(session, sorted(wafer_pks), test_num, test_name)
+    if out is None:
+        st.info("No dies with coordinates on the selected wafers.")
+        return
+    _show_composite_map(out)
 
 
 # ---------- Bin summary ----------
@@ -1343,90 +1229,175 @@ def custom_query(session: Session):
             run_sql(df_placeholder, session, sql)
 
 
-def _execute_llm_tool_display(session: Session, tool: str, params: dict) -> bool:
+def _llm_lot(session: Session, value) -> str:
+    """LOT_ID in the DB for a lot named by the LLM (any case, unique prefix or close spelling); else as given."""
+    return entity_index(session).find_lot(str(value)) or str(value)
+
+
+def _build_llm_tool(session: Session, tool: str, params: dict) -> dict:
     """
-    執行 LLM 工具並在當前 context 顯示圖表/表格。回傳是否成功顯示內容。
+    執行一個 LLM 工具，只產生結果不呼叫 Streamlit（可在 worker thread 執行）。
+    回傳 {"tool", "params", "ok", "message", 以及 figs / table / diff / composite}，由 _show_llm_tool 顯示。
     """
     params = params or {}
+    out = {"tool": tool, "params": params, "ok": False, "message": None, "figs": []}
+    index = entity_index(session)
     if tool == "lot_pchart":
         lots = params.get("lots") or []
         if not isinstance(lots, list) or not lots:
-            st.caption("lot_pchart 的 lots 參數為空。")
-            return False
-        fig = build_lot_pchart_figure(session, lots)
+            out["message"] = "lot_pchart 的 lots 參數為空。"
+            return out
+        fig = build_lot_pchart_figure(session, [_llm_lot(session, l) for l in lots])
         if fig:
-            st.plotly_chart(fig, use_container_width=True)
-            return True
-        st.caption("找不到對應的 lots 或沒有足夠資料。")
-        return False
+            out.update(ok=True, figs=[fig])
+        else:
+            out["message"] = "找不到對應的 lots 或沒有足夠資料。"
     elif tool == "wafer_map":
         lot_id = params.get("lot")
         wafer = params.get("wafer")
         if not lot_id or not wafer:
-            st.caption("wafer_map 需要 lot、wafer。")
-            return False
-        fig = build_wafer_map_figure(session, str(lot_id), str(wafer))
+            out["message"] = "wafer_map 需要 lot、wafer。"
+            return out
+        fig = build_wafer_map_figure(session, _llm_lot(session, lot_id), str(wafer))
         if fig:
-            st.plotly_chart(fig, use_container_width=True)
-            return True
-        st.caption("找不到對應的 lot/wafer。")
-        return False
+            out.update(ok=True, figs=[fig])
+        else:
+            out["message"] = "找不到對應的 lot/wafer。"
     elif tool == "top_fail_pareto":
         level = params.get("level") or "Die"
         lot_id = params.get("lot")
         k = params.get("k", 5)
         if not lot_id:
-            st.caption("top_fail_pareto 需要 lot。")
-            return False
-        fig, df = build_top_fail_pareto_figure(session, str(level), int(k), str(lot_id))
+            out["message"] = "top_fail_pareto 需要 lot。"
+            return out
+        fig, df = build_top_fail_pareto_figure(session, str(level), int(k), _llm_lot(session, lot_id))
         if df is not None and not df.empty:
-            st.dataframe(df, use_container_width=True)
+            out["table"] = df
         if fig:
-            st.plotly_chart(fig, use_container_width=True)
-            return True
-        st.caption("沒有足夠的 fail 資料。")
-        return False
+            out.update(ok=True, figs=[fig])
+        else:
+            out["message"] = "沒有足夠的 fail 資料。"
     elif tool == "wafer_diff":
         lot_id = params.get("lot")
         wafer_left = params.get("wafer_left")
         wafer_right = params.get("wafer_right")
         if not lot_id or not wafer_left or not wafer_right:
-            st.caption("wafer_diff 需要 lot、wafer_left、wafer_right。")
-            return False
-        out = build_wafer_to_wafer_diff(session, str(lot_id), str(wafer_left), str(wafer_right))
-        st.caption(f"**Bin 差異 die 數：** {out['diff_count']}")
-        col_a, col_b = st.columns(2)
-        with col_a:
-            if out["left_fig"]:
-                st.plotly_chart(out["left_fig"], use_container_width=True)
-        with col_b:
-            if out["right_fig"]:
-                st.plotly_chart(out["right_fig"], use_container_width=True)
-        if out["diff_fig"]:
-            st.plotly_chart(out["diff_fig"], use_container_width=True)
-        return bool(out["left_fig"] or out["right_fig"])
+            out["message"] = "wafer_diff 需要 lot、wafer_left、wafer_right。"
+            return out
+        diff = build_wafer_to_wafer_diff(session, _llm_lot(session, lot_id), str(wafer_left), str(wafer_right))
+        out.update(ok=bool(diff["left_fig"] or diff["right_fig"]), diff=diff)
+        if not out["ok"]:
+            out["message"] = "找不到對應的 lot/wafer，或沒有足夠資料。"
     elif tool == "test_heatmap":
         lot_id = params.get("lot")
         wafer = params.get("wafer")
         test = params.get("test")
         if not lot_id or not wafer or test is None:
-            st.caption("test_heatmap 需要 lot、wafer、test。")
-            return False
-        fig = build_test_value_heatmap_figure(session, str(lot_id), str(wafer), test)
+            out["message"] = "test_heatmap 需要 lot、wafer、test。"
+            return out
+        fig = build_test_value_heatmap_figure(session, _llm_lot(session, lot_id), str(wafer), test)
         if fig:
-            st.plotly_chart(fig, use_container_width=True)
-            return True
-        st.caption("找不到對應的 lot/wafer/測試。")
-        return False
+            out.update(ok=True, figs=[fig])
+        else:
+            out["message"] = "找不到對應的 lot/wafer/測試。"
+    elif tool == "composite_map":
+        lots = params.get("lots") or []
+        if isinstance(lots, str):
+            lots = [lots]
+        if not lots:
+            out["message"] = "composite_map 需要 lots。"
+            return out
+        lot_rows = index.lots([_llm_lot(session, l) for l in lots])
+        wafers = params.get("wafers") or []
+        if isinstance(wafers, str):
+            wafers = [wafers]
+        if wafers:
+            matched = (index.wafer(r[0], w, loose=False) for r in lot_rows for w in wafers)
+            wafer_pks = sorted({m[0] for m in matched if m})
+        else:
+            wafer_pks = sorted(w[0] for r in lot_rows for w in index.wafers(r[0]))
+        test_num = test_name = None
+        if params.get("test") not in (None, ""):
+            resolved = _resolve_ptr_test(session, {r[2] for r in lot_rows}, params["test"])
+            if resolved is None:
+                out["message"] = "找不到對應的測試。"
+                return out
+            test_num, test_name = resolved
+        comp = build_composite_map(session, wafer_pks, test_num, test_name) if wafer_pks else None
+        if comp is None:
+            out["message"] = "找不到對應的 lots/wafers。"
+        else:
+            out.update(ok=True, composite=comp)
     else:
-        st.caption(f"不支援工具：{tool}")
-        return False
+        out["message"] = f"不支援工具：{tool}"
+    return out
+
+
+def _build_llm_tool_safe(session: Session, call: dict) -> dict:
+    """_build_llm_tool with errors turned into a message, so one failing call does not hide the others."""
+    try:
+        return _build_llm_tool(session, call["tool"], call.get("params"))
+    except Exception as e:
+        session.rollback()
+        return {"tool": call["tool"], "params": call.get("params") or {}, "ok": False, "message": f"錯誤：{e}", "figs": []}
+
+
+def _llm_tool_worker(call: dict, data_version) -> dict:
+    session = get_session()
+    session.info["data_version"] = data_version   # same version (and cache keys) as the caller's render
+    try:
+        return _build_llm_tool_safe(session, call)
+    finally:
+        session.close()
+
+
+def run_llm_tool_calls(session: Session, calls: List[dict]) -> List[dict]:
+    """
+    Results of tool calls, in the given order. A single call is built on the caller's session; several are
+    built concurrently (LLM_TOOL_WORKERS threads, each with its own read-only session), so a compound
+    question takes about its slowest tool. Identical calls are built once.
+    """
+    keys = [json.dumps(c, sort_keys=True, ensure_ascii=False, default=str) for c in calls]
+    unique = dict(zip(keys, calls))
+    if len(unique) <= 1 or LLM_TOOL_WORKERS <= 1:
+        built = {k: _build_llm_tool_safe(session, c) for k, c in unique.items()}
+    else:
+        version = get_data_version(session)
+        with ThreadPoolExecutor(max_workers=min(LLM_TOOL_WORKERS, len(unique)), thread_name_prefix="llm-tool") as pool:
+            futures = {k: pool.submit(_llm_tool_worker, c, version) for k, c in unique.items()}
+            built = {k: f.result() for k, f in futures.items()}
+    return [built[k] for k in keys]
+
+
+def _show_llm_tool(result: dict, notice=st.caption) -> bool:
+    """顯示 _build_llm_tool 的結果（圖表 / 表格），沒有內容時以 notice 顯示原因。回傳是否成功顯示內容。"""
+    if result.get("table") is not None:
+        st.dataframe(result["table"], use_container_width=True)
+    diff = result.get("diff")
+    if diff:
+        st.caption(f"**Bin 差異 die 數：** {diff['diff_count']}")
+        col_a, col_b = st.columns(2)
+        with col_a:
+            if diff["left_fig"]:
+                st.plotly_chart(diff["left_fig"], use_container_width=True)
+        with col_b:
+            if diff["right_fig"]:
+                st.plotly_chart(diff["right_fig"], use_container_width=True)
+        if diff["diff_fig"]:
+            st.plotly_chart(diff["diff_fig"], use_container_width=True)
+    if result.get("composite"):
+        _show_composite_map(result["composite"], top_k=10)
+    for fig in result.get("figs") or []:
+        st.plotly_chart(fig, use_container_width=True)
+    if result.get("message"):
+        notice(result["message"])
+    return result["ok"]
 
 
 def _llm_system_prompt() -> str:
     return (
         "你是 STDF/良率分析助理。"
-        "目前支援以下五個工具（請依需求選一個使用）：\n"
+        "目前支援以下六個工具（請依需求選用）：\n"
         "1) lot_pchart: 畫多個 Lot 的不良率 p-chart。\n"
         "   參數: {\"lots\": [\"LOT1\",\"LOT2\", ...]}\n"
         "2) wafer_map: 畫某個 Lot 的某一片 wafer map（以 hard bin 著色）。\n"
@@ -1437,8 +1408,14 @@ def _llm_system_prompt() -> str:
         "   參數: {\"lot\": \"LOT1\", \"wafer_left\": \"01\", \"wafer_right\": \"02\"}\n"
         "5) test_heatmap: 某片 wafer 上某個 PTR 測試的量測值熱力圖（依座標著色）。\n"
         "   參數: {\"lot\": \"LOT1\", \"wafer\": \"01\", \"test\": \"測試名稱\" 或 test_num 數字}\n"
-        "請根據使用者問題，選擇一個最適合的工具與參數，然後輸出『純 JSON』，"
-        "格式嚴格為：{\"tool\":\"工具名\",\"params\":{...}}。不要加任何多餘文字、註解或說明，只能輸出一個 JSON 物件。"
+        "6) composite_map: 疊合多片 wafer（可跨 Lot）的 composite wafer map：每個座標的不良率、最常見 bin，"
+        "可選某 PTR 測試的平均值。\n"
+        "   參數: {\"lots\": [\"LOT1\", ...], \"wafers\": [\"01\", ...]（選填，預設全部）, \"test\": 測試名稱或編號（選填）}\n"
+        "請根據使用者問題，選擇最適合的工具與參數，然後輸出『純 JSON』。"
+        "只需一個工具時格式嚴格為：{\"tool\":\"工具名\",\"params\":{...}}；"
+        "問題同時要求多個圖表時（例如「比較 LOT1 和 LOT2 的 p-chart 並列出兩者的 top5 pareto」），"
+        "依問題順序列出每個工具呼叫：{\"calls\":[{\"tool\":\"工具名\",\"params\":{...}}, ...]}。"
+        "不要加任何多餘文字、註解或說明，只能輸出一個 JSON 物件。"
     )
 
 
@@ -1458,13 +1435,21 @@ def render_llm_chat_panel(session: Session):
     # 對話歷史（最近 N 則，避免過長）
     history = st.session_state["llm_chat_history"]
     max_show = 20
-    for i, msg in enumerate(history[-max_show:]):
+    shown = history[-max_show:]
+    # every tool call of the shown answers built in one concurrent batch, then displayed in order
+    results = iter(run_llm_tool_calls(
+        session, [c for msg in shown if msg.get("role") == "assistant" for c in tool_calls(msg)]
+    ))
+    for i, msg in enumerate(shown):
         if msg.get("role") == "user":
             st.markdown(f"**您：** {msg.get('content', '')}")
         elif msg.get("role") == "assistant":
-            if msg.get("tool"):
-                st.caption(f"🔧 {msg['tool']}")
-                _execute_llm_tool_display(session, msg["tool"], msg.get("params") or {})
+            calls = tool_calls(msg)
+            if calls:
+                for _ in calls:
+                    result = next(results)
+                    st.caption(f"🔧 {result['tool']}")
+                    _show_llm_tool(result)
             else:
                 st.markdown(f"**助理：** {msg.get('content', '')}")
         st.markdown("---")
@@ -1475,28 +1460,21 @@ def render_llm_chat_panel(session: Session):
             st.caption("請輸入問題。")
         else:
             st.session_state["llm_chat_history"].append({"role": "user", "content": question.strip()})
-            messages = [
-                {"role": "system", "content": _llm_system_prompt()},
-                {"role": "user", "content": question.strip()},
-            ]
             try:
-                if backend.startswith("Online"):
-                    data = call_llm_online(messages)
-                elif "Ollama" in backend:
-                    data = call_llm_ollama(messages)
-                else:
-                    data = call_llm_offline(messages)
+                data, source = ask_llm(session, backend, question.strip())
             except Exception as e:
                 st.session_state["llm_chat_history"].append({"role": "assistant", "content": f"錯誤：{e}"})
                 st.rerun()
-            if not isinstance(data, dict) or "tool" not in data:
+            calls = tool_calls(data)
+            if not calls:
                 st.session_state["llm_chat_history"].append({"role": "assistant", "content": f"回傳格式不正確：{data}"})
                 st.rerun()
-            tool = data.get("tool")
-            params = data.get("params") or {}
-            st.session_state["llm_chat_history"].append({"role": "assistant", "tool": tool, "params": params})
+            st.session_state["llm_chat_history"].append({"role": "assistant", "calls": calls})
             try:
-                log_entry = {"question": question, "backend": backend, "parsed": data, "ts": datetime.utcnow().isoformat()}
+                log_entry = {
+                    "question": question, "backend": backend, "parsed": data, "source": source,
+                    "ts": datetime.utcnow().isoformat(),
+                }
                 with Path("llm_logs.jsonl").open("a", encoding="utf-8") as f:
                     f.write(json.dumps(log_entry, ensure_ascii=False) + "\n")
             except Exception:
@@ -1523,37 +1501,13 @@ def llm_assistant(session: Session):
         if not question.strip():
             st.warning("請先輸入問題。")
             return
-        system_prompt = (
-            "你是 STDF/良率分析助理。"
-            "目前支援以下五個工具（請依需求選一個使用）：\n"
-            "1) lot_pchart: 畫多個 Lot 的不良率 p-chart。\n"
-            "   參數: {\"lots\": [\"LOT1\",\"LOT2\", ...]}\n"
-            "2) wafer_map: 畫某個 Lot 的某一片 wafer map（以 hard bin 著色）。\n"
-            "   參數: {\"lot\": \"LOT1\", \"wafer\": \"01\"}\n"
-            "3) top_fail_pareto: 列出某 Lot 的 top-k fail pareto，level 可為 \"Die\" 或 \"Wafer\"。\n"
-            "   參數: {\"level\": \"Die\" 或 \"Wafer\", \"k\": 5, \"lot\": \"LOT1\"}\n"
-            "4) wafer_diff: 比較同一 Lot 內兩片 wafer 的 bin 差異（左/右 wafer map + 差異位置圖）。\n"
-            "   參數: {\"lot\": \"LOT1\", \"wafer_left\": \"01\", \"wafer_right\": \"02\"}\n"
-            "5) test_heatmap: 某片 wafer 上某個 PTR 測試的量測值熱力圖（依座標著色）。\n"
-            "   參數: {\"lot\": \"LOT1\", \"wafer\": \"01\", \"test\": \"測試名稱\" 或 test_num 數字}\n"
-            "請根據使用者問題，選擇一個最適合的工具與參數，然後輸出『純 JSON』，"
-            "格式嚴格為：{\"tool\":\"工具名\",\"params\":{...}}。不要加任何多餘文字、註解或說明，只能輸出一個 JSON 物件。"
-        )
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": question},
-        ]
         try:
-            if backend.startswith("Online"):
-                data = call_llm_online(messages)
-            elif "Ollama" in backend:
-                data = call_llm_ollama(messages)
-            else:
-                data = call_llm_offline(messages)
+            data, source = ask_llm(session, backend, question)
         except Exception as e:
             st.error(str(e))
             return
-        if not isinstance(data, dict) or "tool" not in data:
+        calls = tool_calls(data)
+        if not calls:
             st.warning(f"LLM 回傳格式不正確：{data}")
             return
         # 紀錄 log 以利未來 fine-tune
@@ -1562,6 +1516,7 @@ def llm_assistant(session: Session):
                 "question": question,
                 "backend": backend,
                 "parsed": data,
+                "source": source,
                 "ts": datetime.utcnow().isoformat(),
             }
             log_path = Path("llm_logs.jsonl")
@@ -1569,86 +1524,50 @@ def llm_assistant(session: Session):
                 f.write(json.dumps(log_entry, ensure_ascii=False) + "\n")
         except Exception:
             pass
-
-        tool = data.get("tool")
-        params = data.get("params") or {}
-        if tool == "lot_pchart":
-            lots = params.get("lots") or []
-            if not isinstance(lots, list) or not lots:
-                st.warning("lot_pchart 的 lots 參數為空，請重新描述問題並包含 LOT ID。")
-                return
-            fig = build_lot_pchart_figure(session, lots)
-            if fig:
-                st.plotly_chart(fig, use_container_width=True)
-            else:
-                st.info("找不到對應的 lots 或沒有足夠資料畫 p-chart。")
-        elif tool == "wafer_map":
-            lot_id = params.get("lot")
-            wafer = params.get("wafer")
-            if not lot_id or not wafer:
-                st.warning("wafer_map 需要參數 lot 與 wafer。")
-                return
-            fig = build_wafer_map_figure(session, str(lot_id), str(wafer))
-            if fig:
-                st.plotly_chart(fig, use_container_width=True)
-            else:
-                st.info("找不到對應的 lot/wafer 或沒有足夠資料畫 wafer map。")
-        elif tool == "top_fail_pareto":
-            level = params.get("level") or "Die"
-            lot_id = params.get("lot")
-            k = params.get("k", 5)
-            if not lot_id:
-                st.warning("top_fail_pareto 需要參數 lot。")
-                return
-            fig, df = build_top_fail_pareto_figure(session, str(level), int(k), str(lot_id))
-            if df is not None and not df.empty:
-                st.dataframe(df, use_container_width=True)
-            if fig:
-                st.plotly_chart(fig, use_container_width=True)
-            elif df is None or df.empty:
-                st.info("沒有足夠的 fail 資料可產生 Pareto 圖。")
-        elif tool == "wafer_diff":
-            lot_id = params.get("lot")
-            wafer_left = params.get("wafer_left")
-            wafer_right = params.get("wafer_right")
-            if not lot_id or not wafer_left or not wafer_right:
-                st.warning("wafer_diff 需要參數 lot、wafer_left、wafer_right。")
-                return
-            out = build_wafer_to_wafer_diff(session, str(lot_id), str(wafer_left), str(wafer_right))
-            st.caption(f"**Bin 差異 die 數：** {out['diff_count']}")
-            col_a, col_b = st.columns(2)
-            with col_a:
-                if out["left_fig"]:
-                    st.plotly_chart(out["left_fig"], use_container_width=True)
-            with col_b:
-                if out["right_fig"]:
-                    st.plotly_chart(out["right_fig"], use_container_width=True)
-            if out["diff_fig"]:
-                st.plotly_chart(out["diff_fig"], use_container_width=True)
-            if not out["left_fig"] and not out["right_fig"]:
-                st.info("找不到對應的 lot/wafer，或沒有足夠資料。")
-        elif tool == "test_heatmap":
-            lot_id = params.get("lot")
-            wafer = params.get("wafer")
-            test = params.get("test")
-            if not lot_id or not wafer:
-                st.warning("test_heatmap 需要參數 lot、wafer；test 可為測試名稱或 test number。")
-                return
-            if test is None:
-                st.warning("test_heatmap 需要參數 test（測試名稱或編號）。")
-                return
-            fig = build_test_value_heatmap_figure(session, str(lot_id), str(wafer), test)
-            if fig:
-                st.plotly_chart(fig, use_container_width=True)
-            else:
-                st.info("找不到對應的 lot/wafer/測試或沒有量測值。")
-        else:
-            st.warning(f"目前不支援工具：{tool}")
+        if source == "rules":
+            st.caption("（本機規則解析，未呼叫模型）")
+        elif source == "cache":
+            st.caption("（相同問題的快取結果，未呼叫模型）")
+
+        results = run_llm_tool_calls(session, calls)
+        for result in results:
+            if len(results) > 1:
+                st.markdown(f"**{result['tool']}**")
+            _show_llm_tool(result, notice=st.info)
+
+
+def _performance_panel():
+    """Sidebar panel (STDF_SQL_PROFILE=1): SQL cost of this render and per-function totals since process start."""
+    from sql_profiler import bucket_labels, profiler
+    snap = profiler.snapshot(top=10)
+    with st.sidebar.expander("Performance", expanded=False):
+        rows = "-" if snap["rows"] is None else snap["rows"]
+        st.caption(f"This render: {snap['statements']} statements, {snap['sql_seconds'] * 1000:.1f} ms SQL, {rows} rows")
+        cache = cache_stats()
+        st.caption(f"Query cache: {cache['entries']} entries, {cache['hits']} hits / {cache['misses']} misses")
+        if snap["costliest"]:
+            st.markdown("**Costliest queries**")
+            st.dataframe(pd.DataFrame(snap["costliest"]).round({"ms": 2}), use_container_width=True, hide_index=True)
+        if snap["callers"]:
+            st.markdown("**By function (this render)**")
+            st.dataframe(
+                pd.DataFrame(snap["callers"]).assign(sql_ms=lambda d: (d["sql_seconds"] * 1000).round(2)).drop(columns="sql_seconds"),
+                use_container_width=True, hide_index=True,
+            )
+        totals = profiler.caller_stats()
+        if totals:
+            st.markdown("**Latency histogram by function (process)**")
+            df = pd.DataFrame([{"caller": t["caller"], "statements": t["statements"], "rows": t["rows"], "max_ms": round(t["max_ms"], 2),
+                                **dict(zip(bucket_labels(), t["histogram"]))} for t in totals[:20]])
+            st.dataframe(df, use_container_width=True, hide_index=True)
 
 
 def main():
     st.set_page_config(page_title="STDF Dashboard", layout="wide")
     st.title("STDF Database Dashboard")
+    if SQL_PROFILE:
+        from sql_profiler import profiler
+        profiler.reset()
     session = get_session()
     _sidebar_filters(session)
     sidebar = st.sidebar
@@ -1661,6 +1580,7 @@ def main():
             "Lot-to-Lot",
             "Wafer-to-Wafer",
             "Die-to-Die",
+            "Composite Map",
             "Fail Pareto",
             "TestSuite→TestItem",
             "Bin Summary",
@@ -1682,6 +1602,8 @@ def main():
             wafer_to_wafer(session)
         elif page == "Die-to-Die":
             die_to_die(session)
+        elif page == "Composite Map":
+            composite_map(session)
         elif page == "Fail Pareto":
             fail_pareto(session)
         elif page == "TestSuite→TestItem":
@@ -1694,6 +1616,8 @@ def main():
             custom_query(session)
     with col_chat:
         render_llm_chat_panel(session)
+    if SQL_PROFILE:
+        _performance_panel()
     session.close()
 
 
@@ -0,0 +1,185 @@
+"""
+Concurrent read benchmark: dashboard overview queries (app.build_lot_overview / build_hierarchy_overview,
+uncached) run in reader threads on the read-only engine while a separate process runs load_stdf into the
+same SQLite DB. Reports read latency (p50/p95/max) before and during the load, failed reads
+("database is locked") and load time, once per SQLite settings profile:
+
+    default  rollback journal, synchronous=FULL, SQLite's default cache, no mmap, 5 s busy timeout
+    tuned    the SQLITE_* settings of config.py (WAL, synchronous=NORMAL, larger cache, mmap, busy timeout)
+
+    python benchmarks/concurrency_bench.py --readers 4 --load-wafers 5 --load-dies 2000 --ptr 50 --out conc.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from synthetic_stdf import generate  # noqa: E402
+
+PROFILES = {
+    "default": {
+        "STDF_SQLITE_JOURNAL_MODE": "DELETE",
+        "STDF_SQLITE_SYNCHRONOUS": "FULL",
+        "STDF_SQLITE_CACHE_SIZE_KB": "2000",
+        "STDF_SQLITE_MMAP_SIZE_MB": "0",
+        "STDF_SQLITE_BUSY_TIMEOUT_MS": "5000",
+    },
+    "tuned": {},
+}
+
+
+def _percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def _latency(seconds):
+    ms = [s * 1000 for s in seconds]
+    return {
+        "reads": len(ms),
+        "p50_ms": round(_percentile(ms, 0.5), 2) if ms else None,
+        "p95_ms": round(_percentile(ms, 0.95), 2) if ms else None,
+        "max_ms": round(max(ms), 2) if ms else None,
+    }
+
+
+def _load(db_url, path):
+    """Loader process (inherits the profile's STDF_SQLITE_* environment)."""
+    import contextlib
+    import io
+    from stdf_loader import load_stdf
+    with contextlib.redirect_stdout(io.StringIO()):
+        report = load_stdf(path, db_url=db_url)
+    return report["rows"]
+
+
+def _run_scenario(db_url, load_path, readers, idle_seconds, env):
+    """Child process: reader threads against db_url, idle first, then while a loader process writes."""
+    os.environ.update(env)
+    import logging
+    logging.disable(logging.WARNING)   # Streamlit bare-mode warnings from importing app
+    import app
+    from sqlalchemy import text
+    from sqlalchemy.orm import sessionmaker
+    from db_models import ensure_db, get_shared_engine
+
+    writer = get_shared_engine(db_url)
+    ensure_db(writer)
+    with writer.connect() as conn:
+        journal_mode = conn.execute(text("PRAGMA journal_mode")).scalar()
+    Session = sessionmaker(bind=get_shared_engine(db_url, read_only=True))
+    phase = ["idle"]
+    samples = {"idle": [], "load": []}
+    errors = Counter()
+    stop = threading.Event()
+
+    def reader():
+        while not stop.is_set():
+            current = phase[0]
+            t0 = time.perf_counter()
+            try:
+                with Session() as session:
+                    app.build_lot_overview.uncached(session, 50)
+                    app.build_hierarchy_overview.uncached(session)
+                samples[current].append(time.perf_counter() - t0)
+            except Exception as e:
+                errors[f"{type(e).__name__}: {str(e).splitlines()[0][:120]}"] += 1
+
+    threads = [threading.Thread(target=reader, daemon=True) for _ in range(readers)]
+    for t in threads:
+        t.start()
+    time.sleep(idle_seconds)
+    phase[0] = "load"
+    t0 = time.perf_counter()
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        rows = pool.submit(_load, db_url, load_path).result()
+    load_seconds = time.perf_counter() - t0
+    stop.set()
+    for t in threads:
+        t.join()
+    return {
+        "journal_mode": journal_mode,
+        "load_rows": rows,
+        "load_seconds": round(load_seconds, 3),
+        "idle": _latency(samples["idle"]),
+        "during_load": _latency(samples["load"]),
+        "errors": dict(errors),
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--seed-lots", type=int, default=20, help="lots in the DB before the concurrent load")
+    ap.add_argument("--load-wafers", type=int, default=5)
+    ap.add_argument("--load-dies", type=int, default=2000, help="dies per wafer of the concurrently loaded lot")
+    ap.add_argument("--ptr", type=int, default=50, help="PTR per die")
+    ap.add_argument("--ftr", type=int, default=5, help="FTR per die")
+    ap.add_argument("--readers", type=int, default=4, help="reader threads")
+    ap.add_argument("--idle-seconds", type=float, default=2.0, help="read time before the load starts")
+    ap.add_argument("--profiles", nargs="+", default=list(PROFILES), choices=list(PROFILES))
+    ap.add_argument("--workdir", help="keep generated files and DBs here (default: temp dir, removed)")
+    ap.add_argument("--out", help="write the JSON report here (default: stdout)")
+    a = ap.parse_args()
+
+    workdir = Path(a.workdir) if a.workdir else Path(tempfile.mkdtemp(prefix="stdf_conc_"))
+    workdir.mkdir(parents=True, exist_ok=True)
+    os.environ["STDF_COLUMNAR_DIR"] = ""   # DB contention only
+    try:
+        seed = generate(workdir / "seed", a.seed_lots, 1, 200, 10, 1, 4, seed=1)
+        load_path = generate(workdir / "load", 1, a.load_wafers, a.load_dies, a.ptr, a.ftr, 4, seed=2)[0][0]
+        seed_url = f"sqlite:///{workdir / 'seed.db'}"
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+            for path, _ in seed:
+                pool.submit(_load, seed_url, str(path)).result()
+        report = {
+            "generated_at": datetime.now().isoformat(timespec="seconds"),
+            "host": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+            "config": {k: getattr(a, k) for k in ("seed_lots", "load_wafers", "load_dies", "ptr", "ftr", "readers", "idle_seconds")},
+            "load_mb": round(load_path.stat().st_size / 1e6, 2),
+            "profiles": {},
+        }
+        for name in a.profiles:
+            db_path = workdir / f"{name}.db"
+            shutil.copy(workdir / "seed.db", db_path)
+            env = {**PROFILES[name], "STDF_COLUMNAR_DIR": ""}
+            with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+                report["profiles"][name] = pool.submit(
+                    _run_scenario, f"sqlite:///{db_path}", str(load_path), a.readers, a.idle_seconds, env,
+                ).result()
+    finally:
+        if not a.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(report, indent=2)
+    if a.out:
+        Path(a.out).write_text(text + "\n", encoding="utf-8")
+        for name, r in report["profiles"].items():
+            idle, busy = r["idle"], r["during_load"]
+            print(
+                f"{name:8s} ({r['journal_mode']}): load {r['load_rows']} rows in {r['load_seconds']} s; reads idle p50 {idle['p50_ms']} ms "
+                f"/ p95 {idle['p95_ms']} ms; during load {busy['reads']} reads p50 {busy['p50_ms']} ms / p95 {busy['p95_ms']} ms "
+                f"/ max {busy['max_ms']} ms; {sum(r['errors'].values())} failed"
+            )
+        print(f"report: {a.out}")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
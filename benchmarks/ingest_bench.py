@@ -0,0 +1,257 @@
+"""
+Ingestion benchmark: generates synthetic STDF lots (benchmarks/synthetic_stdf.py), loads them into a fresh
+SQLite DB (and optionally PostgreSQL) with load_stdf or load_stdf_batch, and writes a JSON report with parse
+throughput, DB write throughput, peak RSS of the loading process and final DB / side-store size.
+With --baseline, rows/s and MB/s are compared against an earlier report and the run fails on a regression.
+
+    python benchmarks/ingest_bench.py --lots 2 --wafers 3 --dies 1000 --ptr 50 --ftr 5 --out bench.json
+    python benchmarks/ingest_bench.py --pg-url postgresql+psycopg://user:pw@localhost/stdf_bench
+    python benchmarks/ingest_bench.py --baseline bench.json --max-regression 0.2
+
+The PostgreSQL database is emptied (STDF tables dropped) before its run: use a scratch database.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from synthetic_stdf import generate  # noqa: E402
+
+# metrics compared against --baseline (higher is better)
+_THROUGHPUT_KEYS = ("parse_mb_per_sec", "write_rows_per_sec", "rows_per_sec")
+
+
+def _dir_size(path):
+    path = Path(path)
+    if not path.exists():
+        return 0
+    if path.is_file():
+        return path.stat().st_size
+    return sum(p.stat().st_size for p in path.rglob("*") if p.is_file())
+
+
+def _peak_rss_mb(who=resource.RUSAGE_SELF):
+    rss = resource.getrusage(who).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024   # bytes on macOS, KiB on Linux
+
+
+def _reset_db(db_url):
+    from db_models import Base, get_engine
+    engine = get_engine(db_url)
+    Base.metadata.drop_all(engine)
+    engine.dispose()
+
+
+def _db_size_bytes(db_url):
+    if db_url.startswith("sqlite:///"):
+        path = Path(db_url[len("sqlite:///"):])
+        return sum(_dir_size(Path(str(path) + suffix)) for suffix in ("", "-wal", "-journal"))
+    from sqlalchemy import text
+    from db_models import get_engine
+    engine = get_engine(db_url)
+    with engine.connect() as conn:
+        size = conn.execute(text("SELECT pg_database_size(current_database())")).scalar()
+    engine.dispose()
+    return int(size)
+
+
+def _run_parse_only(paths):
+    """Child process: parse every file without a DB (stdf_loader.parse_stdf into a no-op forwarder)."""
+    from stdf_io import open_stdf
+    from stdf_loader import _RecordForwarder, parse_stdf
+    records = 0
+    t0 = time.perf_counter()
+    for path in paths:
+        sink = _RecordForwarder(lambda batch: None)
+        with open_stdf(path) as src:
+            parse_stdf(src, sink)
+        sink.flush()
+        records += sink.count
+    return {"records": records, "seconds": time.perf_counter() - t0, "peak_rss_mb": _peak_rss_mb()}
+
+
+def _run_load(db_url, paths, columnar_dir, mode, workers, chunk_size):
+    """Child process: load all files into db_url; returns summed load reports and peak RSS."""
+    os.environ["STDF_COLUMNAR_DIR"] = columnar_dir
+    from stdf_loader import load_stdf, load_stdf_batch
+    t0 = time.perf_counter()
+    if mode == "batch":
+        result = load_stdf_batch(paths, db_url=db_url, workers=workers, chunk_size=chunk_size)
+        reports = [r for r in result["files"] if not r["error"]]
+        failed = result["total"]["failed"]
+    else:
+        reports = [load_stdf(p, db_url=db_url, chunk_size=chunk_size) for p in paths]
+        failed = 0
+    wall = time.perf_counter() - t0
+    out = {k: sum(r[k] for r in reports) for k in ("die", "bin", "test_item", "rows")}
+    out["parse_seconds"] = sum(r["parse_seconds"] for r in reports)
+    out["write_seconds"] = sum(r["write_seconds"] for r in reports)
+    # batch mode: parse workers are children of this process; their peak is reported separately
+    out.update(wall_seconds=wall, failed=failed, peak_rss_mb=_peak_rss_mb(),
+               peak_rss_workers_mb=_peak_rss_mb(resource.RUSAGE_CHILDREN))
+    return out
+
+
+def _in_child(fn, *args):
+    """Run fn in a fresh spawned process so peak RSS belongs to that run only."""
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return pool.submit(fn, *args).result()
+
+
+def _redact(db_url):
+    if "@" in db_url and "://" in db_url:
+        scheme, rest = db_url.split("://", 1)
+        return f"{scheme}://***@{rest.split('@', 1)[1]}"
+    return db_url
+
+
+def bench_backend(name, db_url, paths, input_bytes, columnar_dir, mode, workers, chunk_size):
+    _reset_db(db_url)
+    shutil.rmtree(columnar_dir, ignore_errors=True)
+    r = _in_child(_run_load, db_url, [str(p) for p in paths], columnar_dir, mode, workers, chunk_size)
+    input_mb = input_bytes / 1e6
+    return {
+        "backend": name,
+        "db_url": _redact(db_url),
+        "mode": mode,
+        **{k: r[k] for k in ("die", "bin", "test_item", "rows", "failed")},
+        "parse_seconds": round(r["parse_seconds"], 3),
+        "write_seconds": round(r["write_seconds"], 3),
+        "wall_seconds": round(r["wall_seconds"], 3),
+        "parse_mb_per_sec": round(input_mb / r["parse_seconds"], 2) if r["parse_seconds"] else 0.0,
+        "write_rows_per_sec": round(r["rows"] / r["write_seconds"], 1) if r["write_seconds"] else 0.0,
+        "rows_per_sec": round(r["rows"] / r["wall_seconds"], 1) if r["wall_seconds"] else 0.0,
+        "peak_rss_mb": round(r["peak_rss_mb"], 1),
+        "peak_rss_workers_mb": round(r["peak_rss_workers_mb"], 1),
+        "db_size_mb": round(_db_size_bytes(db_url) / 1e6, 2),
+        "columnar_size_mb": round(_dir_size(columnar_dir) / 1e6, 2),
+    }
+
+
+def compare(report, baseline, max_regression):
+    """List of regressions: throughput metrics below baseline * (1 - max_regression), per backend and mode."""
+    base_runs = {(r["backend"], r["mode"]): r for r in baseline.get("runs", [])}
+    regressions = []
+    for run in report["runs"]:
+        base = base_runs.get((run["backend"], run["mode"]))
+        if not base:
+            continue
+        for key in _THROUGHPUT_KEYS:
+            if base.get(key) and run[key] < base[key] * (1 - max_regression):
+                regressions.append(f"{run['backend']}.{key}: {run[key]} < baseline {base[key]}")
+    parse, base_parse = report.get("parse_only"), baseline.get("parse_only")
+    if parse and base_parse and base_parse.get("mb_per_sec"):
+        if parse["mb_per_sec"] < base_parse["mb_per_sec"] * (1 - max_regression):
+            regressions.append(f"parse_only.mb_per_sec: {parse['mb_per_sec']} < baseline {base_parse['mb_per_sec']}")
+    return regressions
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--lots", type=int, default=2)
+    ap.add_argument("--wafers", type=int, default=2)
+    ap.add_argument("--dies", type=int, default=500, help="dies per wafer")
+    ap.add_argument("--ptr", type=int, default=20, help="PTR per die")
+    ap.add_argument("--ftr", type=int, default=2, help="FTR per die")
+    ap.add_argument("--sites", type=int, default=4)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--mode", choices=("single", "batch"), default="single",
+                    help="single: load_stdf per file; batch: load_stdf_batch (process-pool parsing)")
+    ap.add_argument("--workers", type=int, default=None, help="parse workers for --mode batch")
+    ap.add_argument("--chunk-size", type=int, default=None)
+    ap.add_argument("--pg-url", default=os.getenv("STDF_BENCH_PG_URL"),
+                    help="also benchmark this PostgreSQL(-compatible) URL (env STDF_BENCH_PG_URL)")
+    ap.add_argument("--no-sqlite", action="store_true")
+    ap.add_argument("--workdir", help="keep generated files and DBs here (default: temp dir, removed)")
+    ap.add_argument("--out", help="write the JSON report here (default: stdout)")
+    ap.add_argument("--baseline", help="earlier JSON report to compare against")
+    ap.add_argument("--max-regression", type=float, default=0.2, help="allowed throughput drop vs baseline")
+    a = ap.parse_args()
+
+    workdir = Path(a.workdir) if a.workdir else Path(tempfile.mkdtemp(prefix="stdf_bench_"))
+    workdir.mkdir(parents=True, exist_ok=True)
+    try:
+        t0 = time.perf_counter()
+        files = generate(workdir / "stdf", a.lots, a.wafers, a.dies, a.ptr, a.ftr, a.sites, a.seed)
+        paths = [p for p, _ in files]
+        input_bytes = sum(p.stat().st_size for p in paths)
+        report = {
+            "generated_at": datetime.now().isoformat(timespec="seconds"),
+            "host": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+            "config": {k: getattr(a, k) for k in ("lots", "wafers", "dies", "ptr", "ftr", "sites", "seed", "mode", "workers", "chunk_size")},
+            "input": {
+                "files": len(paths),
+                "mb": round(input_bytes / 1e6, 2),
+                "dies": sum(c["dies"] for _, c in files),
+                "ptr": sum(c["ptr"] for _, c in files),
+                "ftr": sum(c["ftr"] for _, c in files),
+                "generate_seconds": round(time.perf_counter() - t0, 3),
+            },
+        }
+        p = _in_child(_run_parse_only, [str(p) for p in paths])
+        report["parse_only"] = {
+            "records": p["records"],
+            "seconds": round(p["seconds"], 3),
+            "records_per_sec": round(p["records"] / p["seconds"], 1) if p["seconds"] else 0.0,
+            "mb_per_sec": round(input_bytes / 1e6 / p["seconds"], 2) if p["seconds"] else 0.0,
+            "peak_rss_mb": round(p["peak_rss_mb"], 1),
+        }
+        runs, skipped = [], {}
+        if not a.no_sqlite:
+            runs.append(bench_backend(
+                "sqlite", f"sqlite:///{workdir / 'bench.db'}", paths, input_bytes,
+                str(workdir / "columnar_sqlite"), a.mode, a.workers, a.chunk_size,
+            ))
+        if a.pg_url:
+            try:
+                runs.append(bench_backend(
+                    "postgresql", a.pg_url, paths, input_bytes,
+                    str(workdir / "columnar_pg"), a.mode, a.workers, a.chunk_size,
+                ))
+            except Exception as e:   # driver missing / server down: keep the SQLite numbers
+                skipped["postgresql"] = f"{type(e).__name__}: {e}"
+        else:
+            skipped["postgresql"] = "no --pg-url / STDF_BENCH_PG_URL"
+        report["runs"] = runs
+        report["skipped"] = skipped
+        if a.baseline:
+            with open(a.baseline, encoding="utf-8") as f:
+                report["regressions"] = compare(report, json.load(f), a.max_regression)
+    finally:
+        if not a.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(report, indent=2)
+    if a.out:
+        Path(a.out).write_text(text + "\n", encoding="utf-8")
+        for run in report["runs"]:
+            print(
+                f"{run['backend']}: {run['rows']} rows, parse {run['parse_mb_per_sec']} MB/s, "
+                f"write {run['write_rows_per_sec']:.0f} rows/s, {run['rows_per_sec']:.0f} rows/s overall, "
+                f"peak RSS {run['peak_rss_mb']} MB, DB {run['db_size_mb']} MB (+{run['columnar_size_mb']} MB parquet)"
+            )
+        for name, why in report["skipped"].items():
+            print(f"{name}: skipped ({why})")
+        print(f"report: {a.out}")
+    else:
+        print(text)
+    if report.get("regressions"):
+        print("REGRESSION:\n  " + "\n  ".join(report["regressions"]), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+"""
+Dashboard page-render benchmark: runs the page functions of app.py headless (Streamlit bare mode, widgets
+at their defaults) against a seeded DB and reports per page wall time, SQL statement count, SQL time, rows
+fetched, peak Python memory, the most repeated statements (N+1 patterns) and SQL cost per calling function.
+The DB is seeded from synthetic STDF lots (benchmarks/synthetic_stdf.py) unless --db-url points at an
+existing database.
+The query cache is cleared before each cold run; one extra warm run shows what the cache saves.
+Pages over their latency budget (BUDGETS_MS, --budget PAGE=MS) fail the run like a baseline regression.
+
+    python benchmarks/page_bench.py --lots 5 --wafers 3 --dies 500 --ptr 20 --out pages.json
+    python benchmarks/page_bench.py --db-url sqlite:////data/stdf_data.db --pages dashboard_home lot_to_lot
+    python benchmarks/page_bench.py --baseline pages.json --max-regression 0.2
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+from datetime import datetime
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from synthetic_stdf import generate  # noqa: E402
+
+# per-page latency budgets (ms) checked on every run; the overview must stay fast with thousands of lots
+BUDGETS_MS = {"dashboard_home": 300}
+
+PAGES = ("dashboard_home", "lot_to_lot", "wafer_to_wafer", "die_to_die", "composite_map", "fail_pareto", "bin_summary", "equipment_comparison")
+
+
+def seed_db(workdir, a):
+    """Generate synthetic lots and load them into a fresh SQLite DB under workdir; returns its URL."""
+    db_url = f"sqlite:///{workdir / 'pages.db'}"
+    os.environ["STDF_COLUMNAR_DIR"] = str(workdir / "columnar")
+    from stdf_loader import load_stdf
+    files = generate(workdir / "stdf", a.lots, a.wafers, a.dies, a.ptr, a.ftr, a.sites, a.seed)
+    for path, _ in files:
+        load_stdf(str(path), db_url=db_url)
+    return db_url
+
+
+def _db_counts(session):
+    from db_models import Die, Lot, TestItem, Wafer
+    return {m.__tablename__: session.query(m).count() for m in (Lot, Wafer, Die, TestItem)}
+
+
+class _StMessages:
+    """Collects st.error / st.warning / st.exception calls so failing pages show up in the report."""
+    def __init__(self, st):
+        self.messages = []
+        for name in ("error", "warning", "exception"):
+            setattr(st, name, self._recorder(name))
+
+    def _recorder(self, name):
+        def record(body, *args, **kwargs):
+            self.messages.append(f"{name}: {body}"[:300])
+        return record
+
+
+def run_page(app, fn_name, session, profiler, messages, trace_memory=False):
+    """One render of a page; returns wall seconds, profiler snapshot, peak MB (if traced) and st messages."""
+    profiler.reset()
+    n_msgs = len(messages.messages)
+    if trace_memory:
+        tracemalloc.start()
+    t0 = time.perf_counter()
+    try:
+        getattr(app, fn_name)(session)
+    finally:
+        wall = time.perf_counter() - t0
+        peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+        if trace_memory:
+            tracemalloc.stop()
+        session.rollback()
+    snap = profiler.snapshot()
+    snap["wall_seconds"] = wall
+    snap["peak_mb"] = peak / 1e6 if peak is not None else None
+    snap["messages"] = messages.messages[n_msgs:]
+    return snap
+
+
+def bench_pages(db_url, pages, repeat):
+    logging.disable(logging.WARNING)   # Streamlit bare-mode "missing ScriptRunContext" warnings
+    warnings.filterwarnings("ignore")
+    os.chdir(ROOT)
+    import streamlit as st
+    import app
+    from sqlalchemy.orm import sessionmaker
+    from db_models import ensure_db, get_engine
+    from query_cache import clear_cache
+    from sql_profiler import QueryProfiler, row_counting_connect_args
+
+    engine = get_engine(db_url, connect_args=row_counting_connect_args(db_url))
+    ensure_db(engine)
+    profiler = QueryProfiler().attach(engine)
+    session = sessionmaker(bind=engine)()
+    messages = _StMessages(st)
+    app._sidebar_filters(session)   # same session_state filters as a real render
+    results = {"db": _db_counts(session), "pages": []}
+    for name in pages:
+        cold = []
+        for _ in range(repeat):
+            clear_cache()
+            session.expunge_all()
+            cold.append(run_page(app, name, session, profiler, messages))
+        best = min(cold, key=lambda r: r["wall_seconds"])
+        warm = run_page(app, name, session, profiler, messages)
+        clear_cache()
+        session.expunge_all()
+        mem = run_page(app, name, session, profiler, messages, trace_memory=True)
+        results["pages"].append({
+            "page": name,
+            "wall_ms": round(best["wall_seconds"] * 1000, 1),
+            "sql_ms": round(best["sql_seconds"] * 1000, 1),
+            "statements": best["statements"],
+            "rows": best["rows"],
+            "peak_mb": round(mem["peak_mb"], 2),
+            "warm_wall_ms": round(warm["wall_seconds"] * 1000, 1),
+            "warm_statements": warm["statements"],
+            "most_repeated": best["most_repeated"],
+            "callers": [
+                {"caller": c["caller"], "statements": c["statements"], "sql_ms": round(c["sql_seconds"] * 1000, 1), "rows": c["rows"]}
+                for c in best["callers"][:5]
+            ],
+            "messages": best["messages"],
+        })
+    session.close()
+    engine.dispose()
+    return results
+
+
+def compare(report, baseline, max_regression):
+    """Pages whose wall time or statement count grew by more than max_regression vs the baseline."""
+    base_pages = {p["page"]: p for p in baseline.get("pages", [])}
+    regressions = []
+    for page in report["pages"]:
+        base = base_pages.get(page["page"])
+        if not base:
+            continue
+        for key in ("wall_ms", "statements"):
+            if base.get(key) and page[key] > base[key] * (1 + max_regression):
+                regressions.append(f"{page['page']}.{key}: {page[key]} > baseline {base[key]}")
+    return regressions
+
+
+def over_budget(report, budgets):
+    return [
+        f"{p['page']}.wall_ms: {p['wall_ms']} > budget {budgets[p['page']]}"
+        for p in report["pages"] if p["page"] in budgets and p["wall_ms"] > budgets[p["page"]]
+    ]
+
+
+def _budget(text):
+    page, ms = text.split("=", 1)
+    return page, float(ms)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--db-url", help="benchmark this existing DB instead of seeding one")
+    ap.add_argument("--lots", type=int, default=3)
+    ap.add_argument("--wafers", type=int, default=3)
+    ap.add_argument("--dies", type=int, default=300, help="dies per wafer")
+    ap.add_argument("--ptr", type=int, default=20, help="PTR per die")
+    ap.add_argument("--ftr", type=int, default=2, help="FTR per die")
+    ap.add_argument("--sites", type=int, default=4)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--pages", nargs="+", default=list(PAGES), help=f"page functions (default: {' '.join(PAGES)})")
+    ap.add_argument("--repeat", type=int, default=3, help="cold renders per page (best is reported)")
+    ap.add_argument("--workdir", help="keep generated files and DB here (default: temp dir, removed)")
+    ap.add_argument("--out", help="write the JSON report here (default: stdout)")
+    ap.add_argument("--baseline", help="earlier JSON report to compare against")
+    ap.add_argument("--max-regression", type=float, default=0.2, help="allowed wall time / statement growth vs baseline")
+    ap.add_argument("--budget", type=_budget, action="append", default=[], metavar="PAGE=MS",
+                    help=f"latency budget for a page (default: {', '.join(f'{k}={v}' for k, v in BUDGETS_MS.items())})")
+    a = ap.parse_args()
+
+    workdir = None
+    if not a.db_url:
+        workdir = Path(a.workdir) if a.workdir else Path(tempfile.mkdtemp(prefix="stdf_pages_"))
+        workdir.mkdir(parents=True, exist_ok=True)
+    try:
+        t0 = time.perf_counter()
+        db_url = a.db_url or seed_db(workdir, a)
+        report = {
+            "generated_at": datetime.now().isoformat(timespec="seconds"),
+            "host": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+            "config": {k: getattr(a, k) for k in ("lots", "wafers", "dies", "ptr", "ftr", "sites", "seed", "repeat")}
+            if not a.db_url else {"db_url": "external", "repeat": a.repeat},
+            "seed_seconds": round(time.perf_counter() - t0, 3),
+        }
+        report.update(bench_pages(db_url, a.pages, a.repeat))
+        report["budgets_ms"] = {**BUDGETS_MS, **dict(a.budget)}
+        report["regressions"] = over_budget(report, report["budgets_ms"])
+        if a.baseline:
+            with open(a.baseline, encoding="utf-8") as f:
+                report["regressions"] += compare(report, json.load(f), a.max_regression)
+    finally:
+        if workdir is not None and not a.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if a.out:
+        Path(a.out).write_text(text + "\n", encoding="utf-8")
+        print(f"DB: {report['db']}")
+        for p in report["pages"]:
+            rows = "-" if p["rows"] is None else p["rows"]
+            print(
+                f"{p['page']:22s} {p['wall_ms']:9.1f} ms  {p['statements']:5d} stmts  {p['sql_ms']:8.1f} ms SQL  "
+                f"{rows:>8} rows  peak {p['peak_mb']:7.2f} MB  warm {p['warm_wall_ms']:.1f} ms / {p['warm_statements']} stmts"
+            )
+            for m in p["messages"]:
+                print(f"  ! {m}")
+        print(f"report: {a.out}")
+    else:
+        print(text)
+    if report.get("regressions"):
+        print("REGRESSION:\n  " + "\n  ".join(report["regressions"]), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""
+Parser benchmark: decode an STDF file the way the loader does, with pystdf (every record decoded, field
+dicts for the handled types) and with the streaming stdf_reader (handled types only, PTR/FTR fast path).
+No database is involved.
+
+    python benchmarks/parse_bench.py [file.stdf ...] [--repeat 5]
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from stdf_loader import _RecordForwarder, parse_stdf  # noqa: E402
+
+DEFAULT_FILE = ROOT / "data" / "ROOS_20140728_131230.stdf"
+
+
+def time_parse(path, parser, repeat):
+    """Best-of-repeat seconds and number of records handed to the sink."""
+    best, count = None, 0
+    for _ in range(repeat):
+        sink = _RecordForwarder(lambda batch: None)
+        t0 = time.perf_counter()
+        with open(path, "rb") as f:
+            parse_stdf(f, sink, parser)
+        sink.flush()
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+        count = sink.count
+    return best, count
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("files", nargs="*", default=[str(DEFAULT_FILE)])
+    ap.add_argument("--repeat", type=int, default=5)
+    a = ap.parse_args()
+    for path in a.files:
+        size_mb = Path(path).stat().st_size / 1e6
+        print(f"{path} ({size_mb:.2f} MB)")
+        results = {}
+        for parser in ("pystdf", "fast"):
+            seconds, count = time_parse(path, parser, a.repeat)
+            results[parser] = seconds
+            print(f"  {parser:7s} {seconds * 1000:8.1f} ms  {count} records  {count / seconds:10.0f} rec/s  {size_mb / seconds:6.1f} MB/s")
+        print(f"  speedup {results['pystdf'] / results['fast']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
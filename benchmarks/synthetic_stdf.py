@@ -0,0 +1,177 @@
+"""
+Synthetic STDF v4 generator for benchmarks: one file per lot with configurable wafers, dies per wafer,
+PTR/FTR per die and site count. Output is deterministic for a given seed and loads through stdf_loader.
+
+    python benchmarks/synthetic_stdf.py out_dir --lots 2 --wafers 5 --dies 2000 --ptr 50 --ftr 5 --sites 4
+"""
+import argparse
+import math
+import random
+import struct
+from pathlib import Path
+
+_START_T = 1700000000
+
+
+def _cn(s):
+    b = s.encode("ascii")[:255]
+    return struct.pack("<B", len(b)) + b
+
+
+class StdfWriter:
+    """Minimal little-endian STDF v4 record writer (only the records the loader reads)."""
+    def __init__(self, f):
+        self.f = f
+
+    def record(self, typ, sub, payload):
+        self.f.write(struct.pack("<HBB", len(payload), typ, sub) + payload)
+
+    def far(self):
+        self.record(0, 10, struct.pack("<BB", 2, 4))
+
+    def mir(self, lot_id, part_typ, job_nam, job_rev, mode_cod="P", node_nam="NODE1", tstr_typ="SYNTH",
+            facil_id="FAB1", floor_id="F1", exec_typ="SIM", exec_ver="1.0"):
+        payload = struct.pack("<IIBccchc", _START_T, _START_T, 1, mode_cod.encode()[:1], b" ", b" ", 0, b" ")
+        payload += b"".join(_cn(v) for v in (lot_id, part_typ, node_nam, tstr_typ, job_nam, job_rev, "", "", exec_typ, exec_ver))
+        # TEST_COD .. FLOOR_ID: TEST_COD, TST_TEMP, USER_TXT, AUX_FILE, PKG_TYP, FAMLY_ID, DATE_COD, FACIL_ID, FLOOR_ID
+        payload += b"".join(_cn(v) for v in ("", "", "", "", "", "", "", facil_id, floor_id))
+        self.record(1, 10, payload)
+
+    def sdr(self, head, site_grp, sites, card_id="PC-01", load_id="LB-01", hand_id="HD-01"):
+        payload = struct.pack("<BBB", head, site_grp, len(sites)) + bytes(sites)
+        payload += b"".join(_cn(v) for v in ("HANDLER", hand_id, "CARD", card_id, "LOADBOARD", load_id))
+        self.record(1, 80, payload)
+
+    def wir(self, head, wafer_id, start_t=_START_T):
+        self.record(2, 10, struct.pack("<BBI", head, 255, start_t) + _cn(wafer_id))
+
+    def wrr(self, head, wafer_id, part_cnt, good_cnt, finish_t=_START_T + 3600):
+        payload = struct.pack("<BBIIIIII", head, 255, finish_t, part_cnt, 0, 0, good_cnt, 0) + _cn(wafer_id)
+        self.record(2, 20, payload)
+
+    def pir(self, head, site):
+        self.record(5, 10, struct.pack("<BB", head, site))
+
+    def ptr(self, test_num, head, site, result, fail, test_txt="", lo=None, hi=None, units=""):
+        payload = struct.pack("<IBBBBf", test_num, head, site, 0x80 if fail else 0, 0, result) + _cn(test_txt) + _cn("")
+        if lo is not None:
+            payload += struct.pack("<Bbbbff", 0x0E, 0, 0, 0, lo, hi) + _cn(units)
+        self.record(15, 10, payload)
+
+    def ftr(self, test_num, head, site, fail, test_txt=""):
+        payload = struct.pack("<IBBBBIIIIiihHH", test_num, head, site, 0x80 if fail else 0, 0xFF, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+        payload += struct.pack("<H", 0) + _cn("") + _cn("") + _cn("") + _cn(test_txt)
+        self.record(15, 20, payload)
+
+    def prr(self, head, site, num_test, hard_bin, soft_bin, x, y, test_t, part_id, fail):
+        payload = struct.pack("<BBBHHHhhI", head, site, 0x08 if fail else 0, num_test, hard_bin, soft_bin, x, y, test_t)
+        self.record(5, 20, payload + _cn(part_id))
+
+    def hbr(self, bin_num, count, passed, name, head=255, site=255):
+        self.record(1, 40, struct.pack("<BBHIc", head, site, bin_num, count, b"P" if passed else b"F") + _cn(name))
+
+    def sbr(self, bin_num, count, passed, name, head=255, site=255):
+        self.record(1, 50, struct.pack("<BBHIc", head, site, bin_num, count, b"P" if passed else b"F") + _cn(name))
+
+    def tsr(self, test_num, test_typ, exec_cnt, fail_cnt, test_nam, seq_name, head=255, site=255):
+        payload = struct.pack("<BBcIIII", head, site, test_typ.encode(), test_num, exec_cnt, fail_cnt, 0)
+        self.record(10, 30, payload + _cn(test_nam) + _cn(seq_name) + _cn(""))
+
+    def mrr(self, finish_t=_START_T + 7200):
+        self.record(1, 20, struct.pack("<Ic", finish_t, b" ") + _cn("") + _cn(""))
+
+
+def wafer_coords(n_dies):
+    """Die (x, y) grid inside a circle holding at least n_dies dies."""
+    r = math.sqrt(n_dies / math.pi) + 1
+    while True:
+        ri = int(math.ceil(r))
+        coords = [(x, y) for y in range(-ri, ri + 1) for x in range(-ri, ri + 1) if x * x + y * y <= r * r]
+        if len(coords) >= n_dies:
+            return coords[:n_dies], r
+        r += 0.5
+
+
+def write_lot(path, lot_id, wafers=2, dies_per_wafer=500, ptr_per_die=20, ftr_per_die=2, sites=4, seed=0,
+              part_typ="SYNTH_PART", job_nam="SYNTH_PROG", job_rev="A"):
+    """Write one lot as an STDF file; returns record counts."""
+    rng = random.Random(f"{seed}:{lot_id}")
+    coords, radius = wafer_coords(dies_per_wafer)
+    ptr_tests = [(1000 + i, f"PTR_TEST_{i}", rng.uniform(-1, 1), rng.uniform(0.05, 0.2)) for i in range(ptr_per_die)]
+    ftr_tests = [(5000 + i, f"FTR_TEST_{i}") for i in range(ftr_per_die)]
+    lot_shift = rng.gauss(0, 0.05)
+    counts = {"dies": 0, "ptr": 0, "ftr": 0}
+    hbin_cnt, tsr_exec, tsr_fail = {}, {}, {}
+    with open(path, "wb") as f:
+        w = StdfWriter(f)
+        w.far()
+        w.mir(lot_id, part_typ, job_nam, job_rev)
+        w.sdr(1, 255, list(range(1, sites + 1)))
+        for wi in range(wafers):
+            wafer_id = f"{wi + 1:02d}"
+            w.wir(1, wafer_id)
+            good = 0
+            for di, (x, y) in enumerate(coords):
+                site = di % sites + 1
+                edge = math.sqrt(x * x + y * y) / radius
+                w.pir(1, site)
+                die_fail = False
+                for tn, name, mean, sigma in ptr_tests:
+                    val = rng.gauss(mean + lot_shift + 0.3 * sigma * edge * edge, sigma)
+                    lo, hi = mean - 4 * sigma, mean + 4 * sigma
+                    fail = not (lo <= val <= hi)
+                    die_fail |= fail
+                    w.ptr(tn, 1, site, val, fail, name, lo, hi, "V")
+                    tsr_exec[tn] = tsr_exec.get(tn, 0) + 1
+                    tsr_fail[tn] = tsr_fail.get(tn, 0) + fail
+                for tn, name in ftr_tests:
+                    fail = rng.random() < 0.01 + 0.05 * edge ** 4
+                    die_fail |= fail
+                    w.ftr(tn, 1, site, fail, name)
+                    tsr_exec[tn] = tsr_exec.get(tn, 0) + 1
+                    tsr_fail[tn] = tsr_fail.get(tn, 0) + fail
+                hard_bin = 1 if not die_fail else rng.choice((2, 3, 3, 4))
+                hbin_cnt[hard_bin] = hbin_cnt.get(hard_bin, 0) + 1
+                good += not die_fail
+                w.prr(1, site, len(ptr_tests) + len(ftr_tests), hard_bin, hard_bin, x, y,
+                      rng.randint(80, 120), f"{wafer_id}-{di}", die_fail)
+                counts["dies"] += 1
+                counts["ptr"] += len(ptr_tests)
+                counts["ftr"] += len(ftr_tests)
+            w.wrr(1, wafer_id, len(coords), good)
+        for b, c in sorted(hbin_cnt.items()):
+            w.hbr(b, c, b == 1, "PASS" if b == 1 else f"FAIL_{b}")
+            w.sbr(b, c, b == 1, "PASS" if b == 1 else f"FAIL_{b}")
+        for tn, name, _, _ in ptr_tests:
+            w.tsr(tn, "P", tsr_exec[tn], tsr_fail[tn], name, "PARAM")
+        for tn, name in ftr_tests:
+            w.tsr(tn, "F", tsr_exec[tn], tsr_fail[tn], name, "FUNC")
+        w.mrr()
+    return counts
+
+
+def generate(out_dir, lots=1, wafers=2, dies_per_wafer=500, ptr_per_die=20, ftr_per_die=2, sites=4, seed=0):
+    """Write `lots` files SYN<seed>_LOTnnn.stdf into out_dir; returns list of (path, counts)."""
+    out = Path(out_dir)
+    out.mkdir(parents=True, exist_ok=True)
+    files = []
+    for li in range(lots):
+        lot_id = f"SYN{seed}_LOT{li + 1:03d}"
+        path = out / f"{lot_id}.stdf"
+        files.append((path, write_lot(path, lot_id, wafers, dies_per_wafer, ptr_per_die, ftr_per_die, sites, seed)))
+    return files
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("out_dir")
+    ap.add_argument("--lots", type=int, default=1)
+    ap.add_argument("--wafers", type=int, default=2)
+    ap.add_argument("--dies", type=int, default=500, help="dies per wafer")
+    ap.add_argument("--ptr", type=int, default=20, help="PTR per die")
+    ap.add_argument("--ftr", type=int, default=2, help="FTR per die")
+    ap.add_argument("--sites", type=int, default=4)
+    ap.add_argument("--seed", type=int, default=0)
+    a = ap.parse_args()
+    for path, counts in generate(a.out_dir, a.lots, a.wafers, a.dies, a.ptr, a.ftr, a.sites, a.seed):
+        print(path, counts)
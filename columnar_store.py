@@ -0,0 +1,336 @@
+"""
+Columnar side-store for PTR parametric results: Parquet files partitioned lot=<lot.id>/wafer=<wafer.id>
+(wafer=0 for package test), columns die_id, x, y, test_num, result, pass_fail.
+Written by the loader next to the DB and read by the dashboard instead of ORM joins on test_item.
+Each load writes one file per (lot, wafer), named part-<loaded_file.id>-<uuid>.parquet: a wafer is read from
+the store only when every load that wrote dies to it has its file there, other wafers fall back to SQL.
+pyarrow is optional: without it the store is disabled and reads fall back to SQL.
+"""
+import os
+import uuid
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import and_, or_, select
+from sqlalchemy.orm import Session
+
+from config import DATABASE_URL, STATS_CHUNK_ROWS
+from db_models import Die, TestItem, TestKey, Wafer
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:  # optional dependency
+    pa = None
+
+PARAMETRIC_COLUMNS = ["lot_pk", "wafer_pk", "die_id", "x", "y", "result", "pass_fail"]
+_PENDING_PREFIX = "_pending-"   # ignored by readers until published
+_MERGE_ROWS = 1 << 20   # rows per row group when publish() merges a load's parts
+
+
+def _part_name(prefix, load_id):
+    return f"{prefix}{load_id}-{uuid.uuid4().hex}.parquet" if load_id is not None else f"{prefix}{uuid.uuid4().hex}.parquet"
+
+
+def _load_id(path):
+    """loaded_file.id in a part file name; None for files of older stores (part-<uuid>.parquet)."""
+    name = path.name
+    stem = name[len(_PENDING_PREFIX) if name.startswith(_PENDING_PREFIX) else len("part-"):-len(".parquet")]
+    load_id, sep, _ = stem.partition("-")
+    return int(load_id) if sep else None
+
+
+def columnar_store_dir(db_url: str = None):
+    """
+    Store root for a DB: STDF_COLUMNAR_DIR if set ("" disables the store), else <db file>_columnar
+    next to a SQLite DB, else ./stdf_columnar. Returns None when disabled or pyarrow is missing.
+    """
+    if pa is None:
+        return None
+    env = os.getenv("STDF_COLUMNAR_DIR")
+    if env is not None:
+        return Path(env) if env.strip() else None
+    url = db_url or DATABASE_URL
+    if url.startswith("sqlite:///") and ":memory:" not in url:
+        db_path = Path(url[len("sqlite:///"):])
+        return db_path.with_name(db_path.stem + "_columnar")
+    if url.startswith("sqlite"):
+        return None
+    return Path("stdf_columnar")
+
+
+class ColumnarStoreWriter:
+    """
+    Receives the loader's flushed Die/TestItem column batches and writes the PTR rows per (lot, wafer), one
+    part per flush under a pending name. publish() (after the DB commit) merges each (lot, wafer)'s parts into
+    one file named after the load (Die.load_file_id); rows of a load without a registry entry are not stored.
+    """
+    def __init__(self, root):
+        self.root = Path(root)
+        self._pending = []
+        self._obsolete = []   # published files replaced by pending rewrites, removed in publish()
+
+    @classmethod
+    def for_db(cls, db_url: str = None):
+        root = columnar_store_dir(db_url)
+        return cls(root) if root is not None else None
+
+    def write(self, die_cols, item_cols):
+        """die_cols / item_cols: column name -> list, as buffered by StdfToDbSink (every die of one load)."""
+        load_id = die_cols["load_file_id"][0] if die_cols["load_file_id"] else None
+        if load_id is None:
+            return
+        items = pa.table({
+            "die_id": pa.array(item_cols["die_id"], pa.int64()),
+            "test_type": pa.array(item_cols["test_type"], pa.string()),
+            "test_num": pa.array(item_cols["test_num"], pa.int64()),
+            "result": pa.array(item_cols["result"], pa.float64()),
+            "pass_fail": pa.array(item_cols["pass_fail"], pa.int8()),
+        })
+        items = items.filter(pc.equal(items["test_type"], "PTR")).drop_columns(["test_type"])
+        if items.num_rows == 0:
+            return
+        dies = pa.table({
+            "die_id": pa.array(die_cols["id"], pa.int64()),
+            "lot_pk": pa.array(die_cols["lot_id"], pa.int64()),
+            "wafer_pk": pc.fill_null(pa.array(die_cols["wafer_id"], pa.int64()), 0),
+            "x": pa.array(die_cols["x_coord"], pa.int32()),
+            "y": pa.array(die_cols["y_coord"], pa.int32()),
+        })
+        joined = items.join(dies, keys="die_id")
+        groups = joined.group_by(["lot_pk", "wafer_pk"]).aggregate([]).to_pylist()
+        for g in groups:
+            part = joined.filter(
+                pc.and_(pc.equal(joined["lot_pk"], g["lot_pk"]), pc.equal(joined["wafer_pk"], g["wafer_pk"]))
+            ).select(["die_id", "x", "y", "test_num", "result", "pass_fail"])
+            part_dir = self.root / f"lot={g['lot_pk']}" / f"wafer={g['wafer_pk']}"
+            part_dir.mkdir(parents=True, exist_ok=True)
+            path = part_dir / _part_name(_PENDING_PREFIX, load_id)
+            pq.write_table(part, path, compression="zstd")
+            self._pending.append(path)
+
+    def remove_dies(self, lot_pk, wafer_pk, die_ids):
+        """
+        Drop the rows of die_ids from the published files of one (lot, wafer), e.g. before a changed STDF file
+        is re-loaded: affected files are rewritten under a pending name, the originals go in publish().
+        """
+        part_dir = self.root / f"lot={lot_pk}" / f"wafer={wafer_pk or 0}"
+        value_set = pa.array(die_ids, pa.int64())
+        for path in sorted(part_dir.glob("part-*.parquet")):
+            table = pq.ParquetFile(path).read()   # not read_table: no hive columns from the path
+            keep = pc.invert(pc.is_in(table["die_id"], value_set=value_set))
+            if pc.all(keep).as_py():
+                continue
+            kept = table.filter(keep)
+            if kept.num_rows:
+                pending = part_dir / _part_name(_PENDING_PREFIX, _load_id(path))
+                pq.write_table(kept, pending, compression="zstd")
+                self._pending.append(pending)
+            self._obsolete.append(path)
+
+    def publish(self):
+        """
+        Make pending files visible to readers (call after the DB commit): the parts of one load in one
+        (lot, wafer) directory become a single file, so a lot does not collect one small file per flush.
+        """
+        groups = {}
+        for path in self._pending:
+            groups.setdefault((path.parent, _load_id(path)), []).append(path)
+        for (part_dir, load_id), parts in groups.items():
+            final = part_dir / _part_name("part-", load_id)
+            if len(parts) > 1:
+                merged = part_dir / _part_name(_PENDING_PREFIX, load_id)
+                _merge_parts(parts, merged)
+                merged.rename(final)
+                for path in parts:
+                    path.unlink()
+            else:
+                parts[0].rename(final)
+        for path in self._obsolete:
+            path.unlink(missing_ok=True)
+        self._pending = []
+        self._obsolete = []
+
+    def discard(self):
+        """Remove files written since the last publish (load failed or rolled back)."""
+        for path in self._pending:
+            path.unlink(missing_ok=True)
+        self._pending = []
+        self._obsolete = []
+
+
+def _merge_parts(parts, path):
+    """Concatenate Parquet parts of the same schema into path, in row groups of about _MERGE_ROWS rows."""
+    tables, rows = [], 0
+    with pq.ParquetWriter(path, pq.read_schema(parts[0]), compression="zstd") as writer:
+        for part in parts:
+            table = pq.ParquetFile(part).read()
+            tables.append(table)
+            rows += table.num_rows
+            if rows >= _MERGE_ROWS:
+                writer.write_table(pa.concat_tables(tables))
+                tables, rows = [], 0
+        if tables:
+            writer.write_table(pa.concat_tables(tables))
+
+
+def _not_covered(rest):
+    """SQL condition on Die for the (lot, wafer) pairs of ParametricStore.coverage() that are not in the store."""
+    wafer_pks = [w for wafers in rest.values() for w in wafers if w is not None]
+    package_lots = [lot_pk for lot_pk, wafers in rest.items() if None in wafers]
+    return or_(Die.wafer_id.in_(wafer_pks), and_(Die.wafer_id == None, Die.lot_id.in_(package_lots)))
+
+
+def _in_wafers(wafer_pks):
+    """SQL condition on Die for a wafer_pks filter; None in it stands for package dies (wafer_id IS NULL)."""
+    cond = Die.wafer_id.in_([w for w in wafer_pks if w is not None])
+    return or_(cond, Die.wafer_id == None) if None in wafer_pks else cond
+
+
+class ParametricStore:
+    """Read side of the columnar store."""
+    def __init__(self, root):
+        self.root = Path(root)
+
+    @classmethod
+    def for_db(cls, db_url: str = None):
+        root = columnar_store_dir(db_url)
+        return cls(root) if root is not None and root.is_dir() else None
+
+    def _load_files(self, lot_pk, wafer_pk):
+        """load id -> published files of one (lot, wafer); files of older stores (no load id) are left out."""
+        files = {}
+        for path in sorted((self.root / f"lot={lot_pk}" / f"wafer={wafer_pk or 0}").glob("part-*.parquet")):
+            load_id = _load_id(path)
+            if load_id is not None:
+                files.setdefault(load_id, []).append(path)
+        return files
+
+    def coverage(self, session: Session, lot_pks, wafer_pks=None):
+        """
+        Split the (lot, wafer) pairs holding dies of the given lots (optionally only the given wafers, None for
+        package dies) into store files to scan and pairs to read from test_item. A wafer is served from the
+        store only when every load of its dies (Die.load_file_id) has a file there; files of other loads (e.g.
+        a replaced one) are not read. Returns (files, {lot_pk: [wafer_pk or None, ...] not in the store}).
+        """
+        # die has no lot index: wafer dies are reached through wafer.lot_id, package dies through wafer_id IS NULL
+        q = session.query(Wafer.lot_id, Wafer.id, Die.load_file_id).join(Die, Die.wafer_id == Wafer.id).filter(
+            Wafer.lot_id.in_(lot_pks)
+        )
+        if wafer_pks is not None:
+            q = q.filter(Wafer.id.in_([w for w in wafer_pks if w is not None]))
+        rows = q.distinct().all()
+        if wafer_pks is None or None in wafer_pks:
+            rows += session.query(Die.lot_id, Die.wafer_id, Die.load_file_id).filter(
+                Die.wafer_id == None, Die.lot_id.in_(lot_pks)
+            ).distinct().all()
+        loads = {}
+        for lot_pk, wafer_pk, load_id in rows:
+            loads.setdefault((lot_pk, wafer_pk), set()).add(load_id)
+        files, rest = [], {}
+        for (lot_pk, wafer_pk), load_ids in sorted(loads.items(), key=lambda kv: (kv[0][0], kv[0][1] or 0)):
+            stored = self._load_files(lot_pk, wafer_pk)
+            if load_ids <= stored.keys():
+                files += [f for load_id in sorted(load_ids) for f in stored[load_id]]
+            else:
+                rest.setdefault(lot_pk, []).append(wafer_pk)
+        return files, rest
+
+    def _dataset(self, files):
+        return ds.dataset(
+            [str(f) for f in files], format="parquet",
+            partitioning=ds.partitioning(
+                pa.schema([("lot", pa.int64()), ("wafer", pa.int64())]), flavor="hive"
+            ),
+            partition_base_dir=str(self.root),
+        )
+
+    def read(self, test_num, files):
+        """Column scan of one PTR test over store files (as returned by coverage())."""
+        if not files:
+            return pd.DataFrame(columns=PARAMETRIC_COLUMNS)
+        table = self._dataset(files).to_table(
+            columns=["lot", "wafer", "die_id", "x", "y", "result", "pass_fail"],
+            filter=(ds.field("test_num") == int(test_num)) & ds.field("result").is_valid(),
+        )
+        df = table.to_pandas()
+        df.columns = PARAMETRIC_COLUMNS
+        df["wafer_pk"] = df["wafer_pk"].where(df["wafer_pk"] != 0, None)
+        return df
+
+    def iter_results(self, test_num, files, batch_rows):
+        """(lot_pk array, result array) record batches of one PTR test over store files."""
+        if not files:
+            return
+        batches = self._dataset(files).to_batches(
+            columns=["lot", "result"], batch_size=batch_rows,
+            filter=(ds.field("test_num") == int(test_num)) & ds.field("result").is_valid(),
+        )
+        for batch in batches:
+            if batch.num_rows:
+                yield batch.column(0).to_numpy(), batch.column(1).to_numpy(zero_copy_only=False)
+
+
+def fetch_parametric(session: Session, test_num, lot_pks=None, wafer_pks=None):
+    """
+    Results of one PTR test as a DataFrame (lot_pk, wafer_pk, die_id, x, y, result, pass_fail).
+    Filter by lot primary keys and/or wafer primary keys. Wafers the columnar store covers are read
+    from it, the others from test_item.
+    """
+    lot_pks = list(lot_pks) if lot_pks is not None else None
+    wafer_pks = list(wafer_pks) if wafer_pks is not None else None
+    if wafer_pks is not None and lot_pks is None:
+        lot_pks = [r[0] for r in session.query(Die.lot_id).filter(Die.wafer_id.in_(wafer_pks)).distinct()]
+    store = ParametricStore.for_db(str(session.get_bind().url)) if lot_pks else None
+    frames = []
+    q = session.query(
+        Die.lot_id, Die.wafer_id, Die.id, Die.x_coord, Die.y_coord, TestItem.result, TestItem.pass_fail
+    ).join(TestItem, TestItem.die_id == Die.id).join(TestKey, TestKey.id == TestItem.test_key_id).filter(
+        TestKey.test_num == test_num, TestKey.test_type == "PTR", TestItem.result != None
+    )
+    if store is not None:
+        files, rest = store.coverage(session, lot_pks, wafer_pks)
+        frames.append(store.read(test_num, files))
+        if not rest:
+            return frames[0]
+        q = q.filter(_not_covered(rest))
+    if lot_pks is not None:
+        q = q.filter(Die.lot_id.in_(lot_pks))
+    if wafer_pks is not None:
+        q = q.filter(Die.wafer_id.in_(wafer_pks))
+    frames.append(pd.DataFrame(q.all(), columns=PARAMETRIC_COLUMNS))
+    frames = [f for f in frames if len(f)]
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=PARAMETRIC_COLUMNS)
+
+
+def iter_parametric_results(session: Session, test_num, lot_pks, chunk_rows: int = STATS_CHUNK_ROWS, wafer_pks=None):
+    """
+    Streaming form of fetch_parametric for aggregates: (lot_pk array, result array) chunks of one PTR test
+    over the lots (only the given wafers if wafer_pks, None standing for package dies), at most chunk_rows rows
+    each. Parquet record batches for the wafers the columnar store covers, a test_item query fetched with
+    yield_per (a server-side cursor on PostgreSQL) for the others.
+    """
+    lot_pks = list(lot_pks)
+    wafer_pks = list(wafer_pks) if wafer_pks is not None else None
+    if not lot_pks or wafer_pks == []:
+        return
+    stmt = select(Die.lot_id, TestItem.result).join(TestItem, TestItem.die_id == Die.id).join(
+        TestKey, TestKey.id == TestItem.test_key_id
+    ).where(
+        TestKey.test_num == test_num, TestKey.test_type == "PTR", TestItem.result != None, Die.lot_id.in_(lot_pks)
+    ).execution_options(yield_per=chunk_rows)
+    if wafer_pks is not None:
+        stmt = stmt.where(_in_wafers(wafer_pks))
+    store = ParametricStore.for_db(str(session.get_bind().url))
+    if store is not None:
+        files, rest = store.coverage(session, lot_pks, wafer_pks)
+        yield from store.iter_results(test_num, files, chunk_rows)
+        if not rest:
+            return
+        stmt = stmt.where(_not_covered(rest))
+    for rows in session.execute(stmt).partitions():
+        arr = np.array(rows, dtype=np.float64).reshape(-1, 2)
+        yield arr[:, 0].astype(np.int64), arr[:, 1]
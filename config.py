@@ -8,3 +8,68 @@ DATABASE_URL = os.getenv("STDF_DB_URL", "sqlite:///stdf_data.db")
 DEFAULT_COMPANY = os.getenv("STDF_DEFAULT_COMPANY", "DefaultCompany")
 DEFAULT_PRODUCT = os.getenv("STDF_DEFAULT_PRODUCT", "")
 DEFAULT_STAGE = os.getenv("STDF_DEFAULT_STAGE", "")
+
+# Bulk loader: rows buffered per table before a Core executemany, and the throughput target reported by load_stdf
+LOAD_CHUNK_SIZE = int(os.getenv("STDF_LOAD_CHUNK_SIZE", "20000"))
+LOAD_TARGET_ROWS_PER_SEC = float(os.getenv("STDF_LOAD_TARGET_ROWS_PER_SEC", "50000"))
+
+# PostgreSQL loader: Die/Bin/TestItem via COPY FROM STDIN, "binary" or "csv"; "off" keeps INSERT executemany
+PG_COPY_FORMAT = os.getenv("STDF_PG_COPY", "binary").lower()
+
+# Batch loader (stdf_loader.py --batch): number of pystdf parse processes
+LOAD_WORKERS = int(os.getenv("STDF_LOAD_WORKERS", str(os.cpu_count() or 2)))
+
+# STDF parser used by the loader: "fast" (stdf_reader: needed record types only) or "pystdf"
+STDF_PARSER = os.getenv("STDF_PARSER", "fast")
+
+# Wide per-wafer result matrices (wafer_matrix.py): written by the loader only when STDF_WAFER_MATRIX=1;
+# stored under STDF_WAFER_MATRIX_DIR (default <db file>_matrix next to a SQLite DB)
+WAFER_MATRIX = os.getenv("STDF_WAFER_MATRIX", "").lower() in ("1", "true", "yes", "on")
+
+# Wafer maps (wafer_map.py): grids wider than this many cells per side are block-reduced before drawing
+WAFER_MAP_MAX_CELLS = int(os.getenv("STDF_WAFER_MAP_MAX_CELLS", "400"))
+
+# Wafer-to-wafer diff: numeric tolerance when comparing PTR values / means across wafers
+WAFER_DIFF_TOLERANCE = float(os.getenv("STDF_WAFER_DIFF_TOLERANCE", "1e-9"))
+
+# Dashboard query cache (query_cache.py): max entries and approximate memory cap
+QUERY_CACHE_MAX_ENTRIES = int(os.getenv("STDF_QUERY_CACHE_ENTRIES", "256"))
+QUERY_CACHE_MAX_MB = float(os.getenv("STDF_QUERY_CACHE_MB", "256"))
+
+# SQL instrumentation (sql_profiler.py): off unless STDF_SQL_PROFILE=1; statements slower than
+# STDF_SLOW_QUERY_MS are appended to STDF_SLOW_QUERY_LOG (JSONL)
+SQL_PROFILE = os.getenv("STDF_SQL_PROFILE", "").lower() in ("1", "true", "yes", "on")
+SLOW_QUERY_MS = float(os.getenv("STDF_SLOW_QUERY_MS", "200"))
+SLOW_QUERY_LOG = os.getenv("STDF_SLOW_QUERY_LOG", "slow_queries.jsonl")
+
+# SQLite connection settings applied by db_models.get_engine (WAL lets the dashboard read while a loader writes).
+# STDF_SQLITE_JOURNAL_MODE / STDF_SQLITE_SYNCHRONOUS = "" keep SQLite's defaults (DELETE / FULL).
+SQLITE_JOURNAL_MODE = os.getenv("STDF_SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("STDF_SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_PAGE_SIZE = int(os.getenv("STDF_SQLITE_PAGE_SIZE", "8192"))   # new DB files only
+SQLITE_CACHE_SIZE_KB = int(os.getenv("STDF_SQLITE_CACHE_SIZE_KB", "65536"))
+SQLITE_MMAP_SIZE_MB = float(os.getenv("STDF_SQLITE_MMAP_SIZE_MB", "256"))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("STDF_SQLITE_BUSY_TIMEOUT_MS", "30000"))
+
+# Dashboard read-only connection pool (db_models.get_shared_engine(read_only=True)), separate from the writer
+DB_READ_POOL_SIZE = int(os.getenv("STDF_DB_READ_POOL_SIZE", "4"))
+
+# LLM gateway (llm_gateway.py): request timeouts and retries (connection errors, 429/502/503/504), and the
+# persisted question -> tool call cache (SQLite file; "" disables) with its TTL and entry limit
+LLM_TIMEOUT_S = float(os.getenv("STDF_LLM_TIMEOUT_S", "120"))
+LLM_CONNECT_TIMEOUT_S = float(os.getenv("STDF_LLM_CONNECT_TIMEOUT_S", "5"))
+LLM_RETRIES = int(os.getenv("STDF_LLM_RETRIES", "2"))
+LLM_CACHE_PATH = os.getenv("STDF_LLM_CACHE", "llm_cache.sqlite")
+LLM_CACHE_TTL_HOURS = float(os.getenv("STDF_LLM_CACHE_TTL_HOURS", "168"))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("STDF_LLM_CACHE_MAX_ENTRIES", "2000"))
+
+# LLM assistant fast path (intent_parser.py): rule-based answers below this confidence go to the LLM
+INTENT_MIN_CONFIDENCE = float(os.getenv("STDF_INTENT_MIN_CONFIDENCE", "0.8"))
+
+# LLM assistant: tool calls of one answer built concurrently, each worker on its own read-only session
+LLM_TOOL_WORKERS = int(os.getenv("STDF_LLM_TOOL_WORKERS", "4"))
+
+# Lot-to-Lot parametric statistics (stream_stats.py): PTR results are read in chunks of this many rows and
+# summarized per lot with running moments and a KLL quantile sketch of this size (memory ~ 3 x K values per lot)
+STATS_CHUNK_ROWS = int(os.getenv("STDF_STATS_CHUNK_ROWS", "100000"))
+QUANTILE_SKETCH_K = int(os.getenv("STDF_QUANTILE_SKETCH_K", "200"))
@@ -1,12 +1,16 @@
 """
-Relational schema: Company -> Product -> Stage -> TestProgram -> Lot -> Wafer -> Die -> Bin / TestSuite -> TestItem.
+Relational schema: Company -> Product -> Stage -> TestProgram -> Lot -> Wafer -> Die -> Bin / TestItem;
+TestItem -> TestKey (per-program test dimension) -> TestSuite.
 SQLAlchemy ORM models for STDF hierarchy.
 """
+import threading
 from datetime import datetime
 from sqlalchemy import (
     create_engine,
+    event,
     Column,
     Integer,
+    BigInteger,
     String,
     Float,
     DateTime,
@@ -59,6 +63,7 @@ class TestProgram(Base):
     lots = relationship("Lot", back_populates="test_program", cascade="all, delete-orphan")
     test_suites = relationship("TestSuite", back_populates="test_program", cascade="all, delete-orphan")
     test_definitions = relationship("TestDefinition", back_populates="test_program", cascade="all, delete-orphan")
+    test_keys = relationship("TestKey", back_populates="test_program", cascade="all, delete-orphan")
     __table_args__ = (UniqueConstraint("stage_id", "name", "revision", name="uq_stage_program"),)
 
 
@@ -123,6 +128,7 @@ class Die(Base):
     part_flg = Column(Integer, default=0)
     num_test = Column(Integer, default=0)
     test_t = Column(Integer, default=0)       # elapsed test time ms
+    load_file_id = Column(Integer, ForeignKey("loaded_file.id"), nullable=True)   # registry entry of the source file
     lot = relationship("Lot", back_populates="dies")
     wafer = relationship("Wafer", back_populates="dies")
     bin_record = relationship("Bin", back_populates="die", uselist=False, cascade="all, delete-orphan")
@@ -131,6 +137,7 @@ class Die(Base):
         Index("ix_die_wafer_site", "wafer_id", "head_num", "site_num"),
         Index("ix_die_xy", "wafer_id", "x_coord", "y_coord"),
         Index("ix_die_bins", "hard_bin", "soft_bin"),
+        Index("ix_die_load_file", "load_file_id"),
     )
 
 
@@ -201,39 +208,230 @@ class SiteEquipment(Base):
     __table_args__ = (UniqueConstraint("lot_id", "head_num", "site_grp", name="uq_lot_head_site"),)
 
 
-class TestItem(Base):
-    """Single parametric (PTR) or functional (FTR) test result per die."""
-    __tablename__ = "test_item"
+class TestKey(Base):
+    """
+    Test dimension: per-program constants of one test (name, units, limits, suite), so test_item rows
+    carry only a key. Limits / units are those of the first result loaded for the test.
+    """
+    __tablename__ = "test_key"
     id = Column(Integer, primary_key=True, autoincrement=True)
-    die_id = Column(Integer, ForeignKey("die.id"), nullable=False)
+    test_program_id = Column(Integer, ForeignKey("test_program.id"), nullable=False)
     test_num = Column(Integer, nullable=False)
-    test_txt = Column(String(512), default="")
     test_type = Column(String(8), nullable=False)   # 'PTR' or 'FTR'
-    test_suite_id = Column(Integer, ForeignKey("test_suite.id"), nullable=True)  # from TestDefinition
-    result = Column(Float, nullable=True)           # PTR RESULT; FTR use pass/fail
+    test_txt = Column(String(512), default="")
     units = Column(String(64), default="")
     lo_limit = Column(Float, nullable=True)
     hi_limit = Column(Float, nullable=True)
+    test_suite_id = Column(Integer, ForeignKey("test_suite.id"), nullable=True)  # from TSR
+    test_program = relationship("TestProgram", back_populates="test_keys")
+    test_suite = relationship("TestSuite", backref="test_keys")
+    __table_args__ = (
+        UniqueConstraint("test_program_id", "test_num", "test_type", name="uq_test_key"),
+        Index("ix_test_key_test_num", "test_num"),
+        Index("ix_test_key_suite", "test_suite_id"),
+    )
+
+
+class TestItem(Base):
+    """Single parametric (PTR) or functional (FTR) test result per die; test constants live in TestKey."""
+    __tablename__ = "test_item"
+    die_id = Column(Integer, ForeignKey("die.id"), primary_key=True)
+    test_key_id = Column(Integer, ForeignKey("test_key.id"), primary_key=True)
+    result = Column(Float, nullable=True)           # PTR RESULT; FTR use pass/fail
     pass_fail = Column(Integer, nullable=True)      # 0 pass, 1 fail, null unknown
     die = relationship("Die", back_populates="test_items")
-    test_suite = relationship("TestSuite", backref="test_items")
+    test_key = relationship("TestKey")
+    __table_args__ = (
+        Index("ix_test_item_key", "test_key_id"),
+        {"sqlite_with_rowid": False},   # rows live in the (die_id, test_key_id) primary key b-tree
+    )
+
+
+class LotSummary(Base):
+    """Pre-aggregated per-lot counts, maintained by the loader (see summaries.py)."""
+    __tablename__ = "lot_summary"
+    lot_id = Column(Integer, ForeignKey("lot.id"), primary_key=True)
+    die_count = Column(Integer, default=0)
+    fail_die_count = Column(Integer, default=0)   # dies with at least one failing TestItem
+    test_time_sum = Column(Integer, default=0)    # sum of Die.test_t (ms)
+
+
+class WaferSummary(Base):
+    """Pre-aggregated per-wafer counts, maintained by the loader."""
+    __tablename__ = "wafer_summary"
+    wafer_id = Column(Integer, ForeignKey("wafer.id"), primary_key=True)
+    lot_id = Column(Integer, ForeignKey("lot.id"), nullable=False)
+    die_count = Column(Integer, default=0)
+    fail_die_count = Column(Integer, default=0)
+    test_time_sum = Column(Integer, default=0)
+    __table_args__ = (Index("ix_wafer_summary_lot", "lot_id"),)
+
+
+class TestSummary(Base):
+    """Per lot / wafer (null for package test) / test: executions and failures."""
+    __tablename__ = "test_summary"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    lot_id = Column(Integer, ForeignKey("lot.id"), nullable=False)
+    wafer_id = Column(Integer, ForeignKey("wafer.id"), nullable=True)
+    test_num = Column(Integer, nullable=False)
+    test_type = Column(String(8), nullable=False)
+    test_txt = Column(String(512), default="")
+    exec_count = Column(Integer, default=0)
+    fail_count = Column(Integer, default=0)
+    __table_args__ = (
+        Index("ix_test_summary_lot_test", "lot_id", "test_num"),
+        Index("ix_test_summary_wafer", "wafer_id"),
+    )
+
+
+class BinCount(Base):
+    """Hard bin histogram per lot / wafer (null for package test)."""
+    __tablename__ = "bin_count"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    lot_id = Column(Integer, ForeignKey("lot.id"), nullable=False)
+    wafer_id = Column(Integer, ForeignKey("wafer.id"), nullable=True)
+    hard_bin = Column(Integer, nullable=False)
+    die_count = Column(Integer, default=0)
     __table_args__ = (
-        UniqueConstraint("die_id", "test_num", "test_type", name="uq_die_test"),
-        Index("ix_test_item_test_num", "test_num"),
-        Index("ix_test_item_name", "test_txt"),
-        Index("ix_test_item_suite", "test_suite_id"),
+        Index("ix_bin_count_lot", "lot_id"),
+        Index("ix_bin_count_wafer", "wafer_id"),
     )
 
 
-def get_engine(database_url: str = None, use_static_pool: bool = False):
-    from config import DATABASE_URL
+class DataVersion(Base):
+    """Single row counter bumped in every load transaction; the dashboard query cache keys on it."""
+    __tablename__ = "data_version"
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+
+class LoadedFile(Base):
+    """
+    Load registry: one row per loaded STDF file (see load_registry.py). status "loading" while its data is
+    being written, "done" once committed; the file's dies carry its id (Die.load_file_id).
+    """
+    __tablename__ = "loaded_file"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    path = Column(String(1024), nullable=False)   # resolved path, or "upload:<name>:<sha256>" for uploaded files
+    size = Column(BigInteger, nullable=False)
+    mtime_ns = Column(BigInteger, nullable=True)
+    content_hash = Column(String(64), nullable=False)   # sha256 of the file as stored (compressed or not)
+    status = Column(String(16), nullable=False, default="loading")
+    records = Column(Integer, nullable=True)
+    die_count = Column(Integer, default=0)
+    test_item_count = Column(BigInteger, default=0)
+    lot_pks = Column(Text, default="")   # comma-separated lot.id values the file wrote to
+    loaded_at = Column(DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        Index("ix_loaded_file_path", "path"),
+        Index("ix_loaded_file_hash", "content_hash"),
+    )
+
+
+def bump_data_version(session):
+    """Increment the data version inside the caller's transaction (call before commit)."""
+    updated = session.query(DataVersion).filter_by(id=1).update(
+        {DataVersion.version: DataVersion.version + 1, DataVersion.updated_at: datetime.utcnow()},
+        synchronize_session=False,
+    )
+    if not updated:
+        session.add(DataVersion(id=1, version=1, updated_at=datetime.utcnow()))
+    session.info.pop("data_version", None)
+
+
+def get_data_version(session):
+    """Current data version, read once per session (a Streamlit rerun opens a new session)."""
+    if "data_version" not in session.info:
+        session.info["data_version"] = session.query(DataVersion.version).filter_by(id=1).scalar() or 0
+    return session.info["data_version"]
+
+
+def get_engine(database_url: str = None, use_static_pool: bool = False, connect_args: dict = None,
+               read_only: bool = False, pool_kwargs: dict = None):
+    """New engine; SQLite connections get the SQLITE_* pragmas from config.py. Prefer get_shared_engine()."""
+    from config import DATABASE_URL, SQL_PROFILE
     url = database_url or DATABASE_URL
     kwargs = {}
     if url.startswith("sqlite"):
         kwargs["connect_args"] = {"check_same_thread": False}
         if use_static_pool:
             kwargs["poolclass"] = StaticPool
-    return create_engine(url, **kwargs)
+    if SQL_PROFILE:
+        from sql_profiler import row_counting_connect_args
+        connect_args = {**row_counting_connect_args(url), **(connect_args or {})}
+    if connect_args:
+        kwargs["connect_args"] = {**kwargs.get("connect_args", {}), **connect_args}
+    kwargs.update(pool_kwargs or {})
+    engine = create_engine(url, **kwargs)
+    if engine.dialect.name == "sqlite":
+        _set_sqlite_pragmas(engine, read_only)
+    if SQL_PROFILE:
+        from sql_profiler import profiler
+        profiler.attach(engine)
+    return engine
+
+
+def _set_sqlite_pragmas(engine, read_only=False):
+    """Apply the SQLITE_* settings from config.py to every new connection; read_only adds PRAGMA query_only."""
+    from config import (
+        SQLITE_BUSY_TIMEOUT_MS, SQLITE_CACHE_SIZE_KB, SQLITE_JOURNAL_MODE, SQLITE_MMAP_SIZE_MB,
+        SQLITE_PAGE_SIZE, SQLITE_SYNCHRONOUS,
+    )
+
+    @event.listens_for(engine, "connect")
+    def _on_connect(dbapi_conn, connection_record):
+        cur = dbapi_conn.cursor()
+        cur.execute(f"PRAGMA busy_timeout = {int(SQLITE_BUSY_TIMEOUT_MS)}")
+        if not read_only:
+            cur.execute(f"PRAGMA page_size = {int(SQLITE_PAGE_SIZE)}")   # only takes effect for a new DB file
+            if SQLITE_JOURNAL_MODE:
+                cur.execute(f"PRAGMA journal_mode = {SQLITE_JOURNAL_MODE}")
+        if SQLITE_SYNCHRONOUS:
+            cur.execute(f"PRAGMA synchronous = {SQLITE_SYNCHRONOUS}")
+        cur.execute(f"PRAGMA cache_size = {-int(SQLITE_CACHE_SIZE_KB)}")   # negative: KiB instead of pages
+        cur.execute(f"PRAGMA mmap_size = {int(SQLITE_MMAP_SIZE_MB * 1024 * 1024)}")
+        if read_only:
+            cur.execute("PRAGMA query_only = ON")
+        cur.close()
+
+
+_shared_engines = {}
+_shared_engines_lock = threading.Lock()
+
+
+def get_shared_engine(database_url: str = None, read_only: bool = False):
+    """
+    Process-wide engine per (URL, role), created once. Writers (loader, init_db) use the default role;
+    the dashboard reads through read_only=True, a separate pool (DB_READ_POOL_SIZE) whose connections
+    cannot write (SQLite query_only / PostgreSQL default_transaction_read_only).
+    """
+    from config import DATABASE_URL, DB_READ_POOL_SIZE
+    url = database_url or DATABASE_URL
+    key = (url, read_only)
+    engine = _shared_engines.get(key)
+    if engine is not None:
+        return engine
+    with _shared_engines_lock:
+        if key not in _shared_engines:
+            connect_args, pool_kwargs = None, None
+            in_memory = url.startswith("sqlite") and (url in ("sqlite://", "sqlite:///:memory:") or "mode=memory" in url)
+            if read_only and not in_memory:
+                pool_kwargs = {"pool_size": DB_READ_POOL_SIZE, "max_overflow": DB_READ_POOL_SIZE}
+                if url.startswith("postgresql"):
+                    connect_args = {"options": "-c default_transaction_read_only=on"}
+            _shared_engines[key] = get_engine(
+                url, use_static_pool=in_memory, connect_args=connect_args, read_only=read_only and not in_memory,
+                pool_kwargs=pool_kwargs,
+            )
+        return _shared_engines[key]
+
+
+def dispose_shared_engines():
+    with _shared_engines_lock:
+        for engine in _shared_engines.values():
+            engine.dispose()
+        _shared_engines.clear()
 
 
 def init_db(engine=None):
@@ -241,12 +439,58 @@ def init_db(engine=None):
         engine = get_engine()
     Base.metadata.create_all(engine)
     _migrate_add_columns(engine)
+    _migrate_test_keys(engine)
+    _restore_indexes(engine)
+    _backfill_summaries(engine)
+
+
+_initialized_urls = set()
+
+
+def ensure_db(engine):
+    """init_db once per database URL and process (cheap to call on every Streamlit rerun)."""
+    url = str(engine.url)
+    if url not in _initialized_urls:
+        init_db(engine)
+        _initialized_urls.add(url)
+
+
+def _backfill_summaries(engine):
+    """Build summary tables once for DBs loaded before they existed."""
+    from sqlalchemy.orm import Session
+    from summaries import rebuild_summaries
+    with Session(engine) as session:
+        if session.query(LotSummary.lot_id).first() is None and session.query(Die.id).first() is not None:
+            rebuild_summaries(session)
+            session.commit()
+
+
+def _restore_indexes(engine):
+    """Recreate indexes a PostgreSQL bulk load (pg_copy) dropped and could not rebuild, e.g. after a crash."""
+    if engine.dialect.name != "postgresql":
+        return
+    from sqlalchemy import inspect
+    insp = inspect(engine)
+    tables = set(insp.get_table_names())
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if table.name not in tables:
+                continue
+            existing = {ix["name"] for ix in insp.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(bind=conn)
 
 
 def _migrate_add_columns(engine):
-    """Add new columns to existing tables if missing (SQLite)."""
+    """Add new columns to existing tables if missing (die.load_file_id on any dialect, lot columns on SQLite)."""
     from sqlalchemy import inspect
     insp = inspect(engine)
+    die_cols = {c["name"] for c in insp.get_columns("die")} if "die" in insp.get_table_names() else set()
+    if die_cols and "load_file_id" not in die_cols:
+        with engine.begin() as conn:
+            conn.execute(text("ALTER TABLE die ADD COLUMN load_file_id INTEGER"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS ix_die_load_file ON die (load_file_id)"))
     if engine.dialect.name != "sqlite":
         return
     lot_cols = {c["name"] for c in insp.get_columns("lot")} if "lot" in insp.get_table_names() else set()
@@ -266,10 +510,46 @@ def _migrate_add_columns(engine):
                     conn.execute(text(f"ALTER TABLE lot ADD COLUMN {col} {typ}"))
                 except Exception:
                     pass
-        if "test_item" in insp.get_table_names():
-            ti_cols = {c["name"] for c in insp.get_columns("test_item")}
-            if "test_suite_id" not in ti_cols:
-                try:
-                    conn.execute(text("ALTER TABLE test_item ADD COLUMN test_suite_id INTEGER"))
-                except Exception:
-                    pass
+
+
+def _migrate_test_keys(engine):
+    """
+    Convert a test_item table of the old wide layout (test_num / test_txt / units / limits on every row)
+    into test_key rows plus the slim (die_id, test_key_id, result, pass_fail) table, in one transaction.
+    A key takes text, units and limits from the test's first row by die id, the result the loader's
+    _TestKeyRegistry would have seen first.
+    """
+    from sqlalchemy import inspect
+    insp = inspect(engine)
+    if "test_item" not in insp.get_table_names():
+        return
+    cols = {c["name"] for c in insp.get_columns("test_item")}
+    if "test_num" not in cols:
+        return
+    suite = "MAX(t.test_suite_id)" if "test_suite_id" in cols else "NULL"
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE test_item RENAME TO test_item_old"))
+        if engine.dialect.name == "postgresql":   # the primary key index keeps its name across the rename
+            conn.execute(text("ALTER INDEX IF EXISTS test_item_pkey RENAME TO test_item_old_pkey"))
+        TestItem.__table__.create(bind=conn)
+        conn.execute(text(f"""
+            INSERT INTO test_key (test_program_id, test_num, test_type, test_txt, units, lo_limit, hi_limit, test_suite_id)
+            SELECT f.test_program_id, f.test_num, f.test_type, t.test_txt, t.units, t.lo_limit, t.hi_limit, f.suite
+            FROM (
+                SELECT l.test_program_id, t.test_num, t.test_type, MIN(t.die_id) AS first_die, {suite} AS suite
+                FROM test_item_old t JOIN die d ON d.id = t.die_id JOIN lot l ON l.id = d.lot_id
+                GROUP BY l.test_program_id, t.test_num, t.test_type
+            ) f
+            JOIN test_item_old t ON t.die_id = f.first_die AND t.test_num = f.test_num AND t.test_type = f.test_type
+        """))
+        conn.execute(text("""
+            INSERT INTO test_item (die_id, test_key_id, result, pass_fail)
+            SELECT t.die_id, k.id, t.result, t.pass_fail
+            FROM test_item_old t JOIN die d ON d.id = t.die_id JOIN lot l ON l.id = d.lot_id
+            JOIN test_key k ON k.test_program_id = l.test_program_id AND k.test_num = t.test_num
+                AND k.test_type = t.test_type
+        """))
+        conn.execute(text("DROP TABLE test_item_old"))
+    if engine.dialect.name == "sqlite":
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.execute(text("VACUUM"))   # give the freed pages back
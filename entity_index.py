@@ -0,0 +1,215 @@
+"""
+In-process name index: lot IDs, wafer IDs and PTR test names / numbers, plus the Company → Product →
+Stage → TestProgram lists of the sidebar. One index per DB URL, rebuilt when the data version changes,
+so resolvers do dict / bisect lookups instead of LIKE scans and the sidebar no longer loads ORM lists on
+every rerun. Lots and tests are held in memory (sorted keys for prefix search); wafers are read per lot
+on first use (uq_lot_wafer index) into a bounded LRU, so 100k lots do not mean a copy of the wafer table.
+"""
+import bisect
+import difflib
+import re
+import threading
+from collections import OrderedDict, defaultdict
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from db_models import Company, Lot, Product, Stage, TestKey, TestProgram, Wafer, get_data_version
+
+WAFER_CACHE_LOTS = 4096   # lots whose wafer lists are kept
+
+
+_TRAILING_NUMBER = re.compile(r"(\d+)\s*$")
+
+
+def _trailing_number(s):
+    m = _TRAILING_NUMBER.search(s or "")
+    return int(m.group(1)) if m else None
+
+
+class EntityIndex:
+    """Name lookups of one DB at one data version (read-only after construction, except the wafer LRU)."""
+    def __init__(self, session: Session, version):
+        self.version = version
+        self._engine = getattr(session.get_bind(), "engine", session.get_bind())
+        self._wafers = OrderedDict()   # lot pk -> [(wafer pk, WAFER_ID)]
+        self._lock = threading.Lock()
+        conn = session.connection()
+        self.companies = [tuple(r) for r in conn.execute(select(Company.id, Company.name).order_by(Company.name))]
+        self.products = [tuple(r) for r in conn.execute(
+            select(Product.id, Product.name, Product.company_id).order_by(Product.name)
+        )]
+        self.stages = [tuple(r) for r in conn.execute(select(Stage.id, Stage.name, Stage.product_id).order_by(Stage.name))]
+        self.programs = [tuple(r) for r in conn.execute(
+            select(TestProgram.id, TestProgram.name, TestProgram.revision, TestProgram.stage_id).order_by(TestProgram.name)
+        )]
+        lots = defaultdict(list)   # LOT_ID upper -> [(lot pk, LOT_ID, test program pk)] in pk order
+        for pk, lot_id, program_pk in conn.execute(select(Lot.id, Lot.lot_id, Lot.test_program_id).order_by(Lot.id)):
+            lots[lot_id.strip().upper()].append((pk, lot_id, program_pk))
+        self._lots = dict(lots)
+        self._lot_keys = sorted(self._lots)
+        self._lot_text = "\n".join(self._lot_keys)   # one C-level `in` before a substring scan
+        self._lot_chars = sorted(set(self._lot_text) - {"\n"})
+        tests = defaultdict(dict)  # program pk -> {test_num: name} in test_num order
+        for program_pk, num, name in conn.execute(
+            select(TestKey.test_program_id, TestKey.test_num, TestKey.test_txt)
+            .where(TestKey.test_type == "PTR").order_by(TestKey.test_num)
+        ):
+            tests[program_pk].setdefault(num, (name or "").strip())
+        self._tests = dict(tests)
+
+    # --- lots ---
+
+    def lot(self, lot_id):
+        """(lot pk, LOT_ID, test program pk) of the first lot with this LOT_ID (any case), or None."""
+        hits = self._lots.get(str(lot_id).strip().upper())
+        return hits[0] if hits else None
+
+    def lots(self, lot_ids):
+        """Every (lot pk, LOT_ID, test program pk) with one of the LOT_IDs (a LOT_ID may repeat across programs)."""
+        return [e for lot_id in lot_ids for e in self._lots.get(str(lot_id).strip().upper(), ())]
+
+    def search_lots(self, text, limit=20):
+        """
+        LOT_IDs for typed text (case-insensitive): exact or prefix matches, else substring matches, else
+        LOT_IDs one edit away (a character deleted, inserted, replaced or two swapped).
+        """
+        key = str(text).strip().upper()
+        if not key:
+            return []
+        keys = self._lot_keys
+        found = []
+        i = bisect.bisect_left(keys, key)
+        while i < len(keys) and keys[i].startswith(key) and len(found) < limit:
+            found.append(keys[i])
+            i += 1
+        if not found and key in self._lot_text:
+            found = [k for k in keys if key in k][:limit]
+        if not found:
+            found = sorted(k for k in self._one_edit(key) if k in self._lots)[:limit]
+        return [self._lots[k][0][1] for k in found]
+
+    def _one_edit(self, key):
+        chars = self._lot_chars
+        splits = [(key[:i], key[i:]) for i in range(len(key) + 1)]
+        out = {a + b[1:] for a, b in splits if b}
+        out |= {a + b[1] + b[0] + b[2:] for a, b in splits if len(b) > 1}
+        out |= {a + c + b[1:] for a, b in splits if b for c in chars}
+        out |= {a + c + b for a, b in splits for c in chars}
+        return out
+
+    def find_lot(self, text):
+        """LOT_ID for user text: the exact LOT_ID in any case, else the only prefix / substring / close match."""
+        hit = self.lot(text)
+        if hit:
+            return hit[1]
+        matches = self.search_lots(text, limit=2)
+        return matches[0] if len(matches) == 1 else None
+
+    # --- wafers ---
+
+    def wafers(self, lot_pk):
+        """[(wafer pk, WAFER_ID)] of a lot in id order."""
+        with self._lock:
+            rows = self._wafers.get(lot_pk)
+            if rows is not None:
+                self._wafers.move_to_end(lot_pk)
+                return rows
+        with self._engine.connect() as conn:
+            rows = [tuple(r) for r in conn.execute(
+                select(Wafer.id, Wafer.wafer_id).where(Wafer.lot_id == lot_pk).order_by(Wafer.id)
+            )]
+        with self._lock:
+            self._wafers[lot_pk] = rows
+            while len(self._wafers) > WAFER_CACHE_LOTS:
+                self._wafers.popitem(last=False)
+        return rows
+
+    def wafer(self, lot_pk, wafer_id, loose=True):
+        """
+        (wafer pk, WAFER_ID) of a lot's wafer: exact, else the only one with the same number ("1" = "01" =
+        "W01"), else (loose) the first containing the text. None when not found.
+        """
+        rows = self.wafers(lot_pk)
+        needle = str(wafer_id).strip()
+        for row in rows:
+            if row[1] == needle or row[1].strip() == needle:
+                return row
+        n = _trailing_number(needle)
+        if n is not None:
+            same = [row for row in rows if _trailing_number(row[1]) == n]
+            if len(same) == 1:
+                return same[0]
+        if loose and needle:
+            return next((row for row in rows if needle in row[1]), None)
+        return None
+
+    # --- tests ---
+
+    def tests(self, program_pks):
+        """[(test_num, name)] of the PTR tests of the programs, by test number."""
+        merged = {}
+        for p in program_pks:
+            for num, name in self._tests.get(p, {}).items():
+                merged.setdefault(num, name)
+        return sorted(merged.items())
+
+    def test(self, program_pks, identifier):
+        """
+        (test_num, name) of a PTR test given by number, or by name: equal, contained, contained ignoring case,
+        then the closest spelling. None when no test matches a name.
+        """
+        try:
+            num = int(identifier)
+        except (TypeError, ValueError):
+            num = None
+        tests = self.tests(program_pks)
+        if num is not None:
+            name = next((t[1] for t in tests if t[0] == num), "")
+            return num, name or f"Test#{num}"
+        needle = str(identifier).strip()
+        if not needle:
+            return None
+        lowered = needle.lower()
+        match = (
+            next((t for t in tests if t[1] == needle), None)
+            or next((t for t in tests if needle in t[1]), None)
+            or next((t for t in tests if lowered in t[1].lower()), None)
+        )
+        if match is None:
+            by_name = {t[1].lower(): t for t in tests if t[1]}
+            close = difflib.get_close_matches(lowered, list(by_name), n=1, cutoff=0.8)
+            match = by_name[close[0]] if close else None
+        if match is None:
+            return None
+        return match[0], match[1] or f"Test#{match[0]}"
+
+    def has_test(self, program_pks, test_num):
+        return any(test_num in self._tests.get(p, {}) for p in program_pks)
+
+    def test_named_in(self, program_pks, text):
+        """test_num of the longest PTR test name (3+ characters) contained in text, or None."""
+        lowered = text.lower()
+        best = None
+        for num, name in self.tests(program_pks):
+            if len(name) >= 3 and name.lower() in lowered and (best is None or len(name) > len(best[1])):
+                best = (num, name)
+        return best[0] if best else None
+
+
+_indexes = {}   # DB URL -> EntityIndex
+_indexes_lock = threading.Lock()
+
+
+def entity_index(session: Session) -> EntityIndex:
+    """Process-wide index of the session's DB, rebuilt on the first call after the data version changed."""
+    url = str(session.get_bind().url)
+    version = get_data_version(session)
+    index = _indexes.get(url)
+    if index is not None and index.version == version:
+        return index
+    with _indexes_lock:
+        index = _indexes.get(url)
+        if index is None or index.version != version:
+            index = _indexes[url] = EntityIndex(session, version)
+    return index
@@ -0,0 +1,222 @@
+"""
+Rule-based fast path for the LLM assistant: a question is matched against the lot / wafer / PTR test
+names in the DB (entity_index, rebuilt when the data version changes) and a small Chinese / English keyword
+grammar. A question that names a known lot and exactly one tool resolves to the same
+{"tool": ..., "params": {...}} the LLM would return, without a model call; anything else (no known
+lot, ambiguous tool, guessed parameters) is left to the LLM.
+
+    python intent_parser.py [llm_logs.jsonl]   # hit rate and agreement with the logged LLM answers
+"""
+import re
+import time
+import unicodedata
+
+from sqlalchemy.orm import Session
+
+from config import INTENT_MIN_CONFIDENCE
+from entity_index import EntityIndex, entity_index
+from llm_gateway import tool_calls
+
+# tool -> keyword patterns (matched case-insensitively on the NFKC-normalized question)
+TOOL_KEYWORDS = {
+    "lot_pchart": [r"p\s*-?\s*chart", "管制圖"],
+    "wafer_map": [r"wafer\s*-?\s*map", r"bin\s*-?\s*map", "晶圓圖"],
+    "top_fail_pareto": ["pareto", "柏拉圖"],
+    "wafer_diff": ["比較", "差異", "不同", r"\bdiff", "compare", r"\bvs\b"],
+    "test_heatmap": [r"heat\s*-?\s*map", "熱力圖", "熱圖"],
+    "composite_map": ["composite", "疊合", "疊圖", r"\bstack"],
+}
+_TOOL_RE = {tool: re.compile("|".join(pats), re.I) for tool, pats in TOOL_KEYWORDS.items()}
+_TOKEN_RE = re.compile(r"[A-Za-z0-9_.\-]+")
+_SEP = r"\s*(?:,|、|和|與|跟|及|and|vs\.?|&|/)\s*"
+_ID = r"[A-Za-z_\-]*\d[A-Za-z0-9_\-]*"   # wafer IDs contain a digit ("wafer map" is not wafer "map")
+_WAFER_RE = re.compile(rf"(?:wafers?|晶圓)\s*#?\s*({_ID})((?:{_SEP}(?:wafer|晶圓)?\s*#?\s*{_ID})*)", re.I)
+_WAFER_NTH_RE = re.compile(r"第\s*(\d+)\s*片")
+_TEST_NUM_RE = re.compile(r"(?:test|測試|測項)\s*(?:#|no\.?|num(?:ber)?)?\s*(\d+)", re.I)
+_TOP_K_RE = re.compile(r"(?:top|前)\s*-?\s*(\d+)", re.I)
+_WAFER_LEVEL_RE = re.compile(r"wafer\s*-?\s*level|wafer\s*層級|晶圓層級", re.I)
+
+
+class Intent:
+    """Parsed tool call with a confidence: 1.0 = every parameter named in the question."""
+    __slots__ = ("tool", "params", "confidence")
+
+    def __init__(self, tool, params, confidence=1.0):
+        self.tool = tool
+        self.params = params
+        self.confidence = confidence
+
+    def as_tool_call(self):
+        return {"tool": self.tool, "params": self.params}
+
+    def __repr__(self):
+        return f"Intent({self.tool}, {self.params}, {self.confidence:.2f})"
+
+
+def _wafer_tokens(text):
+    """Wafer IDs named in a question ("wafer 01 和 02", "wafers 3, 5", "第2片"); IDs contain a digit."""
+    out = []
+    for m in _WAFER_RE.finditer(text):
+        out.append(m.group(1))
+        out += re.split(_SEP, m.group(2) or "", flags=re.I)
+    out += _WAFER_NTH_RE.findall(text)
+    cleaned = []
+    for t in out:
+        t = re.sub(r"^(?:wafer|晶圓)\s*#?\s*", "", t.strip(), flags=re.I)
+        if t and t not in cleaned:
+            cleaned.append(t)
+    return cleaned
+
+
+def _test(text, lot_ids, index):
+    """test_num named in the question (by number or PTR test name) for the lots' programs, or None."""
+    programs = {e[2] for e in index.lots(lot_ids)}
+    m = _TEST_NUM_RE.search(text)
+    if m and index.has_test(programs, int(m.group(1))):
+        return int(m.group(1))
+    return index.test_named_in(programs, text)
+
+
+def _resolve(tool, text, lots, index):
+    """Parameters of one tool, or None when a required one is missing. Returns (params, confidence)."""
+    lot_ids = [e[1] for e in lots]
+    lot_pk, lot = lots[0][0], lots[0][1]
+    if tool == "lot_pchart":
+        return {"lots": lot_ids}, 1.0
+    if tool == "top_fail_pareto":
+        if len(lots) != 1:
+            return None
+        m = _TOP_K_RE.search(text)
+        level = "Wafer" if _WAFER_LEVEL_RE.search(text) else "Die"
+        return {"level": level, "k": int(m.group(1)) if m else 5, "lot": lot}, 1.0
+    if tool == "composite_map":
+        params = {"lots": lot_ids}
+        if len(lots) == 1:
+            wafers = [w[1] for w in (index.wafer(lot_pk, t, loose=False) for t in _wafer_tokens(text)) if w]
+            if wafers:
+                params["wafers"] = wafers
+        test_num = _test(text, lot_ids, index)
+        if test_num is not None:
+            params["test"] = test_num
+        return params, 1.0
+    if len(lots) != 1:
+        return None
+    matched = [index.wafer(lot_pk, t, loose=False) for t in _wafer_tokens(text)]
+    if any(w is None for w in matched):
+        return None   # a wafer the lot does not have
+    wafers = [w[1] for w in matched]
+    confidence = 1.0
+    if not wafers and len(index.wafers(lot_pk)) == 1:
+        wafers, confidence = [index.wafers(lot_pk)[0][1]], 0.9   # single-wafer lot
+    if tool == "wafer_map":
+        if len(wafers) != 1:
+            return None
+        return {"lot": lot, "wafer": wafers[0]}, confidence
+    if tool == "wafer_diff":
+        if len(wafers) != 2 or wafers[0] == wafers[1]:
+            return None
+        return {"lot": lot, "wafer_left": wafers[0], "wafer_right": wafers[1]}, 1.0
+    if tool == "test_heatmap":
+        test_num = _test(text, lot_ids, index)
+        if len(wafers) != 1 or test_num is None:
+            return None
+        return {"lot": lot, "wafer": wafers[0], "test": test_num}, confidence
+    return None
+
+
+def parse_intent(question: str, index: EntityIndex):
+    """Intent for a question, or None (no known lot, no or several tools, missing parameters)."""
+    text = unicodedata.normalize("NFKC", question or "").strip()
+    lots = []   # (lot pk, LOT_ID, test program pk)
+    for token in _TOKEN_RE.findall(text):
+        entry = index.lot(token)
+        if entry and entry[1] not in [e[1] for e in lots]:
+            lots.append(entry)
+    if not lots:
+        return None
+    # lot IDs must not be read as keywords or wafer numbers ("W118892的wafermap")
+    for entry in lots:
+        text = re.sub(re.escape(entry[1]), " ", text, flags=re.I)
+    tools = [t for t, rx in _TOOL_RE.items() if rx.search(text)]
+    resolved = {t: r for t in tools if (r := _resolve(t, text, lots, index)) is not None}
+    if len(resolved) > 1:
+        # "比較 wafer 01 和 02 的 wafer map": a specific map tool wins over the plain wafer map
+        resolved.pop("wafer_map", None)
+    if len(resolved) != 1:
+        return None
+    (tool, (params, confidence)), = resolved.items()
+    return Intent(tool, params, confidence)
+
+
+def fast_path(session: Session, question: str):
+    """Tool call for a question when the rules are confident enough, else None (ask the LLM)."""
+    intent = parse_intent(question, entity_index(session))
+    if intent is None or intent.confidence < INTENT_MIN_CONFIDENCE:
+        return None
+    return intent.as_tool_call()
+
+
+def _same_call(a, b):
+    """Logged LLM answer vs rule answer: same tool and the same parameters (wafer / lot names as strings)."""
+    norm = lambda v: [norm(x) for x in v] if isinstance(v, list) else str(v).strip().upper()
+    return a.get("tool") == b.get("tool") and {k: norm(v) for k, v in (a.get("params") or {}).items()} == {
+        k: norm(v) for k, v in (b.get("params") or {}).items()
+    }
+
+
+def hit_rate_report(session: Session, log_path="llm_logs.jsonl"):
+    """
+    Run the parser over the questions in an LLM log: how many resolve locally, how many of those agree
+    with the logged LLM answer, and the parse time per question.
+    """
+    import json
+    index = entity_index(session)
+    rows = []
+    with open(log_path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                rows.append(json.loads(line))
+    out = {"questions": len(rows), "hits": 0, "agree": 0, "compared": 0, "misses": [], "disagree": []}
+    t0 = time.perf_counter()
+    intents = [parse_intent(r.get("question", ""), index) for r in rows]
+    elapsed = time.perf_counter() - t0
+    for row, intent in zip(rows, intents):
+        if intent is None or intent.confidence < INTENT_MIN_CONFIDENCE:
+            out["misses"].append(row.get("question", "").strip())
+            continue
+        out["hits"] += 1
+        logged = tool_calls(row.get("parsed"))
+        if row.get("source") != "rules" and len(logged) == 1:
+            logged = logged[0]
+            out["compared"] += 1
+            if _same_call(logged, intent.as_tool_call()):
+                out["agree"] += 1
+            else:
+                out["disagree"].append((row.get("question", "").strip(), logged, intent.as_tool_call()))
+    out["hit_rate"] = out["hits"] / len(rows) if rows else 0.0
+    out["us_per_question"] = elapsed / len(rows) * 1e6 if rows else 0.0
+    return out
+
+
+if __name__ == "__main__":
+    import argparse
+    from sqlalchemy.orm import sessionmaker
+    from db_models import get_engine, init_db
+
+    ap = argparse.ArgumentParser(description="Hit rate of the rule-based intent parser over an LLM log")
+    ap.add_argument("log", nargs="?", default="llm_logs.jsonl")
+    ap.add_argument("--db-url", default=None, help="DB with the lots / wafers / tests (default STDF_DB_URL)")
+    args = ap.parse_args()
+    engine = get_engine(args.db_url) if args.db_url else get_engine()
+    init_db(engine)
+    with sessionmaker(bind=engine)() as session:
+        rep = hit_rate_report(session, args.log)
+    print(f"{rep['questions']} questions: {rep['hits']} resolved locally ({rep['hit_rate']:.0%}), "
+          f"{rep['us_per_question']:.0f} us/question")
+    if rep["compared"]:
+        print(f"agreement with the logged LLM answer: {rep['agree']}/{rep['compared']}")
+    for q in rep["misses"]:
+        print(f"  LLM   {q}")
+    for q, logged, ours in rep["disagree"]:
+        print(f"  DIFF  {q}: LLM {logged} / rules {ours}")
@@ -0,0 +1,320 @@
+"""
+LLM gateway: one process-wide client per backend (online = OpenAI SDK client, Ollama / offline = a pooled
+requests.Session with a connect/status retry policy), an async path and a persisted question cache.
+Questions are normalized (NFKC, lower case, no whitespace or trailing punctuation) and the parsed tool
+call is stored per (backend, model, system prompt, question) in a small SQLite file with a TTL and an
+entry limit (least recently used evicted), so a repeated question skips the model round trip.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from typing import Any, Dict, List
+
+from config import (
+    LLM_CACHE_MAX_ENTRIES, LLM_CACHE_PATH, LLM_CACHE_TTL_HOURS, LLM_CONNECT_TIMEOUT_S, LLM_RETRIES, LLM_TIMEOUT_S,
+)
+
+BACKENDS = ("online", "ollama", "offline")
+
+
+def normalize_question(question: str) -> str:
+    """Cache form of a question: "畫出 PChart？\\n" and "畫出pchart" are the same entry."""
+    q = unicodedata.normalize("NFKC", question or "").lower()
+    q = re.sub(r"\s+", "", q)
+    return q.rstrip("?.!。")
+
+
+def extract_json(content: str) -> dict:
+    """Parse LLM response: pure JSON or ```json ... ``` block."""
+    content = (content or "").strip()
+    # 嘗試直接解析
+    try:
+        return json.loads(content)
+    except json.JSONDecodeError:
+        pass
+    # 嘗試從 markdown 程式碼區塊取出
+    m = re.search(r"```(?:json)?\s*([\s\S]*?)```", content)
+    if m:
+        try:
+            return json.loads(m.group(1).strip())
+        except json.JSONDecodeError:
+            pass
+    # 嘗試找第一個 { ... } 區塊
+    m = re.search(r"\{[\s\S]*\}", content)
+    if m:
+        try:
+            return json.loads(m.group(0))
+        except json.JSONDecodeError:
+            pass
+    raise RuntimeError(f"無法從 LLM 回傳中解析 JSON：{content[:200]}...")
+
+
+def tool_calls(data) -> List[Dict[str, Any]]:
+    """
+    Tool calls of an LLM answer, in order: {"tool": ..., "params": {...}} (one call), {"calls": [...]}
+    or a bare list of calls (a compound question). Entries without a tool name are dropped.
+    """
+    if isinstance(data, dict):
+        data = data["calls"] if "calls" in data else [data]
+    if not isinstance(data, list):
+        return []
+    return [
+        {"tool": c["tool"], "params": c.get("params") if isinstance(c.get("params"), dict) else {}}
+        for c in data if isinstance(c, dict) and isinstance(c.get("tool"), str) and c["tool"]
+    ]
+
+
+class ResponseCache:
+    """Persisted normalized-question -> parsed tool call cache (SQLite file; thread-safe)."""
+    def __init__(self, path: str = LLM_CACHE_PATH, ttl_hours: float = LLM_CACHE_TTL_HOURS,
+                 max_entries: int = LLM_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl_s = ttl_hours * 3600
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, backend TEXT, question TEXT, "
+            "parsed TEXT, created REAL, used REAL, hits INTEGER DEFAULT 0)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_llm_cache_used ON llm_cache (used)")
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(backend, model, messages) -> str:
+        system = "\n".join(str(m.get("content", "")) for m in messages if m.get("role") == "system")
+        question = next((str(m.get("content", "")) for m in reversed(messages) if m.get("role") == "user"), "")
+        raw = json.dumps([backend, model or "", hashlib.sha256(system.encode()).hexdigest(), normalize_question(question)])
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def get(self, key):
+        """Parsed tool call, or None when missing or older than the TTL."""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT parsed FROM llm_cache WHERE key = ? AND created >= ?", (key, now - self.ttl_s)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE llm_cache SET used = ?, hits = hits + 1 WHERE key = ?", (now, key))
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key, backend, question, parsed):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, backend, question, parsed, created, used, hits) "
+                "VALUES (?, ?, ?, ?, ?, ?, 0)",
+                (key, backend, question, json.dumps(parsed, ensure_ascii=False), now, now),
+            )
+            self._conn.execute("DELETE FROM llm_cache WHERE created < ?", (now - self.ttl_s,))
+            n = self._conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+            if n > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY used LIMIT ?)",
+                    (n - self.max_entries,),
+                )
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM llm_cache")
+            self.hits = self.misses = 0
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+
+
+class LLMGateway:
+    """
+    ask(backend, messages) -> (parsed tool call, cached). Base URLs default to OPENAI_BASE_URL /
+    OLLAMA_BASE_URL / OFFLINE_LLM_URL, read on each call like the API key and model names.
+    """
+    def __init__(self, cache: ResponseCache = None, openai_base_url=None, ollama_base_url=None, offline_url=None,
+                 timeout: float = LLM_TIMEOUT_S, connect_timeout: float = LLM_CONNECT_TIMEOUT_S,
+                 retries: int = LLM_RETRIES):
+        self.cache = cache
+        self.openai_base_url = openai_base_url
+        self.ollama_base_url = ollama_base_url
+        self.offline_url = offline_url
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.retries = retries
+        self._session = None
+        self._openai = {}   # (api key, base url) -> OpenAI client
+        self._lock = threading.Lock()
+
+    def session(self):
+        """Pooled requests.Session: connection errors and 429/502/503/504 retried with backoff, read timeouts not."""
+        if self._session is None:
+            try:
+                import requests  # type: ignore
+                from requests.adapters import HTTPAdapter
+                from urllib3.util.retry import Retry
+            except ImportError as exc:
+                raise RuntimeError("請安裝 requests：pip install requests") from exc
+            with self._lock:
+                if self._session is None:
+                    retry = Retry(
+                        total=self.retries, connect=self.retries, read=False, status=self.retries, backoff_factor=0.5,
+                        status_forcelist=(429, 502, 503, 504), allowed_methods=None, raise_on_status=False,
+                    )
+                    s = requests.Session()
+                    adapter = HTTPAdapter(max_retries=retry, pool_connections=4, pool_maxsize=8)
+                    s.mount("http://", adapter)
+                    s.mount("https://", adapter)
+                    self._session = s
+        return self._session
+
+    def _openai_client(self, api_key, base_url):
+        key = (api_key, base_url)
+        client = self._openai.get(key)
+        if client is None:
+            try:
+                from openai import OpenAI  # type: ignore
+            except ImportError as exc:
+                raise RuntimeError("openai package not installed. Run: pip install openai") from exc
+            with self._lock:
+                client = self._openai.get(key)
+                if client is None:
+                    client = self._openai[key] = OpenAI(
+                        api_key=api_key, base_url=base_url, timeout=self.timeout, max_retries=self.retries,
+                    )
+        return client
+
+    def model(self, backend):
+        if backend == "online":
+            return os.getenv("OPENAI_MODEL", "gpt-4.1-mini")
+        if backend == "ollama":
+            return os.getenv("OLLAMA_MODEL", "gemma3:4b")
+        return self.offline_url or os.getenv("OFFLINE_LLM_URL") or ""
+
+    def ask(self, backend: str, messages: List[Dict[str, Any]], use_cache: bool = True):
+        """Parsed {"tool": ..., "params": {...}} or {"calls": [...]} for the conversation, from the cache when possible."""
+        if backend not in BACKENDS:
+            raise ValueError(f"unknown LLM backend: {backend}")
+        key = ResponseCache.key(backend, self.model(backend), messages) if self.cache is not None else None
+        if key is not None and use_cache:
+            parsed = self.cache.get(key)
+            if parsed is not None:
+                return parsed, True
+        data, cacheable = getattr(self, f"_{backend}")(messages)
+        if key is not None and cacheable and tool_calls(data):
+            question = next((m.get("content", "") for m in reversed(messages) if m.get("role") == "user"), "")
+            self.cache.put(key, backend, question, data)
+        return data, False
+
+    async def ask_async(self, backend: str, messages: List[Dict[str, Any]], use_cache: bool = True):
+        """ask() on a worker thread (the pooled clients are shared), for asyncio callers."""
+        return await asyncio.to_thread(self.ask, backend, messages, use_cache)
+
+    def _online(self, messages):
+        """
+        Online LLM call (OpenAI).
+        Expect LLM to return pure JSON like:
+          {"tool": "lot_pchart", "params": {"lots": ["LOT1","LOT2"]}}
+        """
+        api_key = os.getenv("OPENAI_API_KEY")
+        if not api_key:
+            raise RuntimeError("OPENAI_API_KEY is not set in environment.")
+        client = self._openai_client(api_key, self.openai_base_url or os.getenv("OPENAI_BASE_URL") or None)
+        resp = client.chat.completions.create(model=self.model("online"), messages=messages, temperature=0)
+        content = resp.choices[0].message.content or ""
+        try:
+            data = json.loads(content)
+        except json.JSONDecodeError as exc:
+            raise RuntimeError(f"LLM 回傳非 JSON 格式：{content}") from exc
+        if isinstance(data, list):
+            data = {"calls": data}
+        if not tool_calls(data):
+            raise RuntimeError(f"LLM 回傳格式錯誤：{data}")
+        return data, True
+
+    def _ollama(self, messages):
+        """
+        與本機 Ollama 互動。需先安裝並啟動 Ollama（預設 http://localhost:11434）。
+        環境變數：OLLAMA_BASE_URL（預設 http://localhost:11434）、OLLAMA_MODEL（預設 gemma3:4b）。
+        要求 Ollama 回傳純 JSON：{"tool": "...", "params": {...}}。
+        """
+        import requests  # type: ignore
+        base = (
+            self.ollama_base_url or os.getenv("OLLAMA_BASE_URL") or os.getenv("OLLAMA_HOST") or "http://localhost:11434"
+        ).rstrip("/")
+        payload = {"model": self.model("ollama"), "messages": messages, "stream": False}
+        try:
+            r = self.session().post(f"{base}/api/chat", json=payload, timeout=(self.connect_timeout, self.timeout))
+            r.raise_for_status()
+        except requests.exceptions.ConnectionError as exc:
+            raise RuntimeError(
+                f"無法連線至 Ollama（{base}）。請確認已安裝並啟動 Ollama（例如終端執行 ollama serve）。"
+            ) from exc
+        except requests.exceptions.Timeout as exc:
+            raise RuntimeError("Ollama 回應逾時，請稍後再試或換較小模型。") from exc
+        except requests.exceptions.HTTPError as exc:
+            raise RuntimeError(f"Ollama 回傳錯誤：{r.status_code} {r.text[:200]}") from exc
+        content = (r.json().get("message") or {}).get("content") or ""
+        parsed = extract_json(content)
+        if isinstance(parsed, list):
+            parsed = {"calls": parsed}
+        if not tool_calls(parsed):
+            raise RuntimeError(f"Ollama 回傳格式須為 {{\"tool\": \"...\", \"params\": {{...}}}}：{parsed}")
+        return parsed, True
+
+    def _offline(self, messages):
+        """
+        Offline LLM placeholder.
+        - 若環境變數 OFFLINE_LLM_URL 設定為本地 HTTP 伺服器，則以 JSON 格式呼叫該端點。
+          預期回傳內容為 JSON: {"tool": "...", "params": {...}}。
+        - 若未設定，則用簡單規則從問題文字中抓取類似 LOT 名稱，直接回傳 lot_pchart 指令（不快取）。
+        """
+        offline_url = self.offline_url or os.getenv("OFFLINE_LLM_URL")
+        if offline_url:
+            # 將 messages 壓成簡單 prompt 給本地服務
+            prompt = "\n\n".join(f"[{m.get('role')}]\n{m.get('content', '')}" for m in messages)
+            r = self.session().post(offline_url, json={"prompt": prompt}, timeout=(self.connect_timeout, self.timeout))
+            r.raise_for_status()
+            data = r.json()
+            # 若本地模型已直接回傳 JSON，則使用；否則嘗試從 data["output"] 中解析
+            if isinstance(data, dict) and ("tool" in data or "calls" in data):
+                return data, True
+            if isinstance(data, dict) and "output" in data:
+                try:
+                    parsed = json.loads(data["output"])
+                    if isinstance(parsed, list):
+                        parsed = {"calls": parsed}
+                    if isinstance(parsed, dict):
+                        return parsed, True
+                except Exception:
+                    pass
+            raise RuntimeError(f"Offline LLM 回傳格式錯誤：{data}")
+
+        # 簡單 fallback：嘗試從問題文字中抓 LOT 名稱，組成 lot_pchart 工具呼叫
+        user_text = next((str(m.get("content", "")) for m in reversed(messages) if m.get("role") == "user"), "")
+        # 抓取類似 LOT 名稱的 token（含英數與 -/_），過濾掉太短的 token
+        lots = [t for t in re.findall(r"[A-Za-z0-9_-]+", user_text) if len(t) >= 3]
+        if not lots:
+            raise RuntimeError("離線模式下無法從問題中推斷 LOT 名稱，請明確輸入 LOT ID。")
+        return {"tool": "lot_pchart", "params": {"lots": lots}}, False
+
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+
+def get_llm_gateway() -> LLMGateway:
+    """Process-wide gateway (Streamlit re-runs app.py; pooled clients and the cache outlive reruns)."""
+    global _gateway
+    if _gateway is None:
+        with _gateway_lock:
+            if _gateway is None:
+                _gateway = LLMGateway(cache=ResponseCache() if LLM_CACHE_PATH else None)
+    return _gateway
@@ -0,0 +1,249 @@
+"""
+Load registry (loaded_file table): which STDF files are in the DB, with size, mtime, content hash, row
+counts and the lots they wrote to. load_stdf / load_stdf_batch consult it so re-loading is idempotent:
+
+- unchanged file (same path, size and mtime, or same size and sha256) -> skipped without parsing
+- uploads (in-memory files) are keyed by name and content hash: the same upload again is skipped, a different
+  upload that shares a name is a new load; it replaces the earlier upload only when asked (replace_upload)
+- changed file -> loaded as a new entry; the previous entry's Die / Bin / TestItem rows are deleted in the
+  transaction that commits the new data (summaries of the affected lots rebuilt, side-store rows of the
+  old dies rewritten), so readers see either the old or the new content
+- entry left in status "loading" (process killed mid-load) -> its rows are purged and the file loaded again,
+  so an interrupted batch resumes with the files that were not done
+- purging an entry (replaced, unfinished or failed load) also deletes the Wafer / Lot rows it leaves without
+  dies; a "loading" entry lists its lots as soon as it writes to them, so a purge finds them even before the
+  first die. Program-level rows (test keys, suites, test definitions) are shared and kept.
+"""
+import hashlib
+import os
+from pathlib import Path
+
+from sqlalchemy import and_, delete, inspect, or_, select
+from sqlalchemy.orm import Session
+
+from db_models import (
+    Bin, BinCount, Die, LoadedFile, Lot, LotSummary, SiteEquipment, TestItem, TestSummary, Wafer, WaferSummary,
+)
+
+_HASH_CHUNK = 1 << 20
+
+
+def _upload_prefix(source):
+    return f"upload:{getattr(source, 'name', None) or 'stream'}:"
+
+
+def registry_key(source, digest=None):
+    """
+    Registry path of a load source: the resolved file path, or "upload:<name>:<sha256>" for in-memory files
+    (digest: their content_hash, computed when not given), so uploads sharing a name never match each other.
+    """
+    if isinstance(source, (str, Path)):
+        return str(Path(source).resolve())
+    return _upload_prefix(source) + (digest or content_hash(source))
+
+
+def _buffer(source):
+    """Bytes of an in-memory source (bytes, memoryview, BytesIO / UploadedFile); None for a path or stream."""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return source
+    if hasattr(source, "getbuffer"):
+        return source.getbuffer()
+    return None
+
+
+def content_hash(source):
+    """sha256 (hex) of a file as stored (compressed files are not decompressed)."""
+    h = hashlib.sha256()
+    buf = _buffer(source) if not isinstance(source, (str, Path)) else None
+    if buf is not None:
+        h.update(buf)
+        return h.hexdigest()
+    with open(source, "rb") as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _signature(source):
+    """(size, mtime_ns): stat of a path; for in-memory sources the size and None."""
+    if isinstance(source, (str, Path)):
+        st = os.stat(source)
+        return st.st_size, st.st_mtime_ns
+    return len(_buffer(source)), None
+
+
+def format_lot_pks(lot_pks):
+    """LoadedFile.lot_pks value: comma-separated lot.id values."""
+    return ",".join(str(pk) for pk in sorted(lot_pks))
+
+
+def parse_lot_pks(value):
+    return {int(pk) for pk in (value or "").split(",") if pk}
+
+
+def is_registrable(source):
+    """Paths and in-memory files can be registered; other streams (pipes) cannot be hashed without consuming them."""
+    return isinstance(source, (str, Path)) or _buffer(source) is not None
+
+
+class LoadPlan:
+    """What to do with one source: action "skip", "load" (new file) or "replace" (changed file)."""
+    __slots__ = ("key", "action", "size", "mtime_ns", "content_hash", "previous", "stale")
+
+    def __init__(self, key, action, size, mtime_ns, content_hash, previous=None, stale=()):
+        self.key = key
+        self.action = action
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.content_hash = content_hash
+        self.previous = previous    # LoadedFile of the data currently in the DB (None for a new file)
+        self.stale = list(stale)    # unfinished or superseded entries of the same path, purged by complete()
+
+
+class LoadRegistry:
+    """Registry operations inside the loader's session (the caller commits)."""
+    def __init__(self, session: Session):
+        self.session = session
+
+    def plan(self, source, force: bool = False, replace_upload: bool = False) -> LoadPlan:
+        """
+        Compare a source with its registry entries: a stat() when size and mtime match, the content
+        hash otherwise. force=True always (re)loads. replace_upload=True makes an upload replace the latest
+        upload of the same name whatever its content (uploads are otherwise matched by content only).
+        """
+        upload = not isinstance(source, (str, Path))
+        digest = content_hash(source) if upload else None
+        key = registry_key(source, digest)
+        match = LoadedFile.path == key
+        if upload:   # entries of older registries, keyed "upload:<name>": only the same content matches
+            match = or_(match, and_(LoadedFile.path == _upload_prefix(source)[:-1], LoadedFile.content_hash == digest))
+        entries = self.session.query(LoadedFile).filter(match).order_by(LoadedFile.id).all()
+        done = [e for e in entries if e.status == "done"]
+        previous = done[-1] if done else None
+        if upload and replace_upload and previous is None:
+            previous = self.session.query(LoadedFile).filter(
+                LoadedFile.path.startswith(_upload_prefix(source), autoescape=True), LoadedFile.status == "done"
+            ).order_by(LoadedFile.id.desc()).first()
+        stale = [e for e in entries if e is not previous]
+        size, mtime_ns = _signature(source)
+        if previous is not None and previous.size == size and not force:
+            if mtime_ns is not None and previous.mtime_ns == mtime_ns:
+                return LoadPlan(key, "skip", size, mtime_ns, previous.content_hash, previous, stale)
+            digest = digest or content_hash(source)
+            if digest == previous.content_hash:
+                previous.mtime_ns = mtime_ns   # touched or copied again, same content
+                return LoadPlan(key, "skip", size, mtime_ns, digest, previous, stale)
+        else:
+            digest = digest or content_hash(source)
+        return LoadPlan(key, "replace" if previous is not None else "load", size, mtime_ns, digest, previous, stale)
+
+    def begin(self, plan: LoadPlan, writers=()) -> LoadedFile:
+        """
+        New "loading" entry for the plan (its id tags the dies the sink writes). When replacing, rows of the
+        previous entry's dies are dropped from the side-store writers (pending until their publish()); the
+        loader passes a matrix writer whenever matrix files exist, also with STDF_WAFER_MATRIX off.
+        """
+        entry = LoadedFile(
+            path=plan.key, size=plan.size, mtime_ns=plan.mtime_ns, content_hash=plan.content_hash, status="loading",
+        )
+        self.session.add(entry)
+        self.session.flush()
+        writers = [w for w in writers if w is not None]
+        if plan.previous is not None and writers:
+            by_wafer = {}
+            rows = self.session.execute(
+                select(Die.lot_id, Die.wafer_id, Die.id).where(Die.load_file_id == plan.previous.id)
+            )
+            for lot_pk, wafer_pk, die_id in rows:
+                by_wafer.setdefault((lot_pk, wafer_pk or 0), []).append(die_id)
+            for (lot_pk, wafer_pk), die_ids in by_wafer.items():
+                for w in writers:
+                    w.remove_dies(lot_pk, wafer_pk, die_ids)
+        return entry
+
+    def _purge(self, entry_ids):
+        """
+        Delete the Die / Bin / TestItem rows of registry entries, then the Wafer / Lot rows left without dies
+        (see _drop_empty); returns the lot ids they touched.
+        """
+        if not entry_ids:
+            return set()
+        dies = select(Die.id).where(Die.load_file_id.in_(entry_ids))
+        lot_pks = {r[0] for r in self.session.execute(
+            select(Die.lot_id).where(Die.load_file_id.in_(entry_ids)).distinct()
+        )}
+        for (listed,) in self.session.execute(select(LoadedFile.lot_pks).where(LoadedFile.id.in_(entry_ids))):
+            lot_pks |= parse_lot_pks(listed)
+        self.session.execute(delete(TestItem).where(TestItem.die_id.in_(dies)))
+        self.session.execute(delete(Bin).where(Bin.die_id.in_(dies)))
+        self.session.execute(delete(Die).where(Die.load_file_id.in_(entry_ids)))
+        self._drop_empty(lot_pks, entry_ids)
+        return lot_pks
+
+    def _drop_empty(self, lot_pks, entry_ids):
+        """
+        Delete wafers without dies in lot_pks, and lots without wafers or dies, with their summary and
+        SiteEquipment rows. Lots another "loading" entry lists are left alone (it may not have written its
+        dies yet); a lot any other entry lists is kept even when it has no dies.
+        """
+        in_use, loading = set(), set()
+        for listed, status in self.session.execute(
+            select(LoadedFile.lot_pks, LoadedFile.status).where(LoadedFile.id.notin_(entry_ids))
+        ):
+            pks = parse_lot_pks(listed)
+            in_use |= pks
+            if status == "loading":
+                loading |= pks
+        lots = sorted(set(lot_pks) - loading)
+        if not lots:
+            return
+        wafer_pks = list(self.session.scalars(select(Wafer.id).where(
+            Wafer.lot_id.in_(lots), ~select(Die.id).where(Die.wafer_id == Wafer.id).exists()
+        )))
+        if wafer_pks:
+            for model in (TestSummary, BinCount, WaferSummary):
+                self.session.execute(delete(model).where(model.wafer_id.in_(wafer_pks)))
+            self.session.execute(delete(Wafer).where(Wafer.id.in_(wafer_pks)))
+        empty = list(self.session.scalars(select(Lot.id).where(
+            Lot.id.in_(sorted(set(lots) - in_use)),
+            ~select(Die.id).where(Die.lot_id == Lot.id).exists(),
+            ~select(Wafer.id).where(Wafer.lot_id == Lot.id).exists(),
+        )))
+        if empty:
+            for model in (TestSummary, BinCount, WaferSummary, LotSummary, SiteEquipment):
+                self.session.execute(delete(model).where(model.lot_id.in_(empty)))
+            self.session.execute(delete(Lot).where(Lot.id.in_(empty)))
+
+    def complete(self, plan: LoadPlan, entry: LoadedFile, rows_written, lot_pks, records=None):
+        """
+        Mark entry done (call after the sink's finish(), before the commit). Rows of the previous and stale
+        entries are deleted and the summaries of every lot they touched are rebuilt.
+        """
+        from summaries import rebuild_summaries
+        entry.status = "done"
+        entry.records = records
+        entry.die_count = rows_written.get("die", 0)
+        entry.test_item_count = rows_written.get("test_item", 0)
+        entry.lot_pks = format_lot_pks(lot_pks)
+        old = [e for e in [plan.previous, *plan.stale] if e is not None and e.id != entry.id]
+        touched = self._purge([e.id for e in old])
+        if touched:
+            rebuild_summaries(self.session, sorted(touched | set(lot_pks)))
+        for e in old:
+            self.session.delete(e)
+
+    def skip(self, plan: LoadPlan):
+        """Unchanged file: purge leftovers of unfinished attempts (their rows were never in the summaries)."""
+        self._purge([e.id for e in plan.stale if e.status != "done"])
+        for e in plan.stale:
+            if e.status != "done":
+                self.session.delete(e)
+
+    def abandon(self, entry: LoadedFile):
+        """
+        Failed load: purge the rows written under the entry (also those other files' commits made durable in a
+        batch) and drop it. No-op for an entry whose insert was rolled back.
+        """
+        if inspect(entry).persistent:
+            self._purge([entry.id])
+            self.session.delete(entry)
@@ -0,0 +1,106 @@
+"""
+Fail Pareto engine: top-k failing tests or bins for one lot, a lot set or a filtered Lot query,
+computed with a single GROUP BY and returned as a DataFrame. Die-level, Wafer-level and cross-lot
+Pareto share this code path.
+"""
+import pandas as pd
+from sqlalchemy import func
+from sqlalchemy.orm import Session, Query
+
+from db_models import Lot, Wafer, Die, Bin, TestItem, TestKey, TestProgram
+
+
+def _lot_filter(lots):
+    """lots: Lot query (e.g. _lots_query), or iterable of lot primary keys."""
+    if isinstance(lots, Query):
+        return Die.lot_id.in_(lots.with_entities(Lot.id).scalar_subquery())
+    return Die.lot_id.in_(list(lots))
+
+
+def test_pareto(session: Session, lots, level: str = "Die", k: int = None, group_by: str = None):
+    """
+    Failing TestItem count per test: one row per test number and type (a PTR and an FTR sharing a number
+    are separate tests) of each test program. level "Wafer" keeps only dies on a wafer.
+    group_by: None, "wafer" or "lot" adds a breakdown column (top k per total across groups).
+    Columns: [Lot|Wafer,] Test #, Type, Test, Fail count. Test names one test: " (PTR)" / " (FTR)" is added
+    when both types share a number, " [program rev]" when the lots span several test programs.
+    """
+    cols = []
+    if group_by == "wafer":
+        cols.append(Wafer.wafer_id.label("Wafer"))
+    elif group_by == "lot":
+        cols.append(Lot.lot_id.label("Lot"))
+    q = session.query(
+        *cols,
+        TestKey.test_num.label("Test #"),
+        TestKey.test_type.label("Type"),
+        TestKey.test_program_id.label("_program"),
+        func.max(TestKey.test_txt).label("Test"),
+        func.count().label("Fail count"),
+    ).select_from(TestItem).join(Die, Die.id == TestItem.die_id).join(TestKey, TestKey.id == TestItem.test_key_id).filter(
+        _lot_filter(lots), TestItem.pass_fail == 1
+    )
+    if group_by == "wafer" or level.lower() == "wafer":
+        q = q.filter(Die.wafer_id != None)
+    if group_by == "wafer":
+        q = q.join(Wafer, Wafer.id == Die.wafer_id).group_by(Die.wafer_id, Wafer.wafer_id)
+    elif group_by == "lot":
+        q = q.join(Lot, Lot.id == Die.lot_id).group_by(Die.lot_id, Lot.lot_id)
+    q = q.group_by(TestKey.test_program_id, TestKey.test_num, TestKey.test_type)
+    df = pd.DataFrame(q.all(), columns=[c["name"] for c in q.column_descriptions])
+    if df.empty:
+        return df.drop(columns="_program")
+    df["Test"] = [(t or "").strip() or f"Test#{n}" for t, n in zip(df["Test"], df["Test #"])]
+    both_types = df.groupby(["_program", "Test #"])["Type"].transform("nunique") > 1
+    df.loc[both_types, "Test"] += " (" + df.loc[both_types, "Type"] + ")"
+    if df["_program"].nunique() > 1:
+        programs = {
+            pk: f"{name} {rev or ''}".strip() for pk, name, rev in session.query(
+                TestProgram.id, TestProgram.name, TestProgram.revision
+            ).filter(TestProgram.id.in_(df["_program"].unique().tolist()))
+        }
+        df["Test"] += " [" + df["_program"].map(programs) + "]"
+    # one key per (test number, type, program), ordered by test number
+    df["_test"] = df.groupby(["Test #", "Type", "_program"]).ngroup()
+    return _top_k(df, "_test", "Fail count", k, group_by).drop(columns=["_test", "_program"])
+
+
+def bin_pareto(session: Session, lots, level: str = "Die", k: int = None, group_by: str = None):
+    """
+    Die count per hard bin (bin name from Bin when known). Columns: [Lot|Wafer,] Hard bin, Bin, Count.
+    """
+    cols = []
+    if group_by == "wafer":
+        cols.append(Wafer.wafer_id.label("Wafer"))
+    elif group_by == "lot":
+        cols.append(Lot.lot_id.label("Lot"))
+    q = session.query(
+        *cols,
+        Die.hard_bin.label("Hard bin"),
+        func.max(Bin.hard_bin_name).label("Bin"),
+        func.count(Die.id).label("Count"),
+    ).select_from(Die).outerjoin(Bin, Bin.die_id == Die.id).filter(_lot_filter(lots), Die.hard_bin != None)
+    if group_by == "wafer" or level.lower() == "wafer":
+        q = q.filter(Die.wafer_id != None)
+    if group_by == "wafer":
+        q = q.join(Wafer, Wafer.id == Die.wafer_id).group_by(Die.wafer_id, Wafer.wafer_id)
+    elif group_by == "lot":
+        q = q.join(Lot, Lot.id == Die.lot_id).group_by(Die.lot_id, Lot.lot_id)
+    q = q.group_by(Die.hard_bin)
+    df = pd.DataFrame(q.all(), columns=[c["name"] for c in q.column_descriptions])
+    if df.empty:
+        return df
+    df["Bin"] = [(n or "").strip() or f"Bin{b}" for n, b in zip(df["Bin"], df["Hard bin"])]
+    return _top_k(df, "Hard bin", "Count", k, group_by)
+
+
+def _top_k(df, key_col, count_col, k, group_by):
+    """Keep the k keys with the highest total count (all groups of those keys), sorted descending."""
+    totals = df.groupby(key_col)[count_col].sum().sort_values(ascending=False, kind="stable")
+    if k:
+        totals = totals.head(int(k))
+    out = df[df[key_col].isin(totals.index)].copy()
+    out["_total"] = out[key_col].map(totals)
+    sort_cols = ["_total", key_col] + ([count_col] if group_by else [])
+    out = out.sort_values(sort_cols, ascending=[False, True] + ([False] if group_by else []), kind="stable")
+    return out.drop(columns="_total").reset_index(drop=True)
@@ -0,0 +1,129 @@
+"""
+PostgreSQL bulk writer for the loader: Die / Bin / TestItem batches are streamed with COPY ... FROM STDIN
+(binary or CSV, built in memory) instead of INSERT executemany. When the die table is empty (initial
+bulk load) and the writer is used by a single transaction, the secondary indexes of die / bin / test_item
+are dropped for the load and rebuilt in finish(), inside that transaction; a writer shared across commits
+(defer_indexes=False, the batch loader) leaves them in place. Supports psycopg (3) and psycopg2; CopyWriter.for_session()
+returns None for other dialects / drivers so the loader keeps its generic executemany path.
+"""
+import io
+import struct
+
+from sqlalchemy import BigInteger, Float, Integer, text
+
+from config import PG_COPY_FORMAT
+
+_BINARY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+_BINARY_TRAILER = struct.pack("!h", -1)
+_NULL = struct.pack("!i", -1)
+_DRIVERS = ("psycopg", "psycopg2")
+
+
+def _binary_field(col_type):
+    """Encoder value -> length-prefixed binary field for one column type (NULL handled by the caller)."""
+    if isinstance(col_type, Float):
+        fmt = struct.Struct("!id")
+        return lambda v: fmt.pack(8, v)
+    if isinstance(col_type, BigInteger):
+        fmt = struct.Struct("!iq")
+        return lambda v: fmt.pack(8, v)
+    if isinstance(col_type, Integer):
+        fmt = struct.Struct("!ii")
+        return lambda v: fmt.pack(4, v)
+    length = struct.Struct("!i")
+
+    def text_field(v):
+        b = str(v).encode("utf-8")
+        return length.pack(len(b)) + b
+    return text_field
+
+
+def encode_binary(table, columns, data) -> bytes:
+    """COPY BINARY payload for rows given column-wise (data[col] = list of values)."""
+    encoders = [_binary_field(table.c[c].type) for c in columns]
+    n_fields = struct.pack("!h", len(columns))
+    out = [_BINARY_HEADER]
+    append = out.append
+    for row in zip(*(data[c] for c in columns)):
+        append(n_fields)
+        for enc, v in zip(encoders, row):
+            append(_NULL if v is None else enc(v))
+    append(_BINARY_TRAILER)
+    return b"".join(out)
+
+
+def _csv_value(v):
+    if v is None:
+        return ""   # unquoted empty field = NULL
+    if isinstance(v, str):
+        return '"' + v.replace('"', '""') + '"'   # quoted, so "" stays an empty string
+    return repr(v) if isinstance(v, float) else str(v)
+
+
+def encode_csv(table, columns, data) -> bytes:
+    """COPY CSV payload (NULL = unquoted empty field, strings always quoted)."""
+    lines = [",".join(_csv_value(v) for v in row) for row in zip(*(data[c] for c in columns))]
+    return ("\n".join(lines) + "\n").encode("utf-8") if lines else b""
+
+
+class CopyWriter:
+    """
+    COPY writer bound to one loader session. defer_indexes=True (one transaction from first write to
+    finish()) drops the secondary indexes for an initial load; pass False when the session commits in between.
+    """
+    def __init__(self, session, tables, fmt="binary", defer_indexes=True):
+        self.session = session
+        self.tables = tables
+        self.fmt = fmt
+        self.defer_indexes = defer_indexes
+        self._started = False
+        self._dropped = []   # Index objects to rebuild in finish()
+
+    @classmethod
+    def for_session(cls, session, tables, fmt=None, defer_indexes=True):
+        """CopyWriter on PostgreSQL with psycopg / psycopg2 and STDF_PG_COPY enabled, else None."""
+        fmt = fmt or PG_COPY_FORMAT
+        dialect = session.get_bind().dialect
+        if fmt not in ("binary", "csv") or dialect.name != "postgresql" or dialect.driver not in _DRIVERS:
+            return None
+        return cls(session, tables, fmt, defer_indexes)
+
+    def _start(self):
+        """First write: defer secondary indexes when this is an initial load into empty tables."""
+        self._started = True
+        if not self.defer_indexes:
+            return
+        die = self.tables[0]
+        if self.session.execute(text(f"SELECT 1 FROM {die.name} LIMIT 1")).first() is not None:
+            return
+        for table in self.tables:
+            for index in table.indexes:
+                self.session.execute(text(f'DROP INDEX IF EXISTS "{index.name}"'))
+                self._dropped.append(index)
+
+    def write(self, table, columns, data):
+        """COPY the rows of data (column-wise lists) into table."""
+        if not self._started:
+            self._start()
+        payload = (encode_binary if self.fmt == "binary" else encode_csv)(table, columns, data)
+        cols = ", ".join(f'"{c}"' for c in columns)
+        sql = f'COPY "{table.name}" ({cols}) FROM STDIN WITH (FORMAT {self.fmt})'
+        cursor = self.session.connection().connection.dbapi_connection.cursor()
+        try:
+            if hasattr(cursor, "copy"):   # psycopg 3
+                with cursor.copy(sql) as copy:
+                    copy.write(payload)
+            else:   # psycopg2
+                cursor.copy_expert(sql, io.BytesIO(payload))
+        finally:
+            cursor.close()
+
+    def finish(self):
+        """Rebuild the indexes dropped for an initial load (same transaction, so a rollback keeps them)."""
+        conn = self.session.connection()
+        for index in self._dropped:
+            index.create(bind=conn)
+        if self._dropped:
+            for table in self.tables:
+                self.session.execute(text(f'ANALYZE "{table.name}"'))
+        self._dropped = []
@@ -0,0 +1,143 @@
+"""
+Process-wide memo cache for dashboard builders. Entries are keyed by builder name, DB URL, the DB data
+version (bumped by the loader on every commit that adds data) and the call arguments, so a load makes
+all older entries unreachable. Bounded by entry count and approximate memory (LRU eviction).
+Streamlit re-executes app.py on every rerun; this module is imported once, so the cache survives reruns.
+"""
+import functools
+import sys
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from config import QUERY_CACHE_MAX_ENTRIES, QUERY_CACHE_MAX_MB
+from db_models import get_data_version
+
+
+def _attrs(obj):
+    """Attribute values of an object: its __dict__ and the __slots__ of its classes."""
+    values = list(vars(obj).values()) if hasattr(obj, "__dict__") else []
+    for cls in type(obj).__mro__:
+        slots = cls.__dict__.get("__slots__", ())
+        for name in (slots,) if isinstance(slots, str) else slots:
+            if name not in ("__dict__", "__weakref__") and hasattr(obj, name):
+                values.append(getattr(obj, name))
+    return values
+
+
+def _approx_size(obj, _depth=0):
+    """
+    Rough byte size of a cached value (DataFrames, arrays, plotly figures, containers, and objects such as
+    WaferGrid / StreamStats through their __slots__ / __dict__ attributes).
+    """
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        return int(obj.memory_usage(deep=True).sum()) if isinstance(obj, pd.DataFrame) else int(obj.memory_usage(deep=True))
+    if isinstance(obj, np.ndarray):
+        return int(obj.nbytes)
+    if hasattr(obj, "to_plotly_json"):
+        return _approx_size(obj.to_plotly_json(), _depth)
+    if _depth > 8:
+        return sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(_approx_size(k, _depth + 1) + _approx_size(v, _depth + 1) for k, v in obj.items())
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return sys.getsizeof(obj) + sum(_approx_size(v, _depth + 1) for v in obj)
+    if isinstance(obj, (str, bytes, int, float, complex, bool, type(None))):
+        return sys.getsizeof(obj)
+    return sys.getsizeof(obj) + sum(_approx_size(v, _depth + 1) for v in _attrs(obj))
+
+
+def _freeze(value):
+    """Hashable form of an argument (lists/dicts/sets become tuples)."""
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted(_freeze(v) for v in value))
+    return value
+
+
+class QueryCache:
+    """Thread-safe LRU with an entry limit and an approximate memory cap (bytes)."""
+    def __init__(self, max_entries: int = QUERY_CACHE_MAX_ENTRIES, max_bytes: int = int(QUERY_CACHE_MAX_MB * 1024 * 1024)):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()   # key -> (value, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return (True, value) on hit, (False, None) on miss."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return True, entry[0]
+
+    def put(self, key, value):
+        size = _approx_size(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._data[key] = (value, size)
+            self._bytes += size
+            while self._data and (len(self._data) > self.max_entries or self._bytes > self.max_bytes):
+                _, (_, evicted) = self._data.popitem(last=False)
+                self._bytes -= evicted
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._data), "bytes": self._bytes, "hits": self.hits, "misses": self.misses}
+
+
+_cache = QueryCache()
+
+
+def cached_builder(fn):
+    """
+    Memoize fn(session, *args, **kwargs) per (DB URL, data version, args). Cached values are shared
+    between reruns and users: builders must return plain data / figures (no ORM instances) and callers
+    must not mutate them.
+    """
+    name = f"{fn.__module__}.{fn.__qualname__}"
+
+    @functools.wraps(fn)
+    def wrapper(session, *args, **kwargs):
+        try:
+            key = (name, str(session.get_bind().url), get_data_version(session), _freeze(args), _freeze(kwargs))
+            hash(key)
+        except TypeError:   # unhashable argument: do not cache
+            return fn(session, *args, **kwargs)
+        hit, value = _cache.get(key)
+        if hit:
+            return value
+        value = fn(session, *args, **kwargs)
+        _cache.put(key, value)
+        return value
+
+    wrapper.uncached = fn
+    return wrapper
+
+
+def cache_stats():
+    return _cache.stats()
+
+
+def clear_cache():
+    _cache.clear()
@@ -0,0 +1,241 @@
+"""
+SQL statement profiler: SQLAlchemy cursor events record every statement an engine executes (SQL text,
+seconds, rows fetched, calling function). Statements of the current render / benchmark run are kept per
+thread between reset() and snapshot(); per-caller totals and latency histograms accumulate for the process.
+Statements slower than slow_ms are appended to a JSONL log (like llm_logs.jsonl).
+Rows are counted at the DB-API cursor, which needs the counting sqlite3 connection factory
+(row_counting_connect_args); on other drivers rows stay None.
+
+get_engine() attaches the shared `profiler` when STDF_SQL_PROFILE is set.
+"""
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+
+from sqlalchemy import event
+
+# upper bounds (ms) of the latency histogram buckets; the last bucket is open-ended
+LATENCY_BUCKETS_MS = (1, 5, 10, 50, 100, 500, 1000)
+# statements kept per thread between reset() calls (later ones are only counted)
+MAX_RECORDS = 5000
+
+_REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class StatementRecord:
+    __slots__ = ("sql", "params", "seconds", "rows", "caller", "stats")
+
+    def __init__(self, sql, params, seconds, caller, stats):
+        self.sql = sql
+        self.params = params
+        self.seconds = seconds
+        self.rows = None
+        self.caller = caller
+        self.stats = stats
+
+
+class CallerStats:
+    """Process-wide totals for one calling function."""
+    __slots__ = ("count", "seconds", "max_seconds", "rows", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.rows = 0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def add(self, seconds):
+        self.count += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        ms = seconds * 1000
+        for i, bound in enumerate(LATENCY_BUCKETS_MS):
+            if ms <= bound:
+                self.buckets[i] += 1
+                return
+        self.buckets[-1] += 1
+
+
+def bucket_labels():
+    return [f"≤{b}ms" for b in LATENCY_BUCKETS_MS] + [f">{LATENCY_BUCKETS_MS[-1]}ms"]
+
+
+class _CountingCursor(sqlite3.Cursor):
+    """sqlite3 cursor that adds fetched rows to the StatementRecord of its current statement."""
+    record = None
+
+    def _count(self, n):
+        rec = self.record
+        if rec is not None:
+            rec.rows = (rec.rows or 0) + n
+            if rec.stats is not None:
+                rec.stats.rows += n
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            self._count(1)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany() if size is None else super().fetchmany(size)
+        self._count(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        self._count(len(rows))
+        return rows
+
+
+class _CountingConnection(sqlite3.Connection):
+    def cursor(self, factory=_CountingCursor):
+        return super().cursor(factory)
+
+
+def row_counting_connect_args(url: str) -> dict:
+    """connect_args for get_engine so fetched rows are counted (SQLite only; empty for other backends)."""
+    return {"factory": _CountingConnection} if url.startswith("sqlite") else {}
+
+
+_WS = re.compile(r"\s+")
+_IN_LIST = re.compile(r"\((?:\s*\?\s*,)+\s*\?\s*\)")
+
+
+def normalize_sql(sql: str) -> str:
+    """One line, IN (?, ?, ...) collapsed, so repeated statements with different bind lists group together."""
+    return _IN_LIST.sub("(?...)", _WS.sub(" ", sql).strip())
+
+
+def _caller(depth=2):
+    """'module.function' of the nearest frame in this repo outside sql_profiler (e.g. 'app.dashboard_home')."""
+    frame = sys._getframe(depth)
+    while frame is not None:
+        path = frame.f_code.co_filename
+        if path.startswith(_REPO_DIR) and "site-packages" not in path and not path.endswith("sql_profiler.py"):
+            return f"{Path(path).stem}.{frame.f_code.co_name}"
+        frame = frame.f_back
+    return "?"
+
+
+class QueryProfiler:
+    """Records statements executed on the attached engines (thread-safe; one profiler can watch several engines)."""
+    def __init__(self, slow_ms: float = None, slow_log: str = None):
+        self.slow_ms = slow_ms
+        self.slow_log = slow_log
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.callers = {}
+
+    def attach(self, engine):
+        if not event.contains(engine, "after_cursor_execute", self._after):
+            event.listen(engine, "before_cursor_execute", self._before)
+            event.listen(engine, "after_cursor_execute", self._after)
+        return self
+
+    def detach(self, engine):
+        event.remove(engine, "before_cursor_execute", self._before)
+        event.remove(engine, "after_cursor_execute", self._after)
+
+    def _records(self):
+        local = self._local
+        if not hasattr(local, "records"):
+            local.records, local.dropped = [], 0
+        return local
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        self._local.t0 = time.perf_counter()
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - getattr(self._local, "t0", time.perf_counter())
+        caller = _caller()
+        with self._lock:
+            stats = self.callers.get(caller)
+            if stats is None:
+                stats = self.callers[caller] = CallerStats()
+            stats.add(seconds)
+        rec = StatementRecord(statement, parameters, seconds, caller, stats)
+        if isinstance(cursor, _CountingCursor):
+            rec.rows = 0
+            cursor.record = rec   # rows are added as SQLAlchemy fetches them
+        local = self._records()
+        if len(local.records) < MAX_RECORDS:
+            local.records.append(rec)
+        else:
+            local.dropped += 1
+        if self.slow_ms is not None and self.slow_log and seconds * 1000 >= self.slow_ms:
+            self._log_slow(rec, executemany)
+
+    def _log_slow(self, rec, executemany):
+        entry = {
+            "ts": datetime.utcnow().isoformat(),
+            "ms": round(rec.seconds * 1000, 2),
+            "caller": rec.caller,
+            "sql": normalize_sql(rec.sql),
+            "params": repr(rec.params)[:500],
+            "executemany": bool(executemany),
+        }
+        try:
+            with self._lock, Path(self.slow_log).open("a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        except Exception:
+            pass
+
+    def reset(self):
+        """Start a new render / run for the current thread."""
+        local = self._records()
+        local.records, local.dropped = [], 0
+
+    def snapshot(self, top: int = 5) -> dict:
+        """
+        Current thread since reset(): statements, sql_seconds, rows (None if not counted), the most
+        repeated statements, the costliest statements and per-caller totals (costliest first).
+        """
+        local = self._records()
+        records = list(local.records)
+        counted = [r.rows for r in records if r.rows is not None]
+        repeated = Counter(normalize_sql(r.sql) for r in records)
+        by_caller = {}
+        for r in records:
+            c = by_caller.setdefault(r.caller, {"caller": r.caller, "statements": 0, "sql_seconds": 0.0, "rows": None})
+            c["statements"] += 1
+            c["sql_seconds"] += r.seconds
+            if r.rows is not None:
+                c["rows"] = (c["rows"] or 0) + r.rows
+        return {
+            "statements": len(records) + local.dropped,
+            "sql_seconds": sum(r.seconds for r in records),
+            "rows": sum(counted) if counted else None,
+            "most_repeated": [{"count": n, "sql": sql[:200]} for sql, n in repeated.most_common(top) if n > 1],
+            "costliest": [
+                {"caller": r.caller, "ms": r.seconds * 1000, "rows": r.rows, "sql": normalize_sql(r.sql)[:300]}
+                for r in sorted(records, key=lambda r: r.seconds, reverse=True)[:top]
+            ],
+            "callers": sorted(by_caller.values(), key=lambda c: c["sql_seconds"], reverse=True),
+        }
+
+    def caller_stats(self) -> list:
+        """Process-wide per-caller totals and latency histogram (bucket_labels() order), costliest first."""
+        with self._lock:
+            items = [(name, s.count, s.seconds, s.max_seconds, s.rows, list(s.buckets)) for name, s in self.callers.items()]
+        return [
+            {"caller": name, "statements": n, "sql_seconds": sec, "max_ms": mx * 1000, "rows": rows, "histogram": buckets}
+            for name, n, sec, mx, rows, buckets in sorted(items, key=lambda t: t[2], reverse=True)
+        ]
+
+
+def _shared_profiler():
+    from config import SLOW_QUERY_LOG, SLOW_QUERY_MS
+    return QueryProfiler(slow_ms=SLOW_QUERY_MS, slow_log=SLOW_QUERY_LOG)
+
+
+# process-wide profiler used by get_engine() when STDF_SQL_PROFILE is on
+profiler = _shared_profiler()
@@ -0,0 +1,121 @@
+"""
+STDF input layer: opens a path, an in-memory buffer or an uploaded file for stdf_reader.iter_records.
+Plain STDF files are memory-mapped (records are decoded in place), .gz / .bz2 / .zip archives are
+decompressed as a stream (nothing is written to disk). Compression is detected from the magic bytes,
+so the file name does not matter.
+"""
+import bz2
+import gzip
+import io
+import mmap
+import zipfile
+from contextlib import contextmanager
+from pathlib import Path
+
+STDF_SUFFIXES = (".stdf", ".std")
+
+_GZIP_MAGIC = b"\x1f\x8b"
+_BZIP2_MAGIC = b"BZh"
+_ZIP_MAGIC = b"PK\x03\x04"
+
+
+def is_stdf_name(name):
+    """file.stdf / file.std, optionally compressed (file.stdf.gz, file.std.bz2) or a .zip archive."""
+    name = str(name).lower()
+    if name.endswith(".zip"):
+        return True
+    for suffix in (".gz", ".bz2"):
+        if name.endswith(suffix):
+            name = name[: -len(suffix)]
+            break
+    return name.endswith(STDF_SUFFIXES)
+
+
+def _zip_member(zf: zipfile.ZipFile):
+    """The STDF member of a zip archive: first *.stdf / *.std (optionally compressed), else the only file."""
+    names = [i.filename for i in zf.infolist() if not i.is_dir()]
+    stdf = [n for n in names if is_stdf_name(n) and not n.lower().endswith(".zip")]
+    if stdf:
+        return sorted(stdf)[0]
+    if len(names) == 1:
+        return names[0]
+    raise ValueError(f"No STDF file in zip archive (members: {', '.join(names[:10])})")
+
+
+def _compression(head: bytes):
+    if head.startswith(_GZIP_MAGIC):
+        return "gz"
+    if head.startswith(_BZIP2_MAGIC):
+        return "bz2"
+    if head.startswith(_ZIP_MAGIC):
+        return "zip"
+    return None
+
+
+@contextmanager
+def _decompressed(fileobj, kind):
+    """Decompressing binary stream over fileobj (which must stay open while it is read)."""
+    if kind == "gz":
+        with gzip.GzipFile(fileobj=fileobj) as f:
+            yield f
+    elif kind == "bz2":
+        with bz2.BZ2File(fileobj) as f:
+            yield f
+    else:
+        with zipfile.ZipFile(fileobj) as zf:
+            name = _zip_member(zf)
+            with zf.open(name) as member:
+                kind = _compression(member.peek(4) if hasattr(member, "peek") else b"")
+                if kind in ("gz", "bz2"):   # e.g. lot.stdf.gz inside a zip
+                    with _decompressed(member, kind) as f:
+                        yield f
+                else:
+                    yield member
+
+
+@contextmanager
+def open_stdf(source):
+    """
+    Context manager yielding an input for stdf_reader.iter_records:
+    - path to a plain STDF file -> read-only mmap
+    - path to a .gz / .bz2 / .zip file -> decompressing stream
+    - bytes / bytearray / memoryview -> the buffer itself (or a stream over it if compressed)
+    - in-memory file (Streamlit UploadedFile, BytesIO) -> its bytes; other binary file objects are read as a stream
+    """
+    if isinstance(source, (str, Path)):
+        path = Path(source)
+        if not path.is_file():
+            raise FileNotFoundError(f"STDF file not found: {source}")
+        with open(path, "rb") as f:
+            kind = _compression(f.read(4))
+            f.seek(0)
+            if kind is not None:
+                with _decompressed(f, kind) as stream:
+                    yield stream
+            elif path.stat().st_size == 0:
+                yield b""
+            else:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    yield mm
+        return
+    if isinstance(source, memoryview):
+        source = source.tobytes()
+    elif hasattr(source, "getvalue"):   # BytesIO / Streamlit UploadedFile: already in memory
+        source = source.getvalue()
+    if isinstance(source, (bytes, bytearray)):
+        kind = _compression(bytes(source[:4]))
+        if kind is None:
+            yield source
+        else:
+            with _decompressed(io.BytesIO(source), kind) as stream:
+                yield stream
+        return
+    # other readable binary stream (pipe, socket file, ...)
+    head = source.peek(4)[:4] if hasattr(source, "peek") else b""
+    kind = _compression(head)
+    if kind is None:
+        yield source
+    else:
+        with _decompressed(source, kind) as stream:
+            yield stream
+
@@ -2,14 +2,35 @@
 Load STDF files into the relational DB (Company/Product/Stage/TestProgram/Lot/Wafer/Die/Bin/TestSuite/TestItem).
 Uses pystdf for parsing; implements a sink that receives record events and writes to SQLAlchemy.
 """
+import io
+import time
+import glob
+import multiprocessing
+import queue
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from pathlib import Path
 
 from pystdf.IO import Parser
-from pystdf import V4
-from sqlalchemy.orm import Session
+from sqlalchemy import event, func, insert, text
+from sqlalchemy.orm import Session, sessionmaker
 
-from config import DEFAULT_COMPANY, DEFAULT_PRODUCT, DEFAULT_STAGE
+from columnar_store import ColumnarStoreWriter
+from wafer_matrix import MatrixStoreWriter
+from pg_copy import CopyWriter
+from config import (
+    DEFAULT_COMPANY,
+    DEFAULT_PRODUCT,
+    DEFAULT_STAGE,
+    LOAD_CHUNK_SIZE,
+    LOAD_TARGET_ROWS_PER_SEC,
+    LOAD_WORKERS,
+    STDF_PARSER,
+)
+from stdf_io import is_stdf_name, open_stdf
+from stdf_reader import iter_records
+from summaries import SummaryAccumulator
+from load_registry import LoadRegistry, format_lot_pks, is_registrable
 from db_models import (
     Base,
     Company,
@@ -22,10 +43,13 @@ from db_models import (
     Bin,
     TestSuite,
     TestDefinition,
+    TestKey,
     TestItem,
     SiteEquipment,
-    get_engine,
-    init_db,
+    LoadedFile,
+    bump_data_version,
+    ensure_db,
+    get_shared_engine,
 )
 
 
@@ -51,13 +75,184 @@ def _stdf_time_to_datetime(val):
         return None
 
 
+def _test_flg_to_pass_fail(test_flg):
+    """PTR/FTR TEST_FLG bit 7 -> 1 fail / 0 pass; None if flag missing."""
+    if isinstance(test_flg, (list, bytes)):
+        test_flg = test_flg[0] if test_flg else 0
+    if test_flg is not None and hasattr(test_flg, "__and__"):
+        return 1 if (test_flg & 0x80) else 0
+    return None
+
+
+class _ColumnBatch:
+    """
+    Columnar buffer for one table: one list per column, appended row by row.
+    Written with a single Core executemany when the loader flushes. extra columns are buffered
+    (for the columnar side-store) but not written to the table.
+    """
+    def __init__(self, table, columns, extra=()):
+        self.table = table
+        self.columns = tuple(columns)
+        self.data = {c: [] for c in self.columns + tuple(extra)}
+        self._lists = list(self.data.values())
+        self._n = len(self.columns)
+
+    def __len__(self):
+        return len(self._lists[0])
+
+    def append(self, *values):
+        for lst, v in zip(self._lists, values):
+            lst.append(v)
+
+    def records(self):
+        """Row dicts for executemany."""
+        cols = self.columns
+        return [dict(zip(cols, row)) for row in zip(*self._lists[:self._n])]
+
+    def clear(self):
+        for lst in self._lists:
+            lst.clear()
+
+
+class _DieIdAllocator:
+    """
+    Hands out die primary keys without a round trip per die. Share one instance between sinks of the same session.
+    PostgreSQL: ids are reserved in blocks from the die id sequence with nextval, so concurrent loaders never collide.
+    SQLite: the first id of a transaction takes the database write lock (BEGIN IMMEDIATE) and reads max(die.id);
+    the ids after it are ours until that transaction ends, then the next call locks and reads again.
+    """
+    PG_BLOCK = 1000
+
+    def __init__(self, session: Session):
+        self.session = session
+        self._next = None
+        self._reserved = []   # PostgreSQL: ids taken from the sequence, handed out from the end
+        self._postgres = session.get_bind().dialect.name == "postgresql"
+        if not self._postgres:
+            event.listen(session, "after_transaction_end", self._on_transaction_end)
+
+    def _on_transaction_end(self, session, transaction):
+        if transaction.parent is None:
+            self._next = None
+
+    def __call__(self):
+        if self._postgres:
+            if not self._reserved:
+                self._reserved = [row[0] for row in self.session.execute(text(
+                    "SELECT nextval(pg_get_serial_sequence('die', 'id')) FROM generate_series(1, :n)"
+                ), {"n": self.PG_BLOCK})]
+                self._reserved.reverse()
+            return self._reserved.pop()
+        if self._next is None:
+            self._lock_sqlite()
+            max_id = self.session.query(func.max(Die.id)).scalar()
+            self._next = (max_id or 0) + 1
+        die_id = self._next
+        self._next += 1
+        return die_id
+
+    def _lock_sqlite(self):
+        """Hold the SQLite write lock until the session's transaction ends, so no other writer adds dies."""
+        conn = self.session.connection()
+        if conn.connection.dbapi_connection.in_transaction:
+            # a deferred transaction is already open (e.g. the lot row was inserted): its next write takes the lock
+            conn.execute(text("UPDATE die SET id = id WHERE 0"))
+        else:
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+
+class _TestKeyRegistry:
+    """
+    (test_program_id, test_num, test_type) -> test_key.id. A program's existing keys are read once; an
+    unseen test gets its key row on first use, with the text / units / limits of that first result.
+    Share one instance between sinks of the same session.
+    """
+    def __init__(self, session: Session):
+        self.session = session
+        self.ids = {}
+        self._programs = set()
+
+    def create(self, program_id, test_num, test_type, test_txt, units, lo_limit, hi_limit, suite_id):
+        """Key id for a test not in self.ids (existing row of the program, else a new one)."""
+        if program_id not in self._programs:
+            self._programs.add(program_id)
+            for key_id, num, typ in self.session.query(TestKey.id, TestKey.test_num, TestKey.test_type).filter(
+                TestKey.test_program_id == program_id
+            ):
+                self.ids[(program_id, num, typ)] = key_id
+            key_id = self.ids.get((program_id, test_num, test_type))
+            if key_id is not None:
+                return key_id
+        key_id = self.session.execute(insert(TestKey.__table__).values(
+            test_program_id=program_id, test_num=test_num, test_type=test_type, test_txt=test_txt,
+            units=units, lo_limit=lo_limit, hi_limit=hi_limit, test_suite_id=suite_id,
+        )).inserted_primary_key[0]
+        self.ids[(program_id, test_num, test_type)] = key_id
+        return key_id
+
+
+_DIE_COLUMNS = (
+    "id", "lot_id", "wafer_id", "head_num", "site_num", "x_coord", "y_coord", "part_id",
+    "hard_bin", "soft_bin", "part_flg", "num_test", "test_t", "load_file_id",
+)
+_BIN_COLUMNS = ("die_id", "hard_bin", "soft_bin", "hard_bin_name", "soft_bin_name")
+_TEST_ITEM_COLUMNS = ("die_id", "test_key_id", "result", "pass_fail")
+_TEST_ITEM_EXTRA = ("test_num", "test_type")   # buffered for the columnar side-store only
+
+
+_COPY_TABLES = (Die.__table__, Bin.__table__, TestItem.__table__)   # die first: CopyWriter checks it for an initial load
+
+
+# V4 record class name -> StdfToDbSink handler; all other record types are ignored
+_RECORD_HANDLERS = {
+    "Mir": "_on_mir",
+    "Wir": "_on_wir",
+    "Wrr": "_on_wrr",
+    "Pir": "_on_pir",
+    "Prr": "_on_prr",
+    "Ptr": "_on_ptr",
+    "Ftr": "_on_ftr",
+    "Hbr": "_on_hbr",
+    "Sbr": "_on_sbr",
+    "Tsr": "_on_tsr",
+    "Sdr": "_on_sdr",
+    "Mrr": "_on_mrr",
+}
+
+
 class StdfToDbSink:
     """
     Sink that receives pystdf record events and inserts into the relational DB.
     Tracks current lot/wafer/die and buffers PTR/FTR until PRR.
+    Die/Bin/TestItem rows are not ORM objects: die IDs come from a _DieIdAllocator, test
+    keys come from a _TestKeyRegistry and rows are accumulated in columnar batches, written with Core executemany every
+    chunk_size test items (or dies). Call finish() before committing and publish() after.
+    With a columnar_writer, PTR results of each flushed batch also go to the Parquet side-store; with a
+    matrix_writer, to the per-wafer result matrices (written at WRR and in finish()).
+    load_file_id (load registry entry) is stored on every die; lot_pks collects the lots the file wrote to.
     """
-    def __init__(self, session: Session, company_name: str = None, product_name: str = None, stage_name: str = None):
+    def __init__(
+        self,
+        session: Session,
+        company_name: str = None,
+        product_name: str = None,
+        stage_name: str = None,
+        chunk_size: int = None,
+        die_id_allocator: _DieIdAllocator = None,
+        test_keys: _TestKeyRegistry = None,
+        columnar_writer: ColumnarStoreWriter = None,
+        matrix_writer: MatrixStoreWriter = None,
+        copy_writer: CopyWriter = None,
+        load_file_id: int = None,
+    ):
         self.session = session
+        self.load_file_id = load_file_id
+        self.lot_pks = set()
+        self.columnar_writer = columnar_writer
+        self.matrix_writer = matrix_writer
+        self.chunk_size = max(1, int(chunk_size or LOAD_CHUNK_SIZE))
+        self._allocate_die_id = die_id_allocator or _DieIdAllocator(session)
+        self._test_keys = test_keys or _TestKeyRegistry(session)
         self.company_name = company_name or DEFAULT_COMPANY
         self.product_name = product_name or DEFAULT_PRODUCT
         self.stage_name = stage_name or DEFAULT_STAGE
@@ -78,6 +273,16 @@ class StdfToDbSink:
         self._soft_bin_names = {}
         # test_num -> test_suite_id (from TSR)
         self._test_num_to_suite = {}
+        self._die_batch = _ColumnBatch(Die.__table__, _DIE_COLUMNS)
+        self._bin_batch = _ColumnBatch(Bin.__table__, _BIN_COLUMNS)
+        self._test_item_batch = _ColumnBatch(TestItem.__table__, _TEST_ITEM_COLUMNS, _TEST_ITEM_EXTRA)
+        # PostgreSQL: COPY instead of executemany (None on other dialects); a shared writer is finished by its owner
+        self._owns_copy_writer = copy_writer is None
+        self._copy_writer = copy_writer or CopyWriter.for_session(session, _COPY_TABLES)
+        self.summary = SummaryAccumulator()
+        self.rows_written = {"die": 0, "bin": 0, "test_item": 0}
+        self.write_seconds = 0.0
+        self._handlers = {name: getattr(self, meth) for name, meth in _RECORD_HANDLERS.items()}
 
     def _get_bin_name(self, head_num, site_num, bin_num, is_hard=True):
         names = self._hard_bin_names if is_hard else self._soft_bin_names
@@ -126,29 +331,15 @@ class StdfToDbSink:
 
     def before_send(self, data_source, data):
         rec_type, fields = data
-        fd = _field_dict(rec_type, fields)
-        if isinstance(rec_type, V4.Mir):
-            self._on_mir(fd)
-        elif isinstance(rec_type, V4.Wir):
-            self._on_wir(fd)
-        elif isinstance(rec_type, V4.Wrr):
-            self._on_wrr(fd)
-        elif isinstance(rec_type, V4.Pir):
-            self._on_pir(fd)
-        elif isinstance(rec_type, V4.Prr):
-            self._on_prr(fd)
-        elif isinstance(rec_type, V4.Ptr):
-            self._on_ptr(fd)
-        elif isinstance(rec_type, V4.Ftr):
-            self._on_ftr(fd)
-        elif isinstance(rec_type, V4.Hbr):
-            self._on_hbr(fd)
-        elif isinstance(rec_type, V4.Sbr):
-            self._on_sbr(fd)
-        elif isinstance(rec_type, V4.Tsr):
-            self._on_tsr(fd)
-        elif isinstance(rec_type, V4.Sdr):
-            self._on_sdr(fd)
+        handler = self._handlers.get(type(rec_type).__name__)
+        if handler is not None:
+            handler(_field_dict(rec_type, fields))
+
+    def handle(self, rec_name, fd):
+        """Dispatch one already-decoded record (V4 class name, field dict), e.g. from a parse worker."""
+        handler = self._handlers.get(rec_name)
+        if handler is not None:
+            handler(fd)
 
     def _on_sdr(self, fd):
         if not self._lot:
@@ -254,6 +445,13 @@ class StdfToDbSink:
                 )
                 self.session.add(td)
                 self.session.flush()
+            if test_num not in self._test_num_to_suite:
+                # TSRs usually follow the results: attach the suite to keys created without one
+                self.session.query(TestKey).filter(
+                    TestKey.test_program_id == self._test_program.id,
+                    TestKey.test_num == test_num,
+                    TestKey.test_suite_id == None,
+                ).update({TestKey.test_suite_id: suite.id}, synchronize_session=False)
             self._test_num_to_suite[test_num] = suite.id
 
     def _on_mir(self, fd):
@@ -293,6 +491,11 @@ class StdfToDbSink:
             self.session.add(lot)
             self.session.flush()
         self._lot = lot
+        if lot.id not in self.lot_pks:
+            self.lot_pks.add(lot.id)
+            if self.load_file_id is not None:
+                # listed on the registry entry right away, so purging this load finds the lot before any die
+                self.session.get(LoadedFile, self.load_file_id).lot_pks = format_lot_pks(self.lot_pks)
         self._wafer = None
         self._wafer_id_current = None
         self._current_die = None
@@ -340,6 +543,9 @@ class StdfToDbSink:
                 self._wafer.part_cnt = part_cnt
             if good_cnt is not None:
                 self._wafer.good_cnt = good_cnt
+            if self.matrix_writer is not None:
+                self.flush()
+                self.matrix_writer.end_wafer(self._wafer.lot_id, self._wafer.id)
         self._wafer_id_current = None
 
     def _on_pir(self, fd):
@@ -374,85 +580,109 @@ class StdfToDbSink:
             self._ptr_ftr_buffer = []
             return
         wafer_id_fk = self._wafer.id if self._wafer else None
-        die = Die(
-            lot_id=self._lot.id,
-            wafer_id=wafer_id_fk,
-            head_num=head_num,
-            site_num=site_num,
-            x_coord=x_coord,
-            y_coord=y_coord,
-            part_id=part_id,
-            hard_bin=hard_bin,
-            soft_bin=soft_bin,
-            part_flg=part_flg or 0,
-            num_test=num_test,
-            test_t=test_t,
+        die_id = self._allocate_die_id()
+        self._die_batch.append(
+            die_id, self._lot.id, wafer_id_fk, head_num, site_num, x_coord, y_coord, part_id,
+            hard_bin, soft_bin, part_flg or 0, num_test, test_t, self.load_file_id,
         )
-        self.session.add(die)
-        self.session.flush()
-        self._current_die = die
         if hard_bin is not None:
             hard_name = self._get_bin_name(head_num, site_num, hard_bin, is_hard=True)
             soft_name = self._get_bin_name(head_num, site_num, soft_bin, is_hard=False) if soft_bin is not None else ""
-            bin_rec = Bin(
-                die_id=die.id,
-                hard_bin=hard_bin,
-                soft_bin=soft_bin,
-                hard_bin_name=hard_name,
-                soft_bin_name=soft_name,
-            )
-            self.session.add(bin_rec)
+            self._bin_batch.append(die_id, hard_bin, soft_bin, hard_name, soft_name)
+        append_item = self._test_item_batch.append
+        add_test = self.summary.add_test
+        key_ids = self._test_keys.ids
+        create_key = self._test_keys.create
+        lot_pk = self._lot.id
+        prog_pk = self._lot.test_program_id
+        die_failed = False
         for rec_type_name, item_fd in self._ptr_ftr_buffer:
+            test_num = item_fd.get("TEST_NUM") or 0
+            test_txt = (item_fd.get("TEST_TXT") or "").strip()[:512]
+            pass_fail = _test_flg_to_pass_fail(item_fd.get("TEST_FLG"))
+            if pass_fail == 1:
+                die_failed = True
             if rec_type_name == "PTR":
+                key_id = key_ids.get((prog_pk, test_num, "PTR"))
+                if key_id is None:
+                    lo_limit = item_fd.get("LO_LIMIT")
+                    hi_limit = item_fd.get("HI_LIMIT")
+                    key_id = create_key(
+                        prog_pk, test_num, "PTR", test_txt, (item_fd.get("UNITS") or "").strip()[:64],
+                        float(lo_limit) if lo_limit is not None else None,
+                        float(hi_limit) if hi_limit is not None else None,
+                        self._test_num_to_suite.get(test_num),
+                    )
                 result = item_fd.get("RESULT")
-                test_txt = (item_fd.get("TEST_TXT") or "").strip()[:512]
-                units = (item_fd.get("UNITS") or "").strip()[:64]
-                lo_limit = item_fd.get("LO_LIMIT")
-                hi_limit = item_fd.get("HI_LIMIT")
-                test_num = item_fd.get("TEST_NUM") or 0
-                test_flg = item_fd.get("TEST_FLG")
-                if isinstance(test_flg, (list, bytes)):
-                    test_flg = test_flg[0] if test_flg else 0
-                pass_fail = None
-                if test_flg is not None and hasattr(test_flg, "__and__"):
-                    pass_fail = 1 if (test_flg & 0x80) else 0
-                suite_id = self._test_num_to_suite.get(test_num)
-                ti = TestItem(
-                    die_id=die.id,
-                    test_num=test_num,
-                    test_txt=test_txt,
-                    test_type="PTR",
-                    test_suite_id=suite_id,
-                    result=float(result) if result is not None else None,
-                    units=units,
-                    lo_limit=float(lo_limit) if lo_limit is not None else None,
-                    hi_limit=float(hi_limit) if hi_limit is not None else None,
-                    pass_fail=pass_fail,
-                )
-                self.session.add(ti)
+                append_item(die_id, key_id, float(result) if result is not None else None, pass_fail, test_num, "PTR")
+                add_test(lot_pk, wafer_id_fk, test_num, "PTR", test_txt, pass_fail)
             else:
-                test_num = item_fd.get("TEST_NUM") or 0
-                test_txt = (item_fd.get("TEST_TXT") or "").strip()[:512]
-                test_flg = item_fd.get("TEST_FLG")
-                if isinstance(test_flg, (list, bytes)):
-                    test_flg = test_flg[0] if test_flg else 0
-                pass_fail = None
-                if test_flg is not None and hasattr(test_flg, "__and__"):
-                    pass_fail = 1 if (test_flg & 0x80) else 0
-                suite_id = self._test_num_to_suite.get(test_num)
-                ti = TestItem(
-                    die_id=die.id,
-                    test_num=test_num,
-                    test_txt=test_txt,
-                    test_type="FTR",
-                    test_suite_id=suite_id,
-                    result=None,
-                    pass_fail=pass_fail,
-                )
-                self.session.add(ti)
+                key_id = key_ids.get((prog_pk, test_num, "FTR"))
+                if key_id is None:
+                    key_id = create_key(
+                        prog_pk, test_num, "FTR", test_txt, "", None, None, self._test_num_to_suite.get(test_num)
+                    )
+                append_item(die_id, key_id, None, pass_fail, test_num, "FTR")
+                add_test(lot_pk, wafer_id_fk, test_num, "FTR", test_txt, pass_fail)
+        self.summary.add_die(lot_pk, wafer_id_fk, hard_bin, test_t, die_failed)
         self._ptr_ftr_buffer = []
         self._current_die = None
         self._current_die_key = None
+        if len(self._test_item_batch) >= self.chunk_size or len(self._die_batch) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Write buffered Die, Bin, TestItem rows (in FK order) with Core executemany, or COPY on PostgreSQL."""
+        t0 = time.perf_counter()
+        if self.columnar_writer is not None and len(self._test_item_batch):
+            self.columnar_writer.write(self._die_batch.data, self._test_item_batch.data)
+        if self.matrix_writer is not None and len(self._die_batch):
+            self.matrix_writer.write(self._die_batch.data, self._test_item_batch.data)
+        for key, batch in (("die", self._die_batch), ("bin", self._bin_batch), ("test_item", self._test_item_batch)):
+            if not len(batch):
+                continue
+            if self._copy_writer is not None:
+                self._copy_writer.write(batch.table, batch.columns, batch.data)
+            else:
+                self.session.execute(insert(batch.table), batch.records())
+            self.rows_written[key] += len(batch)
+            batch.clear()
+        self.write_seconds += time.perf_counter() - t0
+
+    def finish(self):
+        """
+        Flush remaining rows, merge this load's counts into the summary tables and bump the data
+        version (invalidates dashboard caches on commit).
+        """
+        self.flush()
+        t0 = time.perf_counter()
+        if self._copy_writer is not None and self._owns_copy_writer:
+            self._copy_writer.finish()
+        if self.matrix_writer is not None:
+            self.matrix_writer.finish()
+        self.summary.merge_into(self.session)
+        bump_data_version(self.session)
+        self.write_seconds += time.perf_counter() - t0
+
+    def publish(self):
+        """After the DB commit: make side-store files written by this sink visible."""
+        if self.columnar_writer is not None:
+            self.columnar_writer.publish()
+        if self.matrix_writer is not None:
+            self.matrix_writer.publish()
+
+    def discard(self):
+        """
+        Drop buffered rows and pending side-store files. Rows already written are deleted by
+        LoadRegistry.abandon() (by load_file_id), or go with the rollback of an unregistered load.
+        """
+        for batch in (self._die_batch, self._bin_batch, self._test_item_batch):
+            batch.clear()
+        self.summary.clear()
+        if self.columnar_writer is not None:
+            self.columnar_writer.discard()
+        if self.matrix_writer is not None:
+            self.matrix_writer.discard()
 
     def _on_ptr(self, fd):
         self._ptr_ftr_buffer.append(("PTR", fd))
@@ -460,57 +690,419 @@ class StdfToDbSink:
     def _on_ftr(self, fd):
         self._ptr_ftr_buffer.append(("FTR", fd))
 
-    def after_send(self, data_source, data):
-        rec_type, fields = data
-        if isinstance(rec_type, V4.Mrr) and self._lot:
-            fd = _field_dict(rec_type, fields)
+    def _on_mrr(self, fd):
+        if self._lot:
             finish_t = fd.get("FINISH_T")
             self._lot.finish_t = _stdf_time_to_datetime(finish_t)
 
 
+def parse_stdf(src, sink, parser=None):
+    """
+    Feed the records StdfToDbSink handles from src (as yielded by stdf_io.open_stdf) to sink.handle().
+    "fast" streams them with stdf_reader (other record types skipped undecoded, PTR/FTR fast path);
+    "pystdf" runs pystdf's Parser. Returns the number of records handled (None with pystdf).
+    """
+    if (parser or STDF_PARSER) == "pystdf":
+        p = Parser(inp=io.BytesIO(src) if isinstance(src, (bytes, bytearray)) else src)
+        p.addSink(sink)
+        p.parse()
+        return None
+    handle = sink.handle
+    n = 0
+    for n, (rec_name, fd) in enumerate(iter_records(src, _RECORD_HANDLERS), 1):
+        handle(rec_name, fd)
+    return n
+
+
+def _load_report(rows_written, parse_seconds, write_seconds):
+    """Summarize a load: rows per table, timings and rows/second against LOAD_TARGET_ROWS_PER_SEC."""
+    rows = sum(rows_written.values())
+    total_seconds = parse_seconds + write_seconds
+    rows_per_sec = rows / total_seconds if total_seconds > 0 else 0.0
+    return {
+        **rows_written,
+        "rows": rows,
+        "parse_seconds": round(parse_seconds, 3),
+        "write_seconds": round(write_seconds, 3),
+        "seconds": round(total_seconds, 3),
+        "rows_per_sec": round(rows_per_sec, 1),
+        "target_rows_per_sec": LOAD_TARGET_ROWS_PER_SEC,
+        "meets_target": rows_per_sec >= LOAD_TARGET_ROWS_PER_SEC,
+    }
+
+
+def format_load_report(report):
+    """One-line human readable summary of a load report."""
+    if report.get("action") == "skip":
+        return "unchanged since it was loaded (load registry), skipped"
+    status = "OK" if report["meets_target"] else "BELOW TARGET"
+    return (
+        f"{report['rows']} rows (die={report['die']}, bin={report['bin']}, test_item={report['test_item']}) "
+        f"in {report['seconds']:.2f}s (parse {report['parse_seconds']:.2f}s, write {report['write_seconds']:.2f}s): "
+        f"{report['rows_per_sec']:.0f} rows/s, target {report['target_rows_per_sec']:.0f} rows/s [{status}]"
+        + (", replaced the previous load of this file" if report.get("action") == "replace" else "")
+    )
+
+
 def load_stdf(
     stdf_path,
     db_url=None,
     company_name=None,
     product_name=None,
     stage_name=None,
+    chunk_size=None,
+    parser=None,
+    force=False,
+    replace_upload=False,
 ):
     """
     Parse STDF file and load into DB. Creates tables if needed.
+    parser: "fast" (stdf_reader, default from STDF_PARSER) or "pystdf".
+    Paths and uploaded files go through the load registry (load_registry.py): an unchanged file is skipped,
+    a changed one replaces the data of its previous load; force=True re-loads an unchanged file. Uploads are
+    matched by name and content, so one only replaces an earlier upload of its name with replace_upload=True.
+    Returns a load report dict (rows per table, parse/write seconds, rows_per_sec vs target, action).
     """
-    path = Path(stdf_path)
-    if not path.is_file():
+    if isinstance(stdf_path, (str, Path)) and not Path(stdf_path).is_file():
         raise FileNotFoundError(f"STDF file not found: {stdf_path}")
-    engine = get_engine(db_url)
-    init_db(engine)
-    from sqlalchemy.orm import sessionmaker
+    engine = get_shared_engine(db_url)
+    ensure_db(engine)
     SessionLocal = sessionmaker(bind=engine, autoflush=True)
     session = SessionLocal()
-    sink = StdfToDbSink(
-        session,
-        company_name=company_name,
-        product_name=product_name,
-        stage_name=stage_name,
-    )
-    parser = Parser(inp=open(path, "rb"))
-    parser.addSink(sink)
+    registry = LoadRegistry(session) if is_registrable(stdf_path) else None
+    plan = registry.plan(stdf_path, force=force, replace_upload=replace_upload) if registry is not None else None
+    if plan is not None and plan.action == "skip":
+        registry.skip(plan)
+        session.commit()
+        session.close()
+        return {**_load_report(dict.fromkeys(("die", "bin", "test_item"), 0), 0.0, 0.0), "action": "skip"}
+    columnar_writer = ColumnarStoreWriter.for_db(db_url)
+    matrix_writer = MatrixStoreWriter.for_db(db_url)
+    t0 = time.perf_counter()
+    try:
+        entry = registry.begin(plan, (columnar_writer, matrix_writer)) if plan is not None else None
+        sink = StdfToDbSink(
+            session,
+            company_name=company_name,
+            product_name=product_name,
+            stage_name=stage_name,
+            chunk_size=chunk_size,
+            columnar_writer=columnar_writer,
+            matrix_writer=matrix_writer,
+            load_file_id=entry.id if entry is not None else None,
+        )
+        with open_stdf(stdf_path) as src:
+            records = parse_stdf(src, sink, parser)
+        sink.finish()
+        if entry is not None:
+            t_registry = time.perf_counter()
+            registry.complete(plan, entry, sink.rows_written, sink.lot_pks, records)
+            sink.write_seconds += time.perf_counter() - t_registry
+    except Exception:
+        for writer in (columnar_writer, matrix_writer):
+            if writer is not None:
+                writer.discard()
+        session.close()
+        raise
+    t_commit = time.perf_counter()
+    session.commit()
+    sink.publish()
+    session.close()
+    sink.write_seconds += time.perf_counter() - t_commit
+    parse_seconds = time.perf_counter() - t0 - sink.write_seconds
+    return {**_load_report(sink.rows_written, parse_seconds, sink.write_seconds), "action": plan.action if plan else "load"}
+
+
+# ---------- Batch loader: parse in a process pool, single DB writer ----------
+_RECORD_BATCH_SIZE = 5000
+_parse_queue = None
+_parse_stop = None
+
+
+class _RecordForwarder:
+    """pystdf sink for parse workers: forwards records StdfToDbSink handles as (name, field dict) batches."""
+    def __init__(self, emit, batch_size=_RECORD_BATCH_SIZE):
+        self.emit = emit
+        self.batch_size = batch_size
+        self.batch = []
+        self.count = 0
+
+    def before_send(self, data_source, data):
+        rec_type, fields = data
+        name = type(rec_type).__name__
+        if name in _RECORD_HANDLERS:
+            self.handle(name, _field_dict(rec_type, fields))
+
+    def handle(self, rec_name, fd):
+        self.batch.append((rec_name, fd))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            self.count += len(self.batch)
+            self.emit(self.batch)
+            self.batch = []
+
+
+class _Stopped(Exception):
+    """Raised in a parse worker when the writer has given up on the batch."""
+
+
+def _init_parse_worker(q, stop):
+    global _parse_queue, _parse_stop
+    _parse_queue = q
+    _parse_stop = stop
+
+
+def _emit_batch(file_idx, batch):
+    if _parse_stop.is_set():
+        raise _Stopped()
+    _parse_queue.put(("batch", file_idx, batch))
+
+
+def _parse_worker(file_idx, path, parser=None):
+    """Runs in a pool process: parse one STDF file and stream record batches to the writer queue."""
+    t0 = time.perf_counter()
     try:
-        parser.parse()
-    finally:
-        parser.inp.close()
+        forwarder = _RecordForwarder(lambda batch: _emit_batch(file_idx, batch))
+        with open_stdf(path) as src:
+            parse_stdf(src, forwarder, parser)
+        forwarder.flush()
+        _parse_queue.put(("done", file_idx, (time.perf_counter() - t0, forwarder.count)))
+    except _Stopped:
+        pass
+    except Exception as e:
+        _parse_queue.put(("error", file_idx, f"{type(e).__name__}: {e}"))
+
+
+def expand_stdf_inputs(inputs):
+    """
+    Resolve files, directories (*.stdf / *.std inside, also .gz / .bz2 / .zip) and glob patterns into a
+    sorted, de-duplicated path list.
+    """
+    if isinstance(inputs, (str, Path)):
+        inputs = [inputs]
+    paths = []
+    for item in inputs:
+        item = str(item)
+        p = Path(item)
+        if p.is_dir():
+            paths += [c for c in p.iterdir() if c.is_file() and is_stdf_name(c.name)]
+        elif p.is_file():
+            paths.append(p)
+        else:
+            paths += [Path(m) for m in glob.glob(item, recursive=True) if Path(m).is_file()]
+    seen = set()
+    out = []
+    for p in sorted(paths):
+        key = p.resolve()
+        if key not in seen:
+            seen.add(key)
+            out.append(p)
+    return out
+
+
+def load_stdf_batch(
+    inputs,
+    db_url=None,
+    company_name=None,
+    product_name=None,
+    stage_name=None,
+    workers=None,
+    chunk_size=None,
+    parser=None,
+    force=False,
+):
+    """
+    Load many STDF files: parsing (see parse_stdf) runs in a process pool, decoded record batches are funneled
+    through a queue to this process, which is the only one holding a DB connection (no SQLite lock
+    contention). All files share one session and a file's registry entry is marked done in the commit after
+    its last batch, so that commit also makes rows of files still in flight durable; those carry the
+    load_file_id of a "loading" entry and are in no summary table yet. A file that fails to parse, and every
+    open file when the writer itself fails, is purged by load_file_id (Die/Bin/TestItem, and Lot/Wafer rows
+    left without dies). If the process dies instead, the next run purges the "loading" entries of the
+    files it loads again (load_registry.py), so rerunning the same batch resumes it.
+    Files the load registry knows as unchanged are skipped before parsing (force=True re-loads them), changed
+    files replace their previous data, and files of an interrupted run that never completed are loaded again.
+    Returns {"files": [per-file report], "total": {...}}; per-file reports carry parse/write seconds and action.
+    """
+    paths = expand_stdf_inputs(inputs)
+    if not paths:
+        raise FileNotFoundError(f"No STDF files found for: {inputs}")
+    engine = get_shared_engine(db_url)
+    ensure_db(engine)
+    session = sessionmaker(bind=engine, autoflush=True, expire_on_commit=False)()
+    registry = LoadRegistry(session)
+    plans = [registry.plan(p, force=force) for p in paths]
+    for plan in plans:
+        if plan.action == "skip":
+            registry.skip(plan)
     session.commit()
+    todo = [i for i, plan in enumerate(plans) if plan.action != "skip"]
+    workers = max(1, min(int(workers or LOAD_WORKERS), len(todo)))
+    allocate_die_id = _DieIdAllocator(session)
+    test_keys = _TestKeyRegistry(session)
+    # one COPY writer for the batch; files commit one by one, so the indexes stay in place (no deferred rebuild)
+    copy_writer = CopyWriter.for_session(session, _COPY_TABLES, defer_indexes=False)
+    reports = [
+        {"path": str(p), "records": 0, "parse_seconds": 0.0, "error": None, "action": plan.action}
+        for p, plan in zip(paths, plans)
+    ]
+    sinks = {}
+    entries = {}   # file idx -> LoadedFile of the running load
+    writer_seconds = {}   # file idx -> time this process spent handling/writing/committing it
+
+    def sink_for(idx):
+        if idx not in sinks:
+            columnar_writer = ColumnarStoreWriter.for_db(db_url)
+            matrix_writer = MatrixStoreWriter.for_db(db_url)
+            entries[idx] = registry.begin(plans[idx], (columnar_writer, matrix_writer))
+            sinks[idx] = StdfToDbSink(
+                session,
+                company_name=company_name,
+                product_name=product_name,
+                stage_name=stage_name,
+                chunk_size=chunk_size,
+                die_id_allocator=allocate_die_id,
+                test_keys=test_keys,
+                columnar_writer=columnar_writer,
+                matrix_writer=matrix_writer,
+                copy_writer=copy_writer,
+                load_file_id=entries[idx].id,
+            )
+        return sinks[idx]
+
+    t_start = time.perf_counter()
+    ctx = multiprocessing.get_context()
+    q = ctx.Queue(maxsize=workers * 4)
+    stop = ctx.Event()
+    pending = set(todo)
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=ctx, initializer=_init_parse_worker, initargs=(q, stop)
+    ) as pool:
+        futures = {pool.submit(_parse_worker, i, str(paths[i]), parser): i for i in todo}
+        try:
+            while pending:
+                try:
+                    kind, idx, payload = q.get(timeout=1.0)
+                except queue.Empty:
+                    # A worker that died without reporting (e.g. killed) leaves its future failed
+                    for fut, idx in futures.items():
+                        if idx in pending and fut.done() and fut.exception() is not None:
+                            q.put(("error", idx, f"worker failed: {fut.exception()}"))
+                    continue
+                if idx not in pending:
+                    continue
+                sink = sink_for(idx)
+                t0 = time.perf_counter()
+                if kind == "batch":
+                    for rec_name, fd in payload:
+                        sink.handle(rec_name, fd)
+                elif kind == "done":
+                    reports[idx]["parse_seconds"], reports[idx]["records"] = payload
+                    sink.finish()
+                    registry.complete(plans[idx], entries[idx], sink.rows_written, sink.lot_pks, reports[idx]["records"])
+                    session.commit()
+                    sink.publish()
+                    pending.discard(idx)
+                else:
+                    sink.discard()
+                    registry.abandon(entries[idx])
+                    session.commit()
+                    reports[idx]["error"] = payload
+                    pending.discard(idx)
+                writer_seconds[idx] = writer_seconds.get(idx, 0.0) + time.perf_counter() - t0
+        except BaseException:
+            # Stop the parse workers and empty the queue they may be blocked on, so leaving the pool cannot hang
+            stop.set()
+            pool.shutdown(wait=False, cancel_futures=True)
+            while True:
+                try:
+                    q.get(timeout=0.1)
+                except queue.Empty:
+                    if all(fut.done() for fut in futures):
+                        break
+            session.rollback()
+            try:
+                for idx in pending & sinks.keys():
+                    sinks[idx].discard()
+                    registry.abandon(entries[idx])
+                session.commit()
+            except Exception:
+                session.rollback()   # entries stay "loading": purged when the files are loaded again
+            session.close()
+            raise
     session.close()
-    return True
+    wall_seconds = time.perf_counter() - t_start
+    rows_total = {"die": 0, "bin": 0, "test_item": 0}
+    for idx, rep in enumerate(reports):
+        sink = sinks.get(idx)
+        rows = sink.rows_written if sink and not rep["error"] else {"die": 0, "bin": 0, "test_item": 0}
+        rep.update(_load_report(rows, rep["parse_seconds"], writer_seconds.get(idx, 0.0)))
+        for k in rows_total:
+            rows_total[k] += rows[k]
+    rows = sum(rows_total.values())
+    total = {
+        **rows_total,
+        "rows": rows,
+        "files": len(paths),
+        "failed": sum(1 for r in reports if r["error"]),
+        "skipped": sum(1 for r in reports if r["action"] == "skip"),
+        "workers": workers,
+        "wall_seconds": round(wall_seconds, 3),
+        "rows_per_sec": round(rows / wall_seconds, 1) if wall_seconds > 0 else 0.0,
+        "files_per_sec": round(len(paths) / wall_seconds, 3) if wall_seconds > 0 else 0.0,
+    }
+    return {"files": reports, "total": total}
+
+
+def _format_batch_report(result):
+    lines = []
+    for rep in result["files"]:
+        if rep["error"]:
+            lines.append(f"  FAILED {rep['path']}: {rep['error']}")
+        elif rep["action"] == "skip":
+            lines.append(f"  {rep['path']}: unchanged, skipped")
+        else:
+            lines.append(
+                f"  {rep['path']}: {rep['records']} records, {rep['rows']} rows, "
+                f"parse {rep['parse_seconds']:.2f}s, write {rep['write_seconds']:.2f}s"
+                + (" (replaced previous load)" if rep["action"] == "replace" else "")
+            )
+    t = result["total"]
+    lines.append(
+        f"{t['files']} files ({t['failed']} failed, {t['skipped']} unchanged), {t['rows']} rows in {t['wall_seconds']:.2f}s "
+        f"with {t['workers']} parse workers: {t['rows_per_sec']:.0f} rows/s, {t['files_per_sec']:.2f} files/s"
+    )
+    return "\n".join(lines)
 
 
 if __name__ == "__main__":
     import sys
-    if len(sys.argv) < 2:
-        print("Usage: python stdf_loader.py <file.stdf> [company] [product] [stage]")
+    args = sys.argv[1:]
+    force = "--force" in args
+    args = [a for a in args if a != "--force"]
+    if args and args[0] == "--batch":
+        workers = None
+        if "--workers" in args:
+            i = args.index("--workers")
+            workers = int(args[i + 1])
+            del args[i:i + 2]
+        if len(args) < 2:
+            print("Usage: python stdf_loader.py --batch <dir|glob|file>... [--workers N] [--force]")
+            sys.exit(1)
+        result = load_stdf_batch(args[1:], workers=workers, force=force)
+        print(_format_batch_report(result))
+        sys.exit(1 if result["total"]["failed"] else 0)
+    if len(args) < 1:
+        print("Usage: python stdf_loader.py <file.stdf> [company] [product] [stage] [--force]")
+        print("       python stdf_loader.py --batch <dir|glob|file>... [--workers N] [--force]")
         sys.exit(1)
-    stdf_file = sys.argv[1]
-    company = sys.argv[2] if len(sys.argv) > 2 else None
-    product = sys.argv[3] if len(sys.argv) > 3 else None
-    stage = sys.argv[4] if len(sys.argv) > 4 else None
-    load_stdf(stdf_file, company_name=company, product_name=product, stage_name=stage)
+    stdf_file = args[0]
+    company = args[1] if len(args) > 1 else None
+    product = args[2] if len(args) > 2 else None
+    stage = args[3] if len(args) > 3 else None
+    report = load_stdf(stdf_file, company_name=company, product_name=product, stage_name=stage, force=force)
+    print(format_load_report(report))
     print("Done.")
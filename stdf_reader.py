@@ -0,0 +1,219 @@
+"""
+Streaming STDF v4 reader for the loader. The caller declares which record types it needs (V4 class names,
+e.g. "Ptr", "Prr"); other records are skipped by header length without decoding their payload.
+PTR and FTR have a fast path that decodes only the fields the loader stores; everything else is decoded
+with the pystdf V4 field specs, giving the same field values as pystdf's Parser.
+"""
+import mmap
+import struct
+
+from pystdf import V4
+from pystdf.Types import InitialSequenceException, packFormatMap
+
+_READ_SIZE = 1 << 20
+
+
+class _EndOfRecord(Exception):
+    pass
+
+
+def _cn(buf, pos, end):
+    """Cn at pos -> (str, next pos). Raises _EndOfRecord like pystdf when the record is short."""
+    if pos >= end:
+        raise _EndOfRecord()
+    n = buf[pos]
+    pos += 1
+    if n > end - pos:
+        raise _EndOfRecord()
+    return buf[pos:pos + n].decode("ascii", errors="replace"), pos + n
+
+
+class _FieldDecoder:
+    """Generic decoder for one V4 record type built from its fieldMap (same semantics as pystdf.IO.Parser)."""
+    def __init__(self, rec_type, endian):
+        self.names = [name for name, _ in rec_type.fieldMap]
+        self.readers = [self._reader(typ, endian) for _, typ in rec_type.fieldMap]
+
+    def _reader(self, typ, endian):
+        if typ.startswith("k"):
+            idx, elem = int(typ[1:-2]), typ[-2:]   # e.g. k12U2: array of U2, count in field 12
+            elem_reader = self._reader("U1" if elem == "N1" else elem, endian)
+
+            def read_array(buf, pos, end, fields):
+                count = fields[idx] or 0
+                if elem == "N1":
+                    count = (count + 1) // 2
+                out = []
+                for _ in range(count):
+                    val, pos = elem_reader(buf, pos, end, fields)
+                    out.append(val)
+                return out, pos
+            return read_array
+        if typ == "Cn":
+            return lambda buf, pos, end, fields: _cn(buf, pos, end)
+        if typ in ("Bn", "Dn"):
+            len_fmt = struct.Struct(endian + ("B" if typ == "Bn" else "H"))
+
+            def read_bytes(buf, pos, end, fields):
+                if pos + len_fmt.size > end:
+                    raise _EndOfRecord()
+                n, = len_fmt.unpack_from(buf, pos)
+                pos += len_fmt.size
+                if typ == "Dn":
+                    n = (n + 7) // 8
+                if n > end - pos:
+                    raise _EndOfRecord()
+                return list(buf[pos:pos + n]), pos + n
+            return read_bytes
+        if typ == "Vn":
+            def read_unsupported(buf, pos, end, fields):
+                raise _EndOfRecord()   # GDR generic data is not used by the loader
+            return read_unsupported
+        fmt = struct.Struct(endian + packFormatMap[typ])
+        as_str = typ == "C1"
+
+        def read_fixed(buf, pos, end, fields):
+            if pos + fmt.size > end:
+                raise _EndOfRecord()
+            val, = fmt.unpack_from(buf, pos)
+            return (val.decode("ascii", errors="replace") if as_str else val), pos + fmt.size
+        return read_fixed
+
+    def __call__(self, buf, pos, end):
+        fields = []
+        try:
+            for read in self.readers:
+                val, pos = read(buf, pos, end, fields)
+                fields.append(val)
+        except _EndOfRecord:
+            pass
+        fields += [None] * (len(self.names) - len(fields))
+        return dict(zip(self.names, fields))
+
+
+def _ptr_fast(endian):
+    """PTR: TEST_NUM, HEAD_NUM, SITE_NUM, TEST_FLG, RESULT, TEST_TXT, LO_LIMIT, HI_LIMIT, UNITS only."""
+    head = struct.Struct(endian + "IBBBBf")
+    limits = struct.Struct(endian + "Bbbbff")
+
+    def decode(buf, pos, end):
+        # fields missing from a short record stay None, as with pystdf
+        test_num = head_num = site_num = test_flg = result = test_txt = lo = hi = units = None
+        try:
+            if pos + head.size > end:
+                raise _EndOfRecord()
+            test_num, head_num, site_num, test_flg, _, result = head.unpack_from(buf, pos)
+            test_txt, p = _cn(buf, pos + head.size, end)
+            _, p = _cn(buf, p, end)   # ALARM_ID
+            if p + limits.size > end:
+                raise _EndOfRecord()
+            _, _, _, _, lo, hi = limits.unpack_from(buf, p)
+            units, _ = _cn(buf, p + limits.size, end)
+        except _EndOfRecord:
+            pass
+        return {
+            "TEST_NUM": test_num, "HEAD_NUM": head_num, "SITE_NUM": site_num, "TEST_FLG": test_flg,
+            "RESULT": result, "TEST_TXT": test_txt, "LO_LIMIT": lo, "HI_LIMIT": hi, "UNITS": units,
+        }
+    return decode
+
+
+def _ftr_fast(endian, generic):
+    """FTR: TEST_NUM, HEAD_NUM, SITE_NUM, TEST_FLG, TEST_TXT only (arrays and FAIL_PIN are skipped)."""
+    head = struct.Struct(endian + "IBBBBIIIIiihHH")
+    u2 = struct.Struct(endian + "H")
+
+    def decode(buf, pos, end):
+        vals = (None,) * 4
+        test_txt = None
+        try:
+            if pos + head.size > end:
+                return generic(buf, pos, end)   # short fixed part: decode field by field
+            vals = head.unpack_from(buf, pos)
+            rtn_icnt, pgm_icnt = vals[12], vals[13]
+            # skip RTN_INDX, RTN_STAT, PGM_INDX, PGM_STAT
+            p = pos + head.size + 2 * rtn_icnt + (rtn_icnt + 1) // 2 + 2 * pgm_icnt + (pgm_icnt + 1) // 2
+            if p + 2 > end:
+                raise _EndOfRecord()
+            p += 2 + (u2.unpack_from(buf, p)[0] + 7) // 8   # FAIL_PIN
+            for _ in range(3):   # VECT_NAM, TIME_SET, OP_CODE
+                _, p = _cn(buf, p, end)
+            test_txt, _ = _cn(buf, p, end)
+        except _EndOfRecord:
+            pass
+        return {"TEST_NUM": vals[0], "HEAD_NUM": vals[1], "SITE_NUM": vals[2], "TEST_FLG": vals[3], "TEST_TXT": test_txt}
+    return decode
+
+
+_REC_BY_NAME = {type(r).__name__: r for r in V4.records}
+
+
+def _decoders(rec_names, endian, fast):
+    out = {}
+    for name in rec_names:
+        rec = _REC_BY_NAME[name]
+        if fast and name == "Ptr":
+            dec = _ptr_fast(endian)
+        elif fast and name == "Ftr":
+            dec = _ftr_fast(endian, _FieldDecoder(rec, endian))
+        else:
+            dec = _FieldDecoder(rec, endian)
+        out[(rec.typ, rec.sub)] = (name, dec)
+    return out
+
+
+def _read(f, n):
+    """Read up to n bytes, looping over short reads (pipes, decompressors)."""
+    chunks = []
+    while n > 0:
+        chunk = f.read(n)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b"".join(chunks)
+
+
+def _scan(buf, pos, hdr, decoders):
+    """Yield decoded records of buf from pos up to the first incomplete record; returns that offset."""
+    n = len(buf)
+    while pos + 4 <= n:
+        rec_len, typ, sub = hdr.unpack_from(buf, pos)
+        end = pos + 4 + rec_len
+        if end > n:
+            break
+        entry = decoders.get((typ, sub))
+        if entry is not None:
+            yield entry[0], entry[1](buf, pos + 4, end)
+        pos = end
+    return pos
+
+
+def iter_records(source, rec_names, fast: bool = True, read_size: int = _READ_SIZE):
+    """
+    Yield (V4 class name, field dict) for records of the requested types. source is a binary file object
+    (read in read_size chunks) or a whole-file buffer (bytes / bytearray / mmap, decoded in place).
+    Other records are skipped unread. A record cut short by end of file is dropped (pystdf may emit
+    it partially decoded); a truncated record header raises ValueError.
+    """
+    in_memory = isinstance(source, (bytes, bytearray, mmap.mmap))
+    buf = source if in_memory else _read(source, read_size)
+    if not buf:
+        return
+    if len(buf) < 5 or buf[2] != 0 or buf[3] != 10:
+        raise InitialSequenceException()
+    endian = "<" if buf[4] == 2 else ">"
+    hdr = struct.Struct(endian + "HBB")
+    decoders = _decoders(rec_names, endian, fast)
+    while True:
+        pos = yield from _scan(buf, 0, hdr, decoders)
+        rest = buf[pos:]
+        more = b""
+        if not in_memory:
+            need = 4 + hdr.unpack_from(rest, 0)[0] if len(rest) >= 4 else 4
+            more = _read(source, max(read_size, need - len(rest)))
+        if not more:
+            if 0 < len(rest) < 4:
+                raise ValueError("truncated STDF record header")
+            return   # end of data; an incomplete last record is dropped
+        buf = rest + more
@@ -0,0 +1,197 @@
+"""
+Bounded-memory statistics over value chunks: count / mean / variance (Welford, merged per chunk with Chan's
+formula), min / max and approximate quantiles (KLL sketch). Memory per group is O(STDF_QUANTILE_SKETCH_K)
+whatever the number of values, so the Lot-to-Lot box plots and stats tables no longer hold every PTR result.
+Quantiles are exact until a group exceeds the sketch capacity, then within about 0.5% in rank at K = 200.
+"""
+from typing import Dict, Iterable, Tuple
+
+import numpy as np
+
+from config import QUANTILE_SKETCH_K
+
+
+class RunningStats:
+    """Count, mean, sum of squared deviations (Welford / Chan), min and max of a stream of chunks."""
+    __slots__ = ("n", "mean", "m2", "min", "max")
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, values: np.ndarray):
+        if values.size:
+            mean = float(values.mean(dtype=np.float64))
+            m2 = float(np.square(values - mean, dtype=np.float64).sum())
+            self._combine(values.size, mean, m2, float(values.min()), float(values.max()))
+
+    def merge(self, other: "RunningStats"):
+        if other.n:
+            self._combine(other.n, other.mean, other.m2, other.min, other.max)
+
+    def _combine(self, n_b, mean_b, m2_b, min_b, max_b):
+        n = self.n + n_b
+        delta = mean_b - self.mean
+        self.mean += delta * n_b / n
+        self.m2 += m2_b + delta * delta * self.n * n_b / n
+        self.n = n
+        self.min = min(self.min, min_b)
+        self.max = max(self.max, max_b)
+
+    @property
+    def std(self):
+        """Sample standard deviation (ddof=1, as pandas); 0 for fewer than two values."""
+        return float(np.sqrt(self.m2 / (self.n - 1))) if self.n > 1 else 0.0
+
+
+class QuantileSketch:
+    """
+    KLL quantile sketch: level h holds items that weigh 2**h, with capacity k * (2/3)**depth. While the
+    sketch holds more than its total capacity, the lowest over-full level is sorted and every other item
+    (random offset) moves one level up. Compaction is seeded, so the same input gives the same quantiles.
+    """
+    def __init__(self, k: int = QUANTILE_SKETCH_K, seed: int = 0):
+        self.k = max(8, int(k))
+        self.n = 0
+        self.levels = [np.empty(0)]
+        self._rng = np.random.default_rng(seed)
+
+    def update(self, values: np.ndarray):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[~np.isnan(values)]
+        if values.size:
+            self.n += values.size
+            self.levels[0] = np.concatenate([self.levels[0], values])
+            self._compress()
+
+    def merge(self, other: "QuantileSketch"):
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        for h, items in enumerate(other.levels):
+            self.levels[h] = np.concatenate([self.levels[h], items])
+        self.n += other.n
+        self._compress()
+
+    def _capacity(self, h):
+        return max(2, int(np.ceil(self.k * (2 / 3) ** (len(self.levels) - h - 1))))
+
+    def _compress(self):
+        # compact the lowest over-full level while the sketch holds more than its total capacity
+        while len(self) > sum(self._capacity(h) for h in range(len(self.levels))):
+            h = next(h for h in range(len(self.levels)) if len(self.levels[h]) > self._capacity(h))
+            items = np.sort(self.levels[h])
+            keep_odd = items.size % 2   # an odd item out stays on this level, so no weight is lost
+            self.levels[h] = items[:keep_odd]
+            promoted = items[keep_odd + int(self._rng.integers(2))::2]
+            if h + 1 == len(self.levels):
+                self.levels.append(np.empty(0))
+            self.levels[h + 1] = np.concatenate([self.levels[h + 1], promoted])
+
+    def _weighted(self):
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(lv), 2.0 ** h) for h, lv in enumerate(self.levels)])
+        order = np.argsort(items, kind="stable")
+        return items[order], np.cumsum(weights[order])
+
+    def quantiles(self, qs):
+        """Values at the quantiles qs (0..1); exact (linear interpolation, as numpy) before any compaction."""
+        qs = np.asarray(qs, dtype=np.float64)
+        if not self.n:
+            return np.full(qs.shape, np.nan)
+        if len(self.levels) == 1:
+            return np.quantile(self.levels[0], qs)
+        items, cum = self._weighted()
+        idx = np.searchsorted(cum, qs * cum[-1], side="left")
+        return items[np.clip(idx, 0, len(items) - 1)]
+
+    def smallest_at_least(self, x):
+        items = np.concatenate(self.levels)
+        items = items[items >= x]
+        return float(items.min()) if items.size else None
+
+    def largest_at_most(self, x):
+        items = np.concatenate(self.levels)
+        items = items[items <= x]
+        return float(items.max()) if items.size else None
+
+    def __len__(self):
+        return sum(len(lv) for lv in self.levels)
+
+
+class StreamStats:
+    """RunningStats plus a QuantileSketch of one group: summary() for stats tables, box() for box plots."""
+    __slots__ = ("moments", "sketch")
+
+    def __init__(self, k: int = QUANTILE_SKETCH_K):
+        self.moments = RunningStats()
+        self.sketch = QuantileSketch(k)
+
+    def update(self, values):
+        values = np.asarray(values)
+        values = values[~np.isnan(values)]
+        self.moments.update(values)
+        self.sketch.update(values)
+
+    def merge(self, other: "StreamStats"):
+        self.moments.merge(other.moments)
+        self.sketch.merge(other.sketch)
+        return self
+
+    @property
+    def n(self):
+        return self.moments.n
+
+    def summary(self):
+        """N, Mean, Std, Min, Q1, Median, Q3, Max."""
+        m = self.moments
+        q1, median, q3 = self.sketch.quantiles([0.25, 0.5, 0.75])
+        return {
+            "N": m.n, "Mean": m.mean, "Std": m.std, "Min": m.min,
+            "Q1": float(q1), "Median": float(median), "Q3": float(q3), "Max": m.max,
+        }
+
+    def box(self):
+        """
+        Box plot statistics: quartiles, mean, std and Tukey fences (the most extreme sketch values within
+        1.5 IQR of the box, or the exact min / max when inside); min / max beyond the fences are outliers.
+        """
+        s = self.summary()
+        iqr = s["Q3"] - s["Q1"]
+        lo, hi = s["Q1"] - 1.5 * iqr, s["Q3"] + 1.5 * iqr
+        lower = s["Min"] if s["Min"] >= lo else self.sketch.smallest_at_least(lo)
+        upper = s["Max"] if s["Max"] <= hi else self.sketch.largest_at_most(hi)
+        return {
+            "q1": s["Q1"], "median": s["Median"], "q3": s["Q3"], "mean": s["Mean"], "sd": s["Std"],
+            "lowerfence": s["Q1"] if lower is None else min(lower, s["Q1"]),
+            "upperfence": s["Q3"] if upper is None else max(upper, s["Q3"]),
+            "outliers": [v for v in (s["Min"], s["Max"]) if v < lo or v > hi],
+        }
+
+
+def group_stats(chunks: Iterable[Tuple[object, np.ndarray]], k: int = QUANTILE_SKETCH_K) -> Dict[object, StreamStats]:
+    """
+    {group: StreamStats} from (group, values) chunks, in first-seen group order. NaN is dropped and a group
+    only appears once it has a value, so an all-NaN or empty group never reaches summary() / box() with n=0.
+    """
+    out = {}
+    for key, values in chunks:
+        values = np.asarray(values)
+        values = values[~np.isnan(values)]
+        if not values.size:
+            continue
+        stats = out.get(key)
+        if stats is None:
+            stats = out[key] = StreamStats(k)
+        stats.update(values)
+    return out
+
+
+def merged(stats: Iterable[StreamStats], k: int = QUANTILE_SKETCH_K) -> StreamStats:
+    """One StreamStats over several groups (the inputs are left unchanged)."""
+    out = StreamStats(k)
+    for s in stats:
+        out.merge(s)
+    return out
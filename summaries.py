@@ -0,0 +1,138 @@
+"""
+Pre-aggregated yield/fail summary tables (LotSummary, WaferSummary, TestSummary, BinCount).
+The loader accumulates counts per file and merges them at the end of each load; rebuild_summaries()
+recomputes them from die/test_item for existing DBs or after lots are replaced.
+"""
+from sqlalchemy import case, delete, func
+from sqlalchemy.orm import Session
+
+from db_models import Die, TestItem, TestKey, LotSummary, WaferSummary, TestSummary, BinCount
+
+
+class SummaryAccumulator:
+    """In-memory counts for one load, keyed by (lot pk, wafer pk or None)."""
+    def __init__(self):
+        self.wafers = {}   # (lot, wafer) -> [die_count, fail_die_count, test_time_sum]
+        self.tests = {}    # (lot, wafer, test_num, test_type) -> [exec_count, fail_count, test_txt]
+        self.bins = {}     # (lot, wafer, hard_bin) -> die_count
+
+    def add_die(self, lot_pk, wafer_pk, hard_bin, test_t, failed):
+        w = self.wafers.get((lot_pk, wafer_pk))
+        if w is None:
+            w = self.wafers[(lot_pk, wafer_pk)] = [0, 0, 0]
+        w[0] += 1
+        w[1] += 1 if failed else 0
+        w[2] += test_t or 0
+        if hard_bin is not None:
+            key = (lot_pk, wafer_pk, hard_bin)
+            self.bins[key] = self.bins.get(key, 0) + 1
+
+    def add_test(self, lot_pk, wafer_pk, test_num, test_type, test_txt, pass_fail):
+        key = (lot_pk, wafer_pk, test_num, test_type)
+        t = self.tests.get(key)
+        if t is None:
+            t = self.tests[key] = [0, 0, test_txt]
+        elif test_txt and not t[2]:
+            t[2] = test_txt
+        t[0] += 1
+        if pass_fail == 1:
+            t[1] += 1
+
+    def clear(self):
+        self.wafers.clear()
+        self.tests.clear()
+        self.bins.clear()
+
+    def merge_into(self, session: Session):
+        """Add the accumulated counts to the summary tables (same transaction as the load)."""
+        if not self.wafers:
+            return
+        lot_pks = {lot for lot, _ in self.wafers}
+        lots = {s.lot_id: s for s in session.query(LotSummary).filter(LotSummary.lot_id.in_(lot_pks))}
+        wafer_pks = [w for _, w in self.wafers if w is not None]
+        wafers = {s.wafer_id: s for s in session.query(WaferSummary).filter(WaferSummary.wafer_id.in_(wafer_pks))}
+        for (lot_pk, wafer_pk), (n, n_fail, t_sum) in self.wafers.items():
+            ls = lots.get(lot_pk)
+            if ls is None:
+                ls = lots[lot_pk] = LotSummary(lot_id=lot_pk, die_count=0, fail_die_count=0, test_time_sum=0)
+                session.add(ls)
+            ls.die_count += n
+            ls.fail_die_count += n_fail
+            ls.test_time_sum += t_sum
+            if wafer_pk is None:
+                continue
+            ws = wafers.get(wafer_pk)
+            if ws is None:
+                ws = wafers[wafer_pk] = WaferSummary(
+                    wafer_id=wafer_pk, lot_id=lot_pk, die_count=0, fail_die_count=0, test_time_sum=0
+                )
+                session.add(ws)
+            ws.die_count += n
+            ws.fail_die_count += n_fail
+            ws.test_time_sum += t_sum
+
+        tests = {
+            (s.lot_id, s.wafer_id, s.test_num, s.test_type): s
+            for s in session.query(TestSummary).filter(TestSummary.lot_id.in_(lot_pks))
+        }
+        for key, (n_exec, n_fail, txt) in self.tests.items():
+            ts = tests.get(key)
+            if ts is None:
+                session.add(TestSummary(
+                    lot_id=key[0], wafer_id=key[1], test_num=key[2], test_type=key[3],
+                    test_txt=txt, exec_count=n_exec, fail_count=n_fail,
+                ))
+                continue
+            ts.exec_count += n_exec
+            ts.fail_count += n_fail
+            if txt and not ts.test_txt:
+                ts.test_txt = txt
+
+        bins = {
+            (s.lot_id, s.wafer_id, s.hard_bin): s
+            for s in session.query(BinCount).filter(BinCount.lot_id.in_(lot_pks))
+        }
+        for key, n in self.bins.items():
+            bc = bins.get(key)
+            if bc is None:
+                session.add(BinCount(lot_id=key[0], wafer_id=key[1], hard_bin=key[2], die_count=n))
+            else:
+                bc.die_count += n
+        session.flush()
+        self.clear()
+
+
+def rebuild_summaries(session: Session, lot_pks=None):
+    """Recompute summary rows from die/test_item for the given lots (all lots if None)."""
+    for model in (LotSummary, WaferSummary, TestSummary, BinCount):
+        stmt = delete(model)
+        if lot_pks is not None:
+            stmt = stmt.where(model.lot_id.in_(lot_pks))
+        session.execute(stmt)
+
+    def scoped(q):
+        return q.filter(Die.lot_id.in_(lot_pks)) if lot_pks is not None else q
+
+    acc = SummaryAccumulator()
+    fail_dies = scoped(
+        session.query(Die.lot_id, Die.wafer_id, func.count(func.distinct(Die.id)))
+        .join(TestItem, TestItem.die_id == Die.id)
+        .filter(TestItem.pass_fail == 1)
+    ).group_by(Die.lot_id, Die.wafer_id).all()
+    fail_by_wafer = {(lot, wafer): n for lot, wafer, n in fail_dies}
+    for lot, wafer, n, t_sum in scoped(
+        session.query(Die.lot_id, Die.wafer_id, func.count(Die.id), func.coalesce(func.sum(Die.test_t), 0))
+    ).group_by(Die.lot_id, Die.wafer_id):
+        acc.wafers[(lot, wafer)] = [n, fail_by_wafer.get((lot, wafer), 0), t_sum]
+    for lot, wafer, tn, typ, txt, n, n_fail in scoped(
+        session.query(
+            Die.lot_id, Die.wafer_id, TestKey.test_num, TestKey.test_type, func.max(TestKey.test_txt),
+            func.count(), func.sum(case((TestItem.pass_fail == 1, 1), else_=0)),
+        ).join(TestItem, TestItem.die_id == Die.id).join(TestKey, TestKey.id == TestItem.test_key_id)
+    ).group_by(Die.lot_id, Die.wafer_id, TestKey.test_num, TestKey.test_type):
+        acc.tests[(lot, wafer, tn, typ)] = [n, n_fail or 0, txt or ""]
+    for lot, wafer, hb, n in scoped(
+        session.query(Die.lot_id, Die.wafer_id, Die.hard_bin, func.count(Die.id)).filter(Die.hard_bin != None)
+    ).group_by(Die.lot_id, Die.wafer_id, Die.hard_bin):
+        acc.bins[(lot, wafer, hb)] = n
+    acc.merge_into(session)
@@ -0,0 +1,22 @@
+"""Shared test setup: repo modules and benchmarks/synthetic_stdf.py importable, small synthetic STDF lots."""
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "benchmarks"))
+
+
+@pytest.fixture
+def stdf_lots(tmp_path):
+    """Two small lots (2 wafers x 30 dies, 4 PTR + 1 FTR per die); returns their paths."""
+    from synthetic_stdf import generate
+    return [path for path, _ in generate(tmp_path / "stdf", lots=2, wafers=2, dies_per_wafer=30, ptr_per_die=4,
+                                         ftr_per_die=1, sites=2)]
+
+
+@pytest.fixture
+def db_url(tmp_path):
+    return f"sqlite:///{tmp_path / 'stdf.db'}"
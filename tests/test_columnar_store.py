@@ -0,0 +1,57 @@
+import pandas as pd
+import pytest
+from sqlalchemy.orm import Session
+
+pytest.importorskip("pyarrow")
+
+from columnar_store import ParametricStore, columnar_store_dir, fetch_parametric, iter_parametric_results
+from db_models import Lot, get_shared_engine
+from stdf_loader import load_stdf
+
+
+def _sql_only(session, monkeypatch, test_num, lot_pks):
+    monkeypatch.setenv("STDF_COLUMNAR_DIR", "")
+    try:
+        return fetch_parametric(session, test_num, lot_pks)
+    finally:
+        monkeypatch.delenv("STDF_COLUMNAR_DIR")
+
+
+def _sorted(df):
+    return df.sort_values("die_id").reset_index(drop=True)[["lot_pk", "die_id", "result", "pass_fail"]]
+
+
+def test_load_publishes_one_file_per_wafer_and_reads_match_sql(monkeypatch, stdf_lots, db_url):
+    load_stdf(stdf_lots[0], db_url=db_url, chunk_size=50)   # several flushes per wafer
+    root = columnar_store_dir(db_url)
+    files = sorted(root.glob("lot=*/wafer=*/*.parquet"))
+    assert len(files) == 2 and all(f.name.startswith("part-") for f in files)
+    with Session(get_shared_engine(db_url)) as session:
+        lot_pks = [pk for (pk,) in session.query(Lot.id)]
+        store_files, rest = ParametricStore(root).coverage(session, lot_pks)
+        assert len(store_files) == 2 and rest == {}
+        from_store = fetch_parametric(session, 1000, lot_pks)
+        pd.testing.assert_frame_equal(
+            _sorted(from_store), _sorted(_sql_only(session, monkeypatch, 1000, lot_pks)), check_dtype=False
+        )
+
+
+def test_wafers_loaded_without_the_store_fall_back_to_sql(monkeypatch, tmp_path, db_url):
+    from synthetic_stdf import write_lot
+    first, retest = tmp_path / "first.stdf", tmp_path / "retest.stdf"
+    write_lot(first, "LOT_X", wafers=2, dies_per_wafer=20, ptr_per_die=3)
+    write_lot(retest, "LOT_X", wafers=3, dies_per_wafer=10, ptr_per_die=3, seed=1)
+    load_stdf(first, db_url=db_url)
+    monkeypatch.setenv("STDF_COLUMNAR_DIR", "")
+    load_stdf(retest, db_url=db_url)   # same lot, adds dies to wafers 01 / 02 and a new wafer 03
+    monkeypatch.delenv("STDF_COLUMNAR_DIR")
+    with Session(get_shared_engine(db_url)) as session:
+        lot_pks = [pk for (pk,) in session.query(Lot.id)]
+        files, rest = ParametricStore(columnar_store_dir(db_url)).coverage(session, lot_pks)
+        assert files == [] and len(rest[lot_pks[0]]) == 3
+        expected = _sql_only(session, monkeypatch, 1001, lot_pks)
+        assert len(expected) == 70
+        pd.testing.assert_frame_equal(
+            _sorted(fetch_parametric(session, 1001, lot_pks)), _sorted(expected), check_dtype=False
+        )
+        assert sum(len(r) for _, r in iter_parametric_results(session, 1001, lot_pks, chunk_rows=16)) == 70
@@ -0,0 +1,41 @@
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import Session
+
+import db_models
+from db_models import Base, _migrate_test_keys
+
+
+def test_wide_test_item_migration_keeps_first_row_limits(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(text("DROP TABLE test_item"))
+        conn.execute(text("""
+            CREATE TABLE test_item (
+                id INTEGER PRIMARY KEY, die_id INTEGER NOT NULL, test_num INTEGER NOT NULL, test_txt VARCHAR(512),
+                test_type VARCHAR(8) NOT NULL, test_suite_id INTEGER, result FLOAT, units VARCHAR(64),
+                lo_limit FLOAT, hi_limit FLOAT, pass_fail INTEGER
+            )
+        """))
+        conn.execute(text("INSERT INTO company (id, name) VALUES (1, 'C')"))
+        conn.execute(text("INSERT INTO product (id, company_id, name) VALUES (1, 1, 'P')"))
+        conn.execute(text("INSERT INTO stage (id, product_id, name) VALUES (1, 1, 'S')"))
+        conn.execute(text("INSERT INTO test_program (id, stage_id, name, revision) VALUES (1, 1, 'PROG', 'A')"))
+        conn.execute(text("INSERT INTO lot (id, test_program_id, lot_id) VALUES (1, 1, 'L1')"))
+        for die_id in (5, 6, 7):
+            conn.execute(text("INSERT INTO die (id, lot_id) VALUES (:id, 1)"), {"id": die_id})
+        # inserted out of die order: the key must follow die 5, not the insert order or the widest limits
+        conn.execute(text("""
+            INSERT INTO test_item (die_id, test_num, test_txt, test_type, result, units, lo_limit, hi_limit, pass_fail)
+            VALUES (6, 100, 'VDD_LEAK', 'PTR', 0.5, 'mA', -2.0, 3.0, 0),
+                   (5, 100, 'VDD_LEAK', 'PTR', 0.4, 'uA', -1.0, 1.0, 0),
+                   (7, 100, 'VDD_LEAK_RETEST', 'PTR', 0.3, 'uA', -0.5, 9.0, 0),
+                   (5, 200, 'FUNC', 'FTR', NULL, '', NULL, NULL, 1)
+        """))
+    _migrate_test_keys(engine)
+    with Session(engine) as session:
+        keys = {k.test_num: k for k in session.query(db_models.TestKey)}
+        assert (keys[100].test_txt, keys[100].units, keys[100].lo_limit, keys[100].hi_limit) == ("VDD_LEAK", "uA", -1.0, 1.0)
+        assert keys[200].test_type == "FTR" and keys[200].lo_limit is None
+        rows = session.execute(text("SELECT die_id, test_key_id, result FROM test_item ORDER BY die_id, test_key_id"))
+        assert [(d, r) for d, _, r in rows] == [(5, 0.4), (5, None), (6, 0.5), (7, 0.3)]
@@ -0,0 +1,123 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("requests")
+
+import llm_gateway
+from llm_gateway import LLMGateway, ResponseCache, normalize_question
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    c = _Clock()
+    monkeypatch.setattr(llm_gateway.time, "time", c)
+    return c
+
+
+@pytest.fixture
+def stub_server():
+    """Local HTTP endpoint answering every POST with the next queued JSON body; records request bodies."""
+    answers, requests_seen = [], []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            requests_seen.append(json.loads(self.rfile.read(int(self.headers["Content-Length"]))))
+            body = json.dumps(answers.pop(0) if answers else {"tool": "lot_pchart", "params": {}}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}", answers, requests_seen
+    server.shutdown()
+    server.server_close()
+
+
+def _messages(question):
+    return [{"role": "system", "content": "tools: lot_pchart"}, {"role": "user", "content": question}]
+
+
+def test_normalize_question_equivalence():
+    assert normalize_question("畫出 PChart？\n") == normalize_question("畫出pchart") == "畫出pchart"
+    assert normalize_question("Lot  A1 yield?") == normalize_question("lot a1 YIELD")
+    assert normalize_question("ＬＯＴ１") == "lot1"   # NFKC folds full-width characters
+    assert normalize_question("lot a1") != normalize_question("lot a2")
+
+
+def test_cache_miss_then_hit_for_equivalent_question(tmp_path, stub_server):
+    url, answers, seen = stub_server
+    answers.append({"tool": "lot_pchart", "params": {"lots": ["A1"]}})
+    gw = LLMGateway(cache=ResponseCache(str(tmp_path / "cache.sqlite")), offline_url=url)
+    parsed, cached = gw.ask("offline", _messages("P chart of lot A1?"))
+    assert parsed == {"tool": "lot_pchart", "params": {"lots": ["A1"]}} and not cached
+    parsed, cached = gw.ask("offline", _messages("p chart of LOT a1"))
+    assert parsed["params"] == {"lots": ["A1"]} and cached
+    assert len(seen) == 1 and (gw.cache.hits, gw.cache.misses) == (1, 1)
+    _, cached = gw.ask("offline", _messages("p chart of lot a1"), use_cache=False)
+    assert not cached and len(seen) == 2
+
+
+def test_cache_key_depends_on_system_prompt_and_backend():
+    base = ResponseCache.key("offline", "m", _messages("q"))
+    assert base != ResponseCache.key("ollama", "m", _messages("q"))
+    assert base != ResponseCache.key("offline", "m", [{"role": "system", "content": "other"}, _messages("q")[1]])
+
+
+def test_ttl_expiry(tmp_path, clock):
+    cache = ResponseCache(str(tmp_path / "cache.sqlite"), ttl_hours=1)
+    cache.put("k", "offline", "q", {"tool": "t", "params": {}})
+    clock.now += 3599
+    assert cache.get("k") == {"tool": "t", "params": {}}
+    clock.now += 2
+    assert cache.get("k") is None
+    cache.put("k2", "offline", "q2", {"tool": "t", "params": {}})   # expired rows are deleted on put
+    assert len(cache) == 1
+
+
+def test_lru_eviction(tmp_path, clock):
+    cache = ResponseCache(str(tmp_path / "cache.sqlite"), max_entries=2)
+    for key in ("a", "b"):
+        cache.put(key, "offline", key, {"tool": key, "params": {}})
+        clock.now += 1
+    assert cache.get("a") is not None   # "b" is now the least recently used
+    clock.now += 1
+    cache.put("c", "offline", "c", {"tool": "c", "params": {}})
+    assert len(cache) == 2
+    assert cache.get("b") is None and cache.get("a") is not None and cache.get("c") is not None
+
+
+def test_offline_rule_fallback_is_not_cached(tmp_path, monkeypatch):
+    monkeypatch.delenv("OFFLINE_LLM_URL", raising=False)
+    gw = LLMGateway(cache=ResponseCache(str(tmp_path / "cache.sqlite")))
+    parsed, cached = gw.ask("offline", _messages("LOT_A1 LOT_B2"))
+    assert parsed == {"tool": "lot_pchart", "params": {"lots": ["LOT_A1", "LOT_B2"]}} and not cached
+    assert len(gw.cache) == 0
+    assert gw.ask("offline", _messages("LOT_A1 LOT_B2"))[1] is False
+
+
+def test_ollama_answer_in_markdown_block(tmp_path, stub_server):
+    url, answers, seen = stub_server
+    answers.append({"message": {"content": "```json\n[{\"tool\": \"bin_summary\", \"params\": {}}]\n```"}})
+    gw = LLMGateway(cache=ResponseCache(str(tmp_path / "cache.sqlite")), ollama_base_url=url)
+    parsed, cached = gw.ask("ollama", _messages("bin summary"))
+    assert parsed == {"calls": [{"tool": "bin_summary", "params": {}}]} and not cached
+    assert seen[0]["stream"] is False and seen[0]["messages"][-1]["content"] == "bin summary"
+    assert gw.ask("ollama", _messages("Bin summary?")) == (parsed, True)
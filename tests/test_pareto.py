@@ -0,0 +1,57 @@
+from sqlalchemy import func, update
+from sqlalchemy.orm import Session
+
+import db_models
+from db_models import Die, Lot, get_shared_engine
+import pareto
+from stdf_loader import load_stdf
+
+
+def _fails(session, lot_pks, test_num, test_type):
+    return session.query(func.count()).select_from(db_models.TestItem).join(Die).join(db_models.TestKey).filter(
+        Die.lot_id.in_(lot_pks), db_models.TestItem.pass_fail == 1,
+        db_models.TestKey.test_num == test_num, db_models.TestKey.test_type == test_type,
+    ).scalar()
+
+
+def _fail_ptr(session, test_num, every=3):
+    """Mark every n-th result of a PTR test failed (synthetic PTRs sit within 4 sigma and rarely fail)."""
+    keys = session.query(db_models.TestKey.id).filter(
+        db_models.TestKey.test_num == test_num, db_models.TestKey.test_type == "PTR"
+    ).scalar_subquery()
+    session.execute(update(db_models.TestItem).where(
+        db_models.TestItem.test_key_id.in_(keys), db_models.TestItem.die_id % every == 0
+    ).values(pass_fail=1))
+
+
+def test_ptr_and_ftr_sharing_a_number_are_separate_bars(stdf_lots, db_url):
+    load_stdf(stdf_lots[0], db_url=db_url)
+    with Session(get_shared_engine(db_url)) as session:
+        session.execute(update(db_models.TestKey).where(db_models.TestKey.test_type == "FTR").values(test_num=1000))
+        _fail_ptr(session, 1000)
+        session.commit()
+        lot_pks = [pk for (pk,) in session.query(Lot.id)]
+        df = pareto.test_pareto(session, lot_pks)
+        rows = df[df["Test #"] == 1000].set_index("Type")
+        assert sorted(rows.index) == ["FTR", "PTR"]
+        assert rows.loc["PTR", "Fail count"] == _fails(session, lot_pks, 1000, "PTR") > 0
+        assert rows.loc["FTR", "Fail count"] == _fails(session, lot_pks, 1000, "FTR") > 0
+        assert rows.loc["PTR", "Test"].endswith("(PTR)") and rows.loc["FTR", "Test"].endswith("(FTR)")
+        assert df["Test"].is_unique and "_program" not in df.columns
+
+
+def test_cross_lot_keeps_tests_of_different_programs_apart(tmp_path, db_url):
+    from synthetic_stdf import write_lot
+    a, b = tmp_path / "a.stdf", tmp_path / "b.stdf"
+    write_lot(a, "LOT_A", wafers=1, dies_per_wafer=40, ptr_per_die=3, ftr_per_die=1)
+    write_lot(b, "LOT_B", wafers=1, dies_per_wafer=40, ptr_per_die=3, ftr_per_die=1, seed=1, job_rev="B")
+    load_stdf(a, db_url=db_url)
+    load_stdf(b, db_url=db_url)
+    with Session(get_shared_engine(db_url)) as session:
+        _fail_ptr(session, 1000)
+        session.commit()
+        lots = session.query(Lot)
+        df = pareto.test_pareto(session, lots, group_by="lot")
+        rows = df[(df["Test #"] == 1000) & (df["Type"] == "PTR")]
+        assert sorted(rows["Lot"]) == ["LOT_A", "LOT_B"] and rows["Test"].nunique() == 2
+        assert sorted(t.rsplit(" ", 1)[-1] for t in rows["Test"]) == ["A]", "B]"]
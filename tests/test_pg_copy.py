@@ -0,0 +1,115 @@
+import csv
+import io
+import os
+import struct
+
+import pytest
+from sqlalchemy import BigInteger, Column, Float, Integer, MetaData, String, Table, create_engine, inspect
+from sqlalchemy.orm import Session
+
+from db_models import Base, Bin, Die, init_db
+import db_models
+from pg_copy import _BINARY_HEADER, encode_binary, encode_csv
+from stdf_loader import _BIN_COLUMNS, _DIE_COLUMNS, _TEST_ITEM_COLUMNS
+
+PG_URL = os.getenv("STDF_TEST_PG_URL")   # scratch PostgreSQL database; its STDF tables are dropped
+
+
+def decode_binary(table, columns, payload):
+    """Rows of a COPY BINARY payload, decoded with the wire size PostgreSQL expects for each column type."""
+    assert payload.startswith(_BINARY_HEADER)
+    pos, rows = len(_BINARY_HEADER), []
+    while True:
+        (n_fields,) = struct.unpack_from("!h", payload, pos)
+        pos += 2
+        if n_fields == -1:
+            assert pos == len(payload)
+            return rows
+        assert n_fields == len(columns)
+        row = []
+        for c in columns:
+            (length,) = struct.unpack_from("!i", payload, pos)
+            pos += 4
+            if length == -1:
+                row.append(None)
+                continue
+            col_type = table.c[c].type
+            raw = payload[pos:pos + length]
+            pos += length
+            if isinstance(col_type, Float):
+                assert length == 8
+                row.append(struct.unpack("!d", raw)[0])
+            elif isinstance(col_type, BigInteger):
+                assert length == 8
+                row.append(struct.unpack("!q", raw)[0])
+            elif isinstance(col_type, Integer):
+                assert length == 4
+                row.append(struct.unpack("!i", raw)[0])
+            else:
+                row.append(raw.decode("utf-8"))
+        rows.append(tuple(row))
+
+
+def _columns(rows, columns):
+    return {c: [r[i] for r in rows] for i, c in enumerate(columns)}
+
+
+DIE_ROWS = [
+    (1, 7, 3, 1, 2, -5, 12, "W01-0", 1, 1, 0, 24, 95, 4),
+    (2, 7, None, 1, 1, None, None, 'say "hi", ok', 3, None, 8, 0, 0, None),
+]
+BIN_ROWS = [(1, 1, 1, "PASS", "PASS"), (2, 3, None, "", "FAIL_3")]
+ITEM_ROWS = [(1, 10, 0.125, 0), (1, 11, -1e-12, 1), (2, 10, None, None), (2, 12, 3.0e9, 0)]
+
+
+@pytest.mark.parametrize("table, columns, rows", [
+    (Die.__table__, _DIE_COLUMNS, DIE_ROWS),
+    (Bin.__table__, _BIN_COLUMNS, BIN_ROWS),
+    (db_models.TestItem.__table__, _TEST_ITEM_COLUMNS, ITEM_ROWS),
+])
+def test_binary_payload_round_trips_loader_columns(table, columns, rows):
+    assert decode_binary(table, columns, encode_binary(table, columns, _columns(rows, columns))) == rows
+
+
+def test_binary_bigint_uses_eight_bytes():
+    table = Table("t", MetaData(), Column("a", BigInteger), Column("b", Integer), Column("c", String(8)))
+    payload = encode_binary(table, ("a", "b", "c"), {"a": [2 ** 40], "b": [-1], "c": ["é"]})
+    assert decode_binary(table, ("a", "b", "c"), payload) == [(2 ** 40, -1, "é")]
+
+
+def test_csv_payload_keeps_null_apart_from_empty_string():
+    table = Die.__table__
+    payload = encode_csv(table, _DIE_COLUMNS, _columns(DIE_ROWS, _DIE_COLUMNS)).decode("utf-8")
+    lines = payload.splitlines()
+    assert len(lines) == 2
+    assert ',"W01-0",' in lines[0]
+    assert lines[1].startswith("2,7,,1,1,,,") and ',"say ""hi"", ok",' in lines[1]
+    assert next(csv.reader(io.StringIO(lines[1])))[7] == 'say "hi", ok'
+    items = encode_csv(db_models.TestItem.__table__, _TEST_ITEM_COLUMNS, _columns(ITEM_ROWS, _TEST_ITEM_COLUMNS)).decode()
+    assert items.splitlines() == ["1,10,0.125,0", "1,11,-1e-12,1", "2,10,,", "2,12,3000000000.0,0"]
+    assert encode_csv(db_models.TestItem.__table__, _TEST_ITEM_COLUMNS, _columns([], _TEST_ITEM_COLUMNS)) == b""
+
+
+@pytest.mark.skipif(not PG_URL, reason="set STDF_TEST_PG_URL to a scratch PostgreSQL database")
+@pytest.mark.parametrize("fmt", ["binary", "csv"])
+def test_copy_load_into_postgresql(monkeypatch, stdf_lots, tmp_path, fmt):
+    import pg_copy
+    from stdf_loader import load_stdf, load_stdf_batch
+    monkeypatch.setattr(pg_copy, "PG_COPY_FORMAT", fmt)
+    monkeypatch.setenv("STDF_COLUMNAR_DIR", "")
+    engine = create_engine(PG_URL)
+    Base.metadata.drop_all(engine)
+    init_db(engine)
+    indexes = {t: {ix["name"] for ix in inspect(engine).get_indexes(t)} for t in ("die", "bin", "test_item")}
+    load_stdf(stdf_lots[0], db_url=PG_URL)   # initial load: indexes dropped and rebuilt in the transaction
+    load_stdf_batch(stdf_lots[1:], db_url=PG_URL, workers=1)
+    assert {t: {ix["name"] for ix in inspect(engine).get_indexes(t)} for t in indexes} == indexes
+    sqlite_url = f"sqlite:///{tmp_path / 'ref.db'}"
+    load_stdf_batch(stdf_lots, db_url=sqlite_url, workers=1)
+    ref = create_engine(sqlite_url)
+    for model in (Die, Bin, db_models.TestItem):
+        with Session(engine) as pg, Session(ref) as lite:
+            assert pg.query(model).count() == lite.query(model).count() > 0
+    with Session(engine) as pg:
+        assert pg.query(db_models.TestItem).filter(db_models.TestItem.result != None).count() > 0
+    engine.dispose()
@@ -0,0 +1,25 @@
+import numpy as np
+
+from query_cache import QueryCache, _approx_size
+from stream_stats import StreamStats
+from wafer_map import WaferGrid
+
+
+def _grid(cells):
+    return WaferGrid(0, 0, 1, np.zeros((cells, cells)), None, cells * cells)
+
+
+def test_slotted_values_count_their_arrays():
+    assert _approx_size(_grid(500)) >= 500 * 500 * 8
+    stats = StreamStats(k=200)
+    stats.update(np.arange(10_000, dtype=np.float64))
+    assert _approx_size({1: stats}) >= sum(lv.nbytes for lv in stats.sketch.levels)
+
+
+def test_large_grid_evicts_older_entries():
+    cache = QueryCache(max_entries=100, max_bytes=3 * 1024 * 1024)
+    for i in range(5):
+        cache.put(("small", i), _grid(100))   # 80 KB each
+    cache.put("big", _grid(600))   # 2.9 MB
+    assert cache.stats()["bytes"] <= cache.max_bytes
+    assert cache.get("big")[0] and not cache.get(("small", 0))[0]
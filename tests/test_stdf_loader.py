@@ -0,0 +1,102 @@
+import struct
+
+import pytest
+from sqlalchemy import create_engine, func
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+from db_models import Die, LoadedFile, Lot, Wafer, ensure_db, get_shared_engine
+from stdf_loader import _DieIdAllocator, load_stdf
+
+
+def test_die_ids_reserved_under_sqlite_write_lock(tmp_path, stdf_lots, db_url):
+    load_stdf(stdf_lots[0], db_url=db_url)
+    engine = create_engine(db_url, connect_args={"timeout": 0.2})
+    with Session(engine) as first, Session(engine) as second:
+        max_id = first.query(func.max(Die.id)).scalar()
+        assert _DieIdAllocator(first)() == max_id + 1
+        # the first allocator holds the write lock until its transaction ends
+        with pytest.raises(OperationalError, match="locked"):
+            _DieIdAllocator(second)()
+        second.rollback()
+        first.rollback()
+        allocate = _DieIdAllocator(second)
+        assert allocate() == max_id + 1
+        second.commit()
+
+
+def test_allocator_rereads_max_id_after_commit(stdf_lots, db_url):
+    load_stdf(stdf_lots[0], db_url=db_url)
+    engine = get_shared_engine(db_url)
+    ensure_db(engine)
+    with Session(engine) as session:
+        allocate = _DieIdAllocator(session)
+        first_id = allocate()
+        session.commit()
+        load_stdf(stdf_lots[1], db_url=db_url)   # another loader wrote dies in between
+        assert allocate() == session.query(func.max(Die.id)).scalar() + 1 > first_id
+
+
+def test_batch_writer_error_stops_workers_and_rolls_back(monkeypatch, tmp_path, db_url):
+    from synthetic_stdf import generate
+    import stdf_loader
+    paths = [p for p, _ in generate(tmp_path / "big", lots=4, wafers=4, dies_per_wafer=800, ptr_per_die=10)]
+    calls = {"n": 0}
+    handle = stdf_loader.StdfToDbSink.handle
+
+    def failing_handle(self, rec_name, fd):
+        calls["n"] += 1
+        if calls["n"] == 500:
+            raise RuntimeError("writer failed")
+        handle(self, rec_name, fd)
+
+    monkeypatch.setattr(stdf_loader.StdfToDbSink, "handle", failing_handle)
+    with pytest.raises(RuntimeError, match="writer failed"):
+        stdf_loader.load_stdf_batch(paths, db_url=db_url, workers=2)
+    with Session(get_shared_engine(db_url)) as session:
+        assert session.query(Die).count() == 0
+        assert session.query(Lot).count() == session.query(Wafer).count() == 0
+        assert session.query(LoadedFile).count() == 0
+
+
+def test_failed_file_in_batch_is_purged_with_its_lot(tmp_path, stdf_lots, db_url):
+    from synthetic_stdf import write_lot
+    import stdf_loader
+    broken = tmp_path / "stdf" / "BROKEN.stdf"
+    write_lot(broken, "BROKEN_LOT", wafers=4, dies_per_wafer=600, ptr_per_die=4)
+    data = broken.read_bytes()
+    pos = 0
+    while pos < len(data) // 2:   # past the first record batch the worker sends
+        pos += 4 + struct.unpack_from("<H", data, pos)[0]
+    broken.write_bytes(data[:pos] + b"\xff\xff")   # truncated record header
+    result = stdf_loader.load_stdf_batch([*stdf_lots, broken], db_url=db_url, workers=2)
+    assert result["total"]["failed"] == 1
+    with Session(get_shared_engine(db_url)) as session:
+        assert sorted(lot for (lot,) in session.query(Lot.lot_id)) == ["SYN0_LOT001", "SYN0_LOT002"]
+        assert session.query(Wafer).count() == 4
+        assert session.query(Die).count() == 120
+        assert session.query(LoadedFile.status).distinct().all() == [("done",)]
+
+
+def test_uploads_sharing_a_name_replace_only_when_asked(tmp_path, stdf_lots, db_url):
+    import io
+
+    def upload(path):
+        buf = io.BytesIO(path.read_bytes())
+        buf.name = "lot.stdf"
+        return buf
+
+    first, second = stdf_lots
+    assert load_stdf(upload(first), db_url=db_url)["action"] == "load"
+    assert load_stdf(upload(second), db_url=db_url)["action"] == "load"   # unrelated file, same name
+    assert load_stdf(upload(first), db_url=db_url)["action"] == "skip"
+    with Session(get_shared_engine(db_url)) as session:
+        assert session.query(Lot).count() == 2 and session.query(Die).count() == 120
+    assert load_stdf(upload(first), db_url=db_url, replace_upload=True)["action"] == "skip"   # same content
+    from synthetic_stdf import write_lot
+    third = tmp_path / "third.stdf"
+    write_lot(third, "LOT_Z", wafers=1, dies_per_wafer=10, ptr_per_die=2)
+    assert load_stdf(upload(third), db_url=db_url, replace_upload=True)["action"] == "replace"
+    with Session(get_shared_engine(db_url)) as session:   # the latest upload of the name (second) is replaced
+        assert sorted(lot for (lot,) in session.query(Lot.lot_id)) == ["LOT_Z", "SYN0_LOT001"]
+        assert session.query(Die).count() == 70 and session.query(LoadedFile).count() == 2
@@ -0,0 +1,29 @@
+import io
+
+import pytest
+from pystdf.Types import InitialSequenceException
+
+from stdf_loader import _RECORD_HANDLERS
+from stdf_reader import iter_records
+
+
+@pytest.mark.parametrize("head", [
+    b"\x02\x00\x00\x0b\x02\x04",   # REC_SUB wrong
+    b"\x02\x00\x01\x0a\x02\x04",   # REC_TYP wrong (MIR header)
+    b"%PDF-1.7\n",
+])
+def test_non_stdf_buffer_is_rejected(head):
+    with pytest.raises(InitialSequenceException):
+        list(iter_records(head + b"\x00" * 64, _RECORD_HANDLERS))
+    with pytest.raises(InitialSequenceException):
+        list(iter_records(io.BytesIO(head + b"\x00" * 64), _RECORD_HANDLERS))
+
+
+def test_synthetic_file_matches_written_counts(tmp_path):
+    from synthetic_stdf import write_lot
+    path = tmp_path / "lot.stdf"
+    counts = write_lot(path, "LOT1", wafers=2, dies_per_wafer=25, ptr_per_die=3, ftr_per_die=1)
+    names = [name for name, _ in iter_records(path.read_bytes(), _RECORD_HANDLERS)]
+    assert names.count("Prr") == counts["dies"]
+    assert names.count("Ptr") == counts["ptr"] and names.count("Ftr") == counts["ftr"]
+    assert names[0] == "Mir" and names[-1] == "Mrr"
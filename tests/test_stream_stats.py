@@ -0,0 +1,30 @@
+import numpy as np
+
+from stream_stats import group_stats, merged
+
+
+def test_group_stats_matches_numpy_over_chunks():
+    rng = np.random.default_rng(0)
+    values = rng.normal(1.0, 0.1, 150).astype(np.float32)   # below the sketch capacity: exact quantiles
+    stats = group_stats((1, chunk) for chunk in np.array_split(values, 7))
+    s = stats[1].summary()
+    assert s["N"] == 150
+    assert np.isclose(s["Mean"], values.mean(dtype=np.float64)) and np.isclose(s["Std"], values.std(ddof=1))
+    assert s["Min"] == values.min() and s["Max"] == values.max()
+    assert np.allclose([s["Q1"], s["Median"], s["Q3"]], np.quantile(values, [0.25, 0.5, 0.75]))
+
+
+def test_all_nan_lot_makes_no_group():
+    chunks = [
+        (1, np.array([1.0, 2.0, np.nan, 3.0], np.float32)),
+        (2, np.full(5, np.nan, np.float32)),   # lot whose measurements are all NaN
+        (2, np.empty(0, np.float32)),
+        (3, np.empty(0, np.float32)),
+        (1, np.array([4.0], np.float32)),
+    ]
+    stats = group_stats(chunks)
+    assert list(stats) == [1]
+    s = stats[1].summary()
+    assert s["N"] == 4 and s["Min"] == 1.0 and s["Max"] == 4.0 and not np.isnan(s["Median"])
+    assert all(np.isfinite(v) for v in stats[1].box()["outliers"])
+    assert merged(stats.values()).n == 4
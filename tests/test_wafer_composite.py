@@ -0,0 +1,18 @@
+from sqlalchemy import func, update
+from sqlalchemy.orm import Session
+
+from db_models import Die, Wafer, WaferSummary, get_shared_engine
+from stdf_loader import load_stdf
+from wafer_composite import CompositeMap
+
+
+def test_fails_use_the_summary_definition_not_part_flg(stdf_lots, db_url):
+    load_stdf(stdf_lots[0], db_url=db_url)
+    with Session(get_shared_engine(db_url)) as session:
+        session.execute(update(Die).values(part_flg=0))   # tester that never sets PRR PART_FLG bit 3
+        session.commit()
+        wafer_pks = [pk for (pk,) in session.query(Wafer.id)]
+        expected = session.query(func.sum(WaferSummary.fail_die_count)).scalar()
+        cmap = CompositeMap(session, wafer_pks)
+    assert expected > 0
+    assert cmap.n_dies == 60 and int(cmap.fails.sum()) == expected
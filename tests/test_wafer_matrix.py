@@ -0,0 +1,85 @@
+import numpy as np
+from sqlalchemy.orm import Session
+
+import db_models
+import wafer_matrix
+from db_models import Die, Lot, Wafer, get_shared_engine
+from stdf_loader import load_stdf
+from wafer_matrix import iter_lot_test_values, matrix_store_dir, wafer_test_frame
+
+
+def _sql_count(session, test_num):
+    return session.query(db_models.TestItem).join(db_models.TestKey).filter(
+        db_models.TestKey.test_num == test_num, db_models.TestKey.test_type == "PTR", db_models.TestItem.result != None
+    ).count()
+
+
+def _values(session, test_num):
+    lot_pks = [pk for (pk,) in session.query(Lot.id)]
+    chunks = list(iter_lot_test_values(session, lot_pks, test_num, chunk_rows=16))
+    return np.concatenate([v for _, v in chunks]) if chunks else np.empty(0, np.float32)
+
+
+def test_wafers_without_a_matrix_file_fall_back_per_wafer(monkeypatch, tmp_path, db_url):
+    from synthetic_stdf import write_lot
+    path = tmp_path / "lot.stdf"
+    write_lot(path, "LOT_M", wafers=3, dies_per_wafer=20, ptr_per_die=3)
+    monkeypatch.setattr(wafer_matrix, "WAFER_MATRIX", True)
+    load_stdf(path, db_url=db_url)
+    files = sorted(matrix_store_dir(db_url).glob("lot=*/wafer=*.npz"))
+    assert len(files) == 3
+    files[1].unlink()   # one wafer of the lot has no matrix
+    with Session(get_shared_engine(db_url)) as session:
+        values = _values(session, 1001)
+    assert len(values) == 60 and not np.isnan(values).any()
+
+
+def test_load_without_the_matrix_store_is_not_hidden_by_older_files(monkeypatch, tmp_path, db_url):
+    from synthetic_stdf import write_lot
+    first, retest = tmp_path / "a.stdf", tmp_path / "b.stdf"
+    write_lot(first, "LOT_M", wafers=2, dies_per_wafer=20, ptr_per_die=3)
+    write_lot(retest, "LOT_M", wafers=2, dies_per_wafer=20, ptr_per_die=3, seed=1)
+    monkeypatch.setattr(wafer_matrix, "WAFER_MATRIX", True)
+    load_stdf(first, db_url=db_url)
+    monkeypatch.setattr(wafer_matrix, "WAFER_MATRIX", False)
+    load_stdf(retest, db_url=db_url)   # same lot and wafers, dies of a second load the matrices do not hold
+    with Session(get_shared_engine(db_url)) as session:
+        assert len(_values(session, 1001)) == _sql_count(session, 1001) == 80
+        wafer_pks = [pk for (pk,) in session.query(Wafer.id)]
+        assert len(wafer_test_frame(session, wafer_pks, 1001)) == 80
+        assert len(wafer_matrix.wafer_matrix(session, wafer_pks[0])) == 40
+
+
+def test_forced_reload_without_the_flag_drops_the_replaced_rows(monkeypatch, tmp_path, db_url):
+    from synthetic_stdf import write_lot
+    path = tmp_path / "a.stdf"
+    write_lot(path, "LOT_M", wafers=2, dies_per_wafer=20, ptr_per_die=3)
+    monkeypatch.setattr(wafer_matrix, "WAFER_MATRIX", True)
+    load_stdf(path, db_url=db_url)
+    assert len(list(matrix_store_dir(db_url).glob("lot=*/wafer=*.npz"))) == 2
+    monkeypatch.setattr(wafer_matrix, "WAFER_MATRIX", False)
+    load_stdf(path, db_url=db_url, force=True)
+    assert list(matrix_store_dir(db_url).glob("lot=*/wafer=*.npz")) == []   # replaced load's rows removed
+    with Session(get_shared_engine(db_url)) as session:
+        wafer_pk = session.query(Wafer.id).order_by(Wafer.id).first()[0]
+        db_dies = sorted(pk for (pk,) in session.query(Die.id).filter(Die.wafer_id == wafer_pk))
+        assert wafer_matrix.wafer_matrix(session, wafer_pk).die_id.tolist() == db_dies
+        assert len(_values(session, 1001)) == 40
+
+
+def test_rows_of_loads_no_longer_in_the_db_are_not_read(monkeypatch, tmp_path, db_url):
+    from synthetic_stdf import write_lot
+    path = tmp_path / "a.stdf"
+    write_lot(path, "LOT_M", wafers=1, dies_per_wafer=20, ptr_per_die=3)
+    monkeypatch.setattr(wafer_matrix, "WAFER_MATRIX", True)
+    load_stdf(path, db_url=db_url)
+    (file,) = matrix_store_dir(db_url).glob("lot=*/wafer=*.npz")
+    m = wafer_matrix.WaferMatrix.load(file)
+    stale = wafer_matrix.WaferMatrix.build(
+        m.die_id + 1000, m.x, m.y, m.die_id + 1000, np.full(len(m), 1001), np.full(len(m), 99.0), np.zeros(len(m)),
+        load_id=np.full(len(m), 12345),
+    )
+    m.merge(stale).save(file)   # rows of a purged load the writer never removed
+    with Session(get_shared_engine(db_url)) as session:
+        values = _values(session, 1001)
+    assert len(values) == 20 and not (values == 99.0).any()
@@ -0,0 +1,115 @@
+"""
+Composite (stacked) wafer map: per-(x, y) statistics over any set of wafers — fail rate, most frequent
+hard bin and mean of one PTR test. Dies come from one Core query as NumPy arrays and are grouped by a
+position code with np.bincount, so hundreds of wafers cost a few array passes instead of per-wafer work.
+"""
+import numpy as np
+import pandas as pd
+from sqlalchemy import exists, select
+from sqlalchemy.orm import Session
+
+from db_models import Die, TestItem
+from wafer_map import NO_BIN, rasterize
+from wafer_matrix import INVALID_XY, wafer_test_frame
+
+
+def _last_per_key(key):
+    """Mask keeping the last row per key (rows in die id order: a retest replaces the first die)."""
+    _, first_rev = np.unique(key[::-1], return_index=True)
+    keep = np.zeros(len(key), bool)
+    keep[len(key) - 1 - first_rev] = True
+    return keep
+
+
+class CompositeMap:
+    """
+    Stacked statistics of wafers, one entry per (x, y) position present on any of them: n (wafers with a
+    die there), fails, fail_rate, bin_mode (most frequent hard bin, NO_BIN = none), bin_share (share of the
+    mode bin); with test_num also value_n and value_mean. Failing die = any of its tests failed
+    (test_item.pass_fail = 1), the definition the loader's summaries use.
+    """
+    def __init__(self, session: Session, wafer_pks, test_num=None):
+        self.wafer_pks = list(wafer_pks)
+        self.test_num = test_num
+        any_fail = exists().where(TestItem.die_id == Die.id, TestItem.pass_fail == 1)
+        rows = session.connection().execute(
+            select(Die.id, Die.wafer_id, Die.x_coord, Die.y_coord, Die.hard_bin, any_fail).where(
+                Die.wafer_id.in_(self.wafer_pks)
+            )
+        ).all()
+        die_id, wafer, x, y, hard_bin, fail = (np.array(c, dtype=float) for c in (zip(*rows) if rows else [()] * 6))
+        order = np.argsort(die_id, kind="stable")
+        wafer, x, y, hard_bin, fail = wafer[order], x[order], y[order], hard_bin[order], fail[order]
+        ok = ~np.isnan(x) & ~np.isnan(y) & (x != INVALID_XY) & (y != INVALID_XY)
+        wafer, x, y, hard_bin, fail = wafer[ok], x[ok], y[ok], hard_bin[ok], fail[ok]
+        x, y = x.astype(np.int64), y.astype(np.int64)
+        # position code (group-by key) on the bounding box of all dies; last die per (wafer, position)
+        self._x0, self._y0 = (int(x.min()), int(y.min())) if len(x) else (0, 0)
+        self._nx = int(x.max()) - self._x0 + 1 if len(x) else 1
+        code = self._code(x, y)
+        wafer_rank = np.unique(wafer, return_inverse=True)[1]
+        keep = _last_per_key(wafer_rank * (int(code.max()) + 1 if len(code) else 1) + code)
+        code = code[keep]
+        hard_bin = np.where(np.isnan(hard_bin[keep]), NO_BIN, hard_bin[keep]).astype(np.int64)
+        failed = fail[keep] != 0
+        self.n_wafers = len(np.unique(wafer[keep]))
+        self.n_dies = len(code)
+
+        self._pos, inv = np.unique(code, return_inverse=True)
+        self.x = self._pos % self._nx + self._x0
+        self.y = self._pos // self._nx + self._y0
+        n_pos = len(self._pos)
+        self.n = np.bincount(inv, minlength=n_pos)
+        self.fails = np.bincount(inv, weights=failed, minlength=n_pos).astype(np.int64)
+        self.fail_rate = self.fails / np.maximum(self.n, 1)
+
+        bins, bin_code = np.unique(hard_bin, return_inverse=True)
+        counts = np.bincount(inv * len(bins) + bin_code, minlength=n_pos * len(bins)).reshape(n_pos, len(bins))
+        self.bin_mode = bins[counts.argmax(axis=1)] if len(bins) else np.zeros(0, np.int64)
+        self.bin_share = counts.max(axis=1) / np.maximum(self.n, 1) if len(bins) else np.zeros(0)
+
+        self.value_n = self.value_mean = None
+        if test_num is not None:
+            self._add_values(session, test_num)
+
+    def _code(self, x, y):
+        return (np.asarray(y, np.int64) - self._y0) * self._nx + (np.asarray(x, np.int64) - self._x0)
+
+    def _add_values(self, session, test_num):
+        """Mean of one PTR test per position (last measured die per wafer and position)."""
+        df = wafer_test_frame(session, self.wafer_pks, test_num).dropna(subset=["x", "y", "result"])
+        df = df.sort_values("die_id", kind="stable").drop_duplicates(["wafer_pk", "x", "y"], keep="last")
+        code = self._code(df["x"], df["y"])
+        n_pos = len(self._pos)
+        idx = np.minimum(np.searchsorted(self._pos, code), max(n_pos - 1, 0))
+        hit = (self._pos[idx] == code) if n_pos else np.zeros(len(df), bool)
+        self.value_n = np.bincount(idx[hit], minlength=n_pos)
+        sums = np.bincount(idx[hit], weights=df["result"].to_numpy(np.float64)[hit], minlength=n_pos)
+        self.value_mean = np.where(self.value_n > 0, sums / np.maximum(self.value_n, 1), np.nan)
+
+    def __len__(self):
+        return len(self._pos)
+
+    def frame(self):
+        """One row per position: x, y, n, fails, fail_rate, bin_mode, bin_share (+ value_n, value_mean)."""
+        df = pd.DataFrame({
+            "x": self.x, "y": self.y, "n": self.n, "fails": self.fails, "fail_rate": self.fail_rate,
+            "bin_mode": self.bin_mode, "bin_share": self.bin_share,
+        })
+        if self.value_mean is not None:
+            df["value_n"] = self.value_n
+            df["value_mean"] = self.value_mean
+        return df
+
+    def fail_rate_grid(self):
+        return rasterize(self.x, self.y, self.fail_rate) if len(self) else None
+
+    def bin_mode_grid(self):
+        return rasterize(self.x, self.y, self.bin_mode, bins=True) if len(self) else None
+
+    def value_grid(self):
+        """Grid of the per-position test mean; None without a test or without measured positions."""
+        if self.value_mean is None or not np.any(self.value_n):
+            return None
+        has = self.value_n > 0
+        return rasterize(self.x[has], self.y[has], self.value_mean[has])
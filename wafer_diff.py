@@ -0,0 +1,118 @@
+"""
+Vectorized wafer-to-wafer diff engine: fetches all selected wafers' dies (and test results) in one
+query and compares N wafers at once with pandas pivots (wafer × (x, y) × test).
+"""
+import numpy as np
+import pandas as pd
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from config import WAFER_DIFF_TOLERANCE
+from db_models import Die, TestItem, TestKey, TestSummary
+
+_BIN_MISSING = -1   # no die at (x, y) on a wafer; differs from every real bin
+
+
+class WaferDiff:
+    """
+    Die/test data of several wafers. dies: wafer, x, y, hard_bin (last die per position);
+    tests: wafer, x, y, test_num, test_type, result, fail.
+    """
+    def __init__(self, session: Session, wafer_pks, include_tests: bool = True):
+        self.wafer_pks = list(wafer_pks)
+        cols = [Die.wafer_id, Die.x_coord, Die.y_coord, Die.hard_bin]
+        names = ["wafer", "x", "y", "hard_bin"]
+        stmt = select(*cols)
+        if include_tests:
+            stmt = select(*cols, TestKey.test_num, TestKey.test_type, TestItem.result, TestItem.pass_fail).outerjoin(
+                TestItem, TestItem.die_id == Die.id
+            ).outerjoin(TestKey, TestKey.id == TestItem.test_key_id)
+            names += ["test_num", "test_type", "result", "pass_fail"]
+        stmt = stmt.where(Die.wafer_id.in_(self.wafer_pks))
+        df = pd.DataFrame(session.execute(stmt).all(), columns=names)
+        self.dies = df[["wafer", "x", "y", "hard_bin"]].dropna(subset=["x", "y"]).drop_duplicates(
+            ["wafer", "x", "y"], keep="last"
+        )
+        if include_tests:
+            tests = df.dropna(subset=["test_num"]).drop(columns="hard_bin")
+            tests["fail"] = (tests["pass_fail"] == 1).astype(np.int64)
+            tests["result"] = pd.to_numeric(tests["result"], errors="coerce")
+            self.tests = tests
+            self._test_names = {
+                (r.test_num, r.test_type): (r.test_txt or "").strip()
+                for r in session.query(TestSummary.test_num, TestSummary.test_type, TestSummary.test_txt).filter(
+                    TestSummary.wafer_id.in_(self.wafer_pks)
+                )
+            }
+        else:
+            self.tests = None
+            self._test_names = {}
+
+    def test_name(self, test_num, test_type=None):
+        name = self._test_names.get((test_num, test_type)) if test_type else None
+        if not name:
+            name = next((v for (n, _), v in self._test_names.items() if n == test_num and v), "")
+        return name or f"Test#{test_num}"
+
+    def bin_matrix(self):
+        """(x, y) × wafer matrix of hard bins; NaN where a wafer has no die."""
+        return self.dies.pivot(index=["x", "y"], columns="wafer", values="hard_bin").reindex(columns=self.wafer_pks)
+
+    def bin_diff_positions(self):
+        """(x, y) positions where the hard bin is not identical on every selected wafer."""
+        m = self.bin_matrix().fillna(_BIN_MISSING).to_numpy()
+        differs = (m != m[:, :1]).any(axis=1)
+        return [(int(x), int(y)) for x, y in self.bin_matrix().index[differs]]
+
+    def wafer_map_frame(self, wafer_pk):
+        """x, y, hard_bin of one wafer (input of _wafer_map_bin_fig)."""
+        return self.dies.loc[self.dies["wafer"] == wafer_pk, ["x", "y", "hard_bin"]].reset_index(drop=True)
+
+    def test_stats(self):
+        """Per (test_num, test_type): columns (n | fails | fail_rate | mean, wafer)."""
+        g = self.tests.groupby(["test_num", "test_type", "wafer"]).agg(
+            n=("fail", "size"), fails=("fail", "sum"), mean=("result", "mean")
+        )
+        wide = g.unstack("wafer").reindex(columns=self.wafer_pks, level="wafer")
+        n = wide["n"].fillna(0)
+        fails = wide["fails"].fillna(0)
+        rate = (fails / n.where(n > 0)).fillna(0.0)
+        return pd.concat({"n": n, "fails": fails, "fail_rate": rate, "mean": wide["mean"]}, axis=1)
+
+    def test_comparison(self, tolerance: float = None):
+        """
+        One row per test present on any wafer: fail-rate and mean deltas across wafers and
+        Status Same/Different (same rounded fail rate and, for PTR, mean spread <= tolerance).
+        """
+        tol = WAFER_DIFF_TOLERANCE if tolerance is None else tolerance
+        stats = self.test_stats()
+        rate = stats["fail_rate"].to_numpy()
+        mean = stats["mean"].to_numpy(dtype=float)
+        rate_delta = rate.max(axis=1) - rate.min(axis=1)
+        same_pf = np.round(rate, 4).max(axis=1) == np.round(rate, 4).min(axis=1)
+        all_means = ~np.isnan(mean).any(axis=1)
+        mean_delta = np.where(all_means, (stats["mean"].max(axis=1) - stats["mean"].min(axis=1)).to_numpy(), np.nan)
+        is_ptr = stats.index.get_level_values("test_type") == "PTR"
+        same_val = ~(is_ptr & all_means & (mean_delta > tol))
+        out = pd.DataFrame({
+            "test_num": stats.index.get_level_values("test_num"),
+            "test_type": stats.index.get_level_values("test_type"),
+            "fail_rate_delta": rate_delta,
+            "mean_delta": mean_delta,
+            "Status": np.where(same_pf & same_val, "Same", "Different"),
+        })
+        out["test_name"] = [self.test_name(n, t) for n, t in zip(out["test_num"], out["test_type"])]
+        return out, stats
+
+    def value_diff_positions(self, test_num, tolerance: float = None):
+        """(x, y) where a PTR result is present on 2+ wafers and max - min exceeds tolerance."""
+        tol = WAFER_DIFF_TOLERANCE if tolerance is None else tolerance
+        t = self.tests
+        t = t[(t["test_num"] == test_num) & (t["test_type"] == "PTR")].dropna(subset=["x", "y", "result"])
+        if t.empty:
+            return []
+        m = t.pivot_table(index=["x", "y"], columns="wafer", values="result", aggfunc="last")
+        present = m.notna().sum(axis=1) >= 2
+        spread = m.max(axis=1) - m.min(axis=1)
+        differs = (present & (spread > tol)).to_numpy()
+        return [(int(x), int(y)) for x, y in m.index[differs]]
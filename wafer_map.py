@@ -0,0 +1,158 @@
+"""
+Wafer map engine: dies are fetched as NumPy arrays (x, y, bin or value; no ORM rows) and rasterized into
+a 2-D grid drawn as one go.Heatmap trace, so the figure size depends on the grid, not on the die count.
+Grids wider than WAFER_MAP_MAX_CELLS per side are block-reduced (bins: most frequent, values: mean).
+Bin grids are cached per wafer (query_cache, invalidated by the data version).
+"""
+import math
+
+import numpy as np
+import plotly.graph_objects as go
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from config import WAFER_MAP_MAX_CELLS
+from db_models import Die
+from query_cache import cached_builder
+
+NO_BIN = -1   # die without a hard bin
+# bin number -> color; bins not listed take FAIL_COLORS[bin % len]
+BIN_COLORS = {1: "#2ca02c", NO_BIN: "#d3d3d3"}
+FAIL_COLORS = [
+    "#d62728", "#ff7f0e", "#9467bd", "#8c564b", "#e377c2", "#1f77b4", "#bcbd22", "#17becf",
+    "#7f7f7f", "#fdae61", "#a50026", "#542788",
+]
+
+
+def bin_color(bin_num):
+    return BIN_COLORS.get(bin_num) or FAIL_COLORS[int(bin_num) % len(FAIL_COLORS)]
+
+
+class WaferGrid:
+    """
+    Rasterized wafer: z[row, col] covers x = x0 + col * step, y = y0 + row * step (step x step dies per cell
+    after block reduction); NaN = no die. Bin grids hold indexes into bins, value grids the values.
+    """
+    __slots__ = ("x0", "y0", "step", "z", "bins", "n_dies")
+
+    def __init__(self, x0, y0, step, z, bins, n_dies):
+        self.x0 = x0
+        self.y0 = y0
+        self.step = step
+        self.z = z
+        self.bins = bins
+        self.n_dies = n_dies
+
+    def xs(self):
+        return self.x0 + np.arange(self.z.shape[1]) * self.step
+
+    def ys(self):
+        return self.y0 + np.arange(self.z.shape[0]) * self.step
+
+
+def _block_reduce(z, step, n_codes=None):
+    """Merge step x step cells: mean of values, or the most frequent code when n_codes is given."""
+    ny, nx = z.shape
+    z = np.pad(z, ((0, (-ny) % step), (0, (-nx) % step)), constant_values=np.nan)
+    blocks = z.reshape(z.shape[0] // step, step, z.shape[1] // step, step)
+    if n_codes is None:
+        valid = ~np.isnan(blocks)
+        total = np.where(valid, blocks, 0.0).sum(axis=(1, 3))
+        n = valid.sum(axis=(1, 3))
+        return np.where(n > 0, total / np.maximum(n, 1), np.nan)
+    counts = np.stack([(blocks == k).sum(axis=(1, 3)) for k in range(n_codes)])
+    out = counts.argmax(axis=0).astype(float)
+    out[counts.sum(axis=0) == 0] = np.nan
+    return out
+
+
+def rasterize(x, y, values, bins=False, max_cells=None):
+    """
+    Grid from per-die arrays (in load order: the last die at a position wins, as for retests). Dies
+    without coordinates are skipped; with bins=True values are bin numbers (NaN = NO_BIN).
+    Returns None when no die has coordinates.
+    """
+    x = np.asarray(x, float)
+    y = np.asarray(y, float)
+    v = np.asarray(values, float)
+    ok = ~np.isnan(x) & ~np.isnan(y)
+    x, y, v = x[ok].astype(np.int64), y[ok].astype(np.int64), v[ok]
+    if not len(x):
+        return None
+    x0, y0 = int(x.min()), int(y.min())
+    nx, ny = int(x.max()) - x0 + 1, int(y.max()) - y0 + 1
+    flat = (y - y0) * nx + (x - x0)
+    _, first_rev = np.unique(flat[::-1], return_index=True)
+    last = len(flat) - 1 - first_rev
+    bin_nums = None
+    if bins:
+        v = np.where(np.isnan(v), NO_BIN, v).astype(np.int64)
+        bin_nums, v = np.unique(v, return_inverse=True)
+    z = np.full(nx * ny, np.nan)
+    z[flat[last]] = v[last]
+    z = z.reshape(ny, nx)
+    step = max(1, math.ceil(max(nx, ny) / (max_cells or WAFER_MAP_MAX_CELLS)))
+    if step > 1:
+        z = _block_reduce(z, step, len(bin_nums) if bins else None)
+    return WaferGrid(x0, y0, step, z, bin_nums, len(x))
+
+
+@cached_builder
+def wafer_bin_grid(session: Session, wafer_pk):
+    """Hard-bin grid of one wafer (x, y, hard_bin columns only, in die id order); None without coordinates."""
+    rows = session.connection().execute(   # Core rows: no ORM row processing
+        select(Die.x_coord, Die.y_coord, Die.hard_bin).where(Die.wafer_id == wafer_pk).order_by(Die.id)
+    ).all()
+    if not rows:
+        return None
+    x, y, b = (np.array(col, dtype=float) for col in zip(*rows))
+    return rasterize(x, y, b, bins=True)
+
+
+def _layout(fig, title, height):
+    fig.update_layout(
+        title=title, xaxis_title="X", yaxis_title="Y", height=height,
+        yaxis=dict(scaleanchor="x", scaleratio=1), plot_bgcolor="white",
+    )
+    return fig
+
+
+def bin_map_figure(grid, title, show_bin_label=False, highlight_xy=None, height=400):
+    """Bin map of a WaferGrid: one discrete-colored heatmap trace, optional bin labels / highlighted positions."""
+    if grid is None:
+        return None
+    k = len(grid.bins)
+    scale = []
+    for i, b in enumerate(grid.bins):
+        scale += [[i / k, bin_color(b)], [(i + 1) / k, bin_color(b)]]
+    labels = ["no bin" if b == NO_BIN else f"Bin {b}" for b in grid.bins]
+    # bin number per cell for hover / labels; numeric arrays are shipped to the browser as compact typed arrays
+    small = grid.bins.min() >= -32768 and grid.bins.max() <= 32767
+    bin_z = grid.bins.astype(np.int16 if small else np.int32)[np.nan_to_num(grid.z).astype(np.int64)]
+    fig = go.Figure(go.Heatmap(
+        x=grid.xs(), y=grid.ys(), z=grid.z.astype(np.float32), zmin=-0.5, zmax=k - 0.5, colorscale=scale,
+        customdata=bin_z, hoverongaps=False, hovertemplate="X %{x}, Y %{y}<br>Bin %{customdata}<extra></extra>",
+        xgap=1 if grid.z.shape[1] <= 100 else 0, ygap=1 if grid.z.shape[0] <= 100 else 0,
+        text=bin_z if show_bin_label else None, texttemplate="%{text}" if show_bin_label else None, textfont=dict(size=8),
+        colorbar=dict(tickvals=list(range(k)), ticktext=labels, title="Bin"),
+    ))
+    if highlight_xy:
+        hx, hy = zip(*highlight_xy)
+        fig.add_trace(go.Scatter(
+            x=list(hx), y=list(hy), mode="markers", name="Diff", showlegend=False,
+            marker=dict(size=10, symbol="x-open", color="red", line=dict(width=2)),
+        ))
+    return _layout(fig, title, height)
+
+
+def value_map_figure(grid, title, colorscale="Viridis", value_label="result", height=450):
+    """Continuous heatmap of a value WaferGrid (e.g. a PTR result per die)."""
+    if grid is None:
+        return None
+    fig = go.Figure(go.Heatmap(
+        x=grid.xs(), y=grid.ys(), z=grid.z.astype(np.float32), colorscale=colorscale, colorbar=dict(title=value_label),
+        hoverongaps=False,
+        hovertemplate=f"X %{{x}}, Y %{{y}}<br>{value_label} %{{z:.4g}}<extra></extra>",
+        xgap=1 if grid.z.shape[1] <= 100 else 0, ygap=1 if grid.z.shape[0] <= 100 else 0,
+    ))
+    return _layout(fig, title, height)
@@ -0,0 +1,463 @@
+"""
+Wide per-wafer result matrix (optional storage mode, STDF_WAFER_MATRIX=1): each wafer's PTR results are
+kept as a dense float32 matrix (dies x tests, NaN = not measured) plus a packed fail bitmask, one
+compressed .npz per wafer under lot=<lot.id>/wafer=<wafer.id>.npz (wafer=0 for package test).
+Written by the loader next to the DB, like the Parquet side-store. Each row records the load of its die
+(loaded_file.id): a wafer is read from its matrix only when every load that wrote dies to it (Die.load_file_id)
+has rows there, so loads made with the store off fall back, and rows of loads no longer in the DB are not read.
+The accessors below return NumPy arrays and fall back to the parametric store / test_item for other wafers.
+"""
+import os
+import uuid
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from sqlalchemy.orm import Session
+
+from config import DATABASE_URL, STATS_CHUNK_ROWS, WAFER_MATRIX
+from db_models import Die, TestItem, TestKey, Wafer
+
+INVALID_XY = -32768   # STDF "no coordinate", used for dies without x / y
+_PENDING_PREFIX = "_pending-"
+
+
+def matrix_store_dir(db_url: str = None):
+    """
+    Matrix root for a DB: STDF_WAFER_MATRIX_DIR if set ("" disables), else <db file>_matrix next to a
+    SQLite DB, else ./stdf_matrix.
+    """
+    env = os.getenv("STDF_WAFER_MATRIX_DIR")
+    if env is not None:
+        return Path(env) if env.strip() else None
+    url = db_url or DATABASE_URL
+    if url.startswith("sqlite:///") and ":memory:" not in url:
+        db_path = Path(url[len("sqlite:///"):])
+        return db_path.with_name(db_path.stem + "_matrix")
+    if url.startswith("sqlite"):
+        return None
+    return Path("stdf_matrix")
+
+
+class WaferMatrix:
+    """
+    Dense PTR results of one wafer: results[i, j] is test tests[j] on die die_id[i] (NaN = not measured),
+    fail[i, j] its fail flag, load_id[i] the loaded_file.id of the die (-1 = unknown). Rows are ordered by
+    die id, columns by test number.
+    """
+    __slots__ = ("die_id", "x", "y", "tests", "results", "fail", "load_id")
+
+    def __init__(self, die_id, x, y, tests, results, fail, load_id=None):
+        self.die_id = die_id
+        self.x = x
+        self.y = y
+        self.tests = tests
+        self.results = results
+        self.fail = fail
+        self.load_id = np.full(len(die_id), -1, np.int64) if load_id is None else load_id
+
+    @classmethod
+    def build(cls, die_id, x, y, item_die, item_test, item_result, item_fail, load_id=None):
+        """Pivot result rows (die id, test number, result, fail) onto the given dies."""
+        die_id = np.asarray(die_id, np.int64)
+        order = np.argsort(die_id, kind="stable")
+        die_id = die_id[order]
+        x = np.asarray(x, np.int32)[order]
+        y = np.asarray(y, np.int32)[order]
+        load_id = np.asarray(load_id, np.int64)[order] if load_id is not None else None
+        tests, col = np.unique(np.asarray(item_test, np.int64), return_inverse=True)
+        row = np.searchsorted(die_id, np.asarray(item_die, np.int64))
+        results = np.full((len(die_id), len(tests)), np.nan, np.float32)
+        fail = np.zeros(results.shape, bool)
+        results[row, col] = np.asarray(item_result, np.float32)
+        fail[row, col] = np.asarray(item_fail, bool)
+        return cls(die_id, x, y, tests, results, fail, load_id)
+
+    def __len__(self):
+        return len(self.die_id)
+
+    def _index(self, test_num):
+        j = int(np.searchsorted(self.tests, test_num))
+        return j if j < len(self.tests) and self.tests[j] == test_num else None
+
+    def column(self, test_num):
+        """Results of one test for every die (NaN where not measured); None if the test is not on the wafer."""
+        j = self._index(test_num)
+        return None if j is None else self.results[:, j]
+
+    def fail_column(self, test_num):
+        j = self._index(test_num)
+        return None if j is None else self.fail[:, j]
+
+    def take(self, test_nums):
+        """Matrix restricted to the given tests (those present on the wafer, in wafer column order)."""
+        cols = np.flatnonzero(np.isin(self.tests, np.asarray(list(test_nums), np.int64)))
+        return WaferMatrix(
+            self.die_id, self.x, self.y, self.tests[cols], self.results[:, cols], self.fail[:, cols], self.load_id
+        )
+
+    def xy_valid(self):
+        return (self.x != INVALID_XY) & (self.y != INVALID_XY)
+
+    def correlation(self, test_nums=None):
+        """Pearson correlation between tests across dies (pairwise complete); returns (tests, matrix)."""
+        m = self.take(test_nums) if test_nums is not None else self
+        values = np.ma.masked_invalid(m.results.astype(np.float64))
+        return m.tests, np.ma.corrcoef(values, rowvar=False).filled(np.nan)
+
+    def merge(self, other):
+        """Union of two matrices of the same wafer (e.g. a retest loaded later); other wins on shared dies."""
+        keep = ~np.isin(self.die_id, other.die_id)
+        die_id = np.concatenate([self.die_id[keep], other.die_id])
+        tests = np.union1d(self.tests, other.tests)
+        results = np.full((len(die_id), len(tests)), np.nan, np.float32)
+        fail = np.zeros(results.shape, bool)
+        n = int(keep.sum())
+        for rows, m, sel in ((slice(0, n), self, keep), (slice(n, None), other, slice(None))):
+            cols = np.searchsorted(tests, m.tests)
+            results[rows, cols] = m.results[sel]
+            fail[rows, cols] = m.fail[sel]
+        x = np.concatenate([self.x[keep], other.x])
+        y = np.concatenate([self.y[keep], other.y])
+        load_id = np.concatenate([self.load_id[keep], other.load_id])
+        order = np.argsort(die_id, kind="stable")
+        return WaferMatrix(die_id[order], x[order], y[order], tests, results[order], fail[order], load_id[order])
+
+    def _rows(self, keep):
+        return WaferMatrix(
+            self.die_id[keep], self.x[keep], self.y[keep], self.tests, self.results[keep], self.fail[keep],
+            self.load_id[keep],
+        )
+
+    def drop_dies(self, die_ids):
+        """Matrix without the rows of the given dies."""
+        return self._rows(~np.isin(self.die_id, np.asarray(die_ids, np.int64)))
+
+    def for_loads(self, load_ids):
+        """
+        Rows of the given loads (loaded_file ids), or None unless each of them has rows here: a load made with
+        the store off, without a registry entry (None) or before matrices recorded loads (-1) is not covered.
+        """
+        if any(load_id is None for load_id in load_ids):
+            return None
+        wanted = np.asarray(sorted(load_ids), np.int64)
+        if not np.isin(wanted, self.load_id).all():
+            return None
+        keep = np.isin(self.load_id, wanted)
+        return self if keep.all() else self._rows(keep)
+
+    def save(self, path):
+        np.savez_compressed(
+            path, die_id=self.die_id, x=self.x, y=self.y, tests=self.tests, results=self.results,
+            fail_bits=np.packbits(self.fail, axis=None), load_id=self.load_id,
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as z:
+            results = z["results"]
+            fail = np.unpackbits(z["fail_bits"], count=results.size).astype(bool).reshape(results.shape)
+            load_id = z["load_id"] if "load_id" in z.files else None   # files written before load ids: -1
+            return cls(z["die_id"], z["x"], z["y"], z["tests"], results, fail, load_id)
+
+
+class MatrixStoreWriter:
+    """
+    Collects the loader's flushed Die/TestItem column batches per (lot, wafer) and writes each wafer's
+    matrix when the wafer ends (end_wafer, at WRR) or in finish(). Files are written under a pending
+    name and published after the DB commit; an existing matrix of the wafer is merged in. With write_new=False
+    the writer only keeps existing files in step with the DB (remove_dies) and writes no new rows.
+    """
+    def __init__(self, root, write_new: bool = True):
+        self.root = Path(root)
+        self.write_new = write_new
+        self._parts = {}     # (lot_pk, wafer_pk) -> {"dies": [...], "items": [...]}
+        self._pending = []   # (pending path, final path)
+        self._obsolete = set()   # published files to delete in publish()
+
+    @classmethod
+    def for_db(cls, db_url: str = None):
+        """
+        Writer of the DB's matrix store: writes matrices when STDF_WAFER_MATRIX is on; with the flag off and
+        matrix files on disk, one that only maintains them (a replaced load's rows are still removed).
+        """
+        root = matrix_store_dir(db_url)
+        if root is None or not (WAFER_MATRIX or root.is_dir()):
+            return None
+        return cls(root, write_new=WAFER_MATRIX)
+
+    def write(self, die_cols, item_cols):
+        """die_cols / item_cols: column name -> list, as buffered by StdfToDbSink (every die of one load)."""
+        load_id = die_cols["load_file_id"][0] if die_cols["load_file_id"] else None
+        die_id = np.asarray(die_cols["id"], np.int64)
+        if not self.write_new or load_id is None or not len(die_id):
+            return
+        lot = np.asarray(die_cols["lot_id"], np.int64)
+        wafer = np.array([w or 0 for w in die_cols["wafer_id"]], np.int64)
+        x = np.array([INVALID_XY if v is None else v for v in die_cols["x_coord"]], np.int32)
+        y = np.array([INVALID_XY if v is None else v for v in die_cols["y_coord"]], np.int32)
+        is_ptr = np.array([t == "PTR" for t in item_cols["test_type"]], bool)
+        item_die = np.asarray(item_cols["die_id"], np.int64)[is_ptr]
+        item_test = np.asarray(item_cols["test_num"], np.int64)[is_ptr]
+        item_result = np.array([np.nan if v is None else v for v in item_cols["result"]], np.float32)[is_ptr]
+        item_fail = np.array([v == 1 for v in item_cols["pass_fail"]], bool)[is_ptr]
+        item_row = np.searchsorted(die_id, item_die)   # die ids are allocated in ascending order
+        for lot_pk, wafer_pk in set(zip(lot.tolist(), wafer.tolist())):
+            rows = (lot == lot_pk) & (wafer == wafer_pk)
+            items = rows[item_row]
+            part = self._parts.setdefault((lot_pk, wafer_pk), {"dies": [], "items": []})
+            part["dies"].append((die_id[rows], x[rows], y[rows], np.full(int(rows.sum()), load_id, np.int64)))
+            part["items"].append((item_die[items], item_test[items], item_result[items], item_fail[items]))
+
+    def _current(self, final):
+        """Latest matrix of a wafer as this writer sees it: pending version, else the published file."""
+        pending = next((p for p, f in self._pending if f == final), None)
+        if pending is not None:
+            return WaferMatrix.load(pending)
+        if final in self._obsolete or not final.exists():
+            return None
+        return WaferMatrix.load(final)
+
+    def _stage(self, final, matrix):
+        """Write matrix as the pending version of final (replacing an earlier pending one)."""
+        final.parent.mkdir(parents=True, exist_ok=True)
+        path = final.with_name(f"{_PENDING_PREFIX}{uuid.uuid4().hex}.npz")
+        matrix.save(path)
+        for old, f in self._pending:
+            if f == final:
+                old.unlink(missing_ok=True)
+        self._pending = [(p, f) for p, f in self._pending if f != final] + [(path, final)]
+        self._obsolete.discard(final)
+
+    def end_wafer(self, lot_pk, wafer_pk):
+        """Write the matrix of a finished wafer (pending until publish) and free its buffers."""
+        part = self._parts.pop((lot_pk, wafer_pk or 0), None)
+        if part is None:
+            return
+        die_id, x, y, load_id = [np.concatenate(a) for a in zip(*part["dies"])]
+        items = [np.concatenate(a) for a in zip(*part["items"])]
+        matrix = WaferMatrix.build(die_id, x, y, *items, load_id=load_id)
+        final = self.root / f"lot={lot_pk}" / f"wafer={wafer_pk or 0}.npz"
+        previous = self._current(final)
+        self._stage(final, previous.merge(matrix) if previous is not None else matrix)
+
+    def remove_dies(self, lot_pk, wafer_pk, die_ids):
+        """Drop the rows of die_ids from a wafer's matrix (pending until publish), e.g. before a changed file is re-loaded."""
+        final = self.root / f"lot={lot_pk}" / f"wafer={wafer_pk or 0}.npz"
+        current = self._current(final)
+        if current is None:
+            return
+        kept = current.drop_dies(die_ids)
+        if len(kept) == len(current):
+            return
+        if len(kept):
+            self._stage(final, kept)
+            return
+        for old, f in self._pending:
+            if f == final:
+                old.unlink(missing_ok=True)
+        self._pending = [(p, f) for p, f in self._pending if f != final]
+        self._obsolete.add(final)
+
+    def finish(self):
+        """Write every wafer still buffered (call before the DB commit)."""
+        for lot_pk, wafer_pk in list(self._parts):
+            self.end_wafer(lot_pk, wafer_pk)
+
+    def publish(self):
+        """Make pending files visible to readers (call after the DB commit)."""
+        for path, final in self._pending:
+            os.replace(path, final)
+        for final in self._obsolete:
+            final.unlink(missing_ok=True)
+        self._pending = []
+        self._obsolete = set()
+
+    def discard(self):
+        """Drop buffered rows and remove files written since the last publish."""
+        for path, _ in self._pending:
+            path.unlink(missing_ok=True)
+        self._pending = []
+        self._obsolete = set()
+        self._parts = {}
+
+
+@lru_cache(maxsize=32)
+def _load_cached(path, mtime_ns):
+    return WaferMatrix.load(path)
+
+
+def _die_loads(session: Session, lot_pks=None, wafer_pks=None):
+    """
+    {(lot_pk, wafer_pk, 0 for package dies): {Die.load_file_id, ...}} over the dies of the given lots and / or
+    wafers; package dies only when no wafer_pks are given.
+    """
+    # die has no lot index: wafer dies are reached through wafer.lot_id, package dies through wafer_id IS NULL
+    q = session.query(Wafer.lot_id, Wafer.id, Die.load_file_id).join(Die, Die.wafer_id == Wafer.id)
+    if lot_pks is not None:
+        q = q.filter(Wafer.lot_id.in_(lot_pks))
+    if wafer_pks is not None:
+        q = q.filter(Wafer.id.in_(wafer_pks))
+    rows = q.distinct().all()
+    if wafer_pks is None:
+        rows += session.query(Die.lot_id, Die.wafer_id, Die.load_file_id).filter(
+            Die.wafer_id == None, Die.lot_id.in_(lot_pks)
+        ).distinct().all()
+    loads = {}
+    for lot_pk, wafer_pk, load_id in rows:
+        loads.setdefault((lot_pk, wafer_pk or 0), set()).add(load_id)
+    return loads
+
+
+class MatrixStore:
+    """Read side of the matrix store (matrices cached per file and modification time)."""
+    def __init__(self, root):
+        self.root = Path(root)
+
+    @classmethod
+    def for_db(cls, db_url: str = None):
+        root = matrix_store_dir(db_url)
+        return cls(root) if root is not None and root.is_dir() else None
+
+    def read(self, lot_pk, wafer_pk, load_ids):
+        """
+        Matrix of one wafer restricted to the rows of load_ids (the wafer's Die.load_file_id values, see
+        _die_loads); None without a file or when the file does not cover every one of those loads.
+        """
+        m = self.read_path(self.root / f"lot={lot_pk}" / f"wafer={wafer_pk or 0}.npz")
+        return m.for_loads(load_ids) if m is not None else None
+
+    @staticmethod
+    def read_path(path):
+        try:
+            return _load_cached(str(path), path.stat().st_mtime_ns)
+        except FileNotFoundError:
+            return None
+
+
+def _matrix_from_db(session: Session, wafer_pk):
+    """WaferMatrix of one wafer with all its PTR tests, pivoted from test_item."""
+    dies = session.query(Die.id, Die.x_coord, Die.y_coord).filter(Die.wafer_id == wafer_pk).all()
+    q = session.query(TestItem.die_id, TestKey.test_num, TestItem.result, TestItem.pass_fail).join(
+        Die, Die.id == TestItem.die_id
+    ).join(TestKey, TestKey.id == TestItem.test_key_id).filter(Die.wafer_id == wafer_pk, TestKey.test_type == "PTR")
+    items = q.all()
+    return WaferMatrix.build(
+        [d[0] for d in dies],
+        [INVALID_XY if d[1] is None else d[1] for d in dies],
+        [INVALID_XY if d[2] is None else d[2] for d in dies],
+        [r[0] for r in items], [r[1] for r in items],
+        [np.nan if r[2] is None else r[2] for r in items], [r[3] == 1 for r in items],
+    )
+
+
+def _matrix_from_parametric(session: Session, wafer_pk, test_nums):
+    """WaferMatrix of a few tests via fetch_parametric (Parquet side-store or SQL); only dies with a result."""
+    from columnar_store import fetch_parametric
+    if not test_nums:
+        return WaferMatrix.build([], [], [], [], [], [], [])
+    frames = [fetch_parametric(session, n, wafer_pks=[wafer_pk]).assign(test_num=n) for n in test_nums]
+    df = pd.concat(frames, ignore_index=True)
+    dies = df.drop_duplicates("die_id")
+    return WaferMatrix.build(
+        dies["die_id"], dies["x"].fillna(INVALID_XY), dies["y"].fillna(INVALID_XY),
+        df["die_id"], df["test_num"], df["result"].astype(np.float32), df["pass_fail"] == 1,
+    )
+
+
+def wafer_matrix(session: Session, wafer_pk, test_nums=None):
+    """
+    Dies x PTR tests matrix of one wafer: from the matrix store when its file covers the wafer's loads
+    (restricted to test_nums if given); otherwise the given tests via fetch_parametric, or all tests pivoted
+    from test_item.
+    """
+    store = MatrixStore.for_db(str(session.get_bind().url))
+    if store is not None:
+        for (lot_pk, _), load_ids in _die_loads(session, wafer_pks=[wafer_pk]).items():
+            m = store.read(lot_pk, wafer_pk, load_ids)
+            if m is not None:
+                return m.take(test_nums) if test_nums is not None else m
+    if test_nums is not None:
+        return _matrix_from_parametric(session, wafer_pk, list(test_nums))
+    return _matrix_from_db(session, wafer_pk)
+
+
+def iter_lot_test_values(session: Session, lot_pks, test_num, chunk_rows: int = STATS_CHUNK_ROWS):
+    """
+    (lot_pk, float32 values) chunks of one PTR test, NaN dropped: one chunk per wafer (or package) matrix that
+    covers its loads, and columnar_store.iter_parametric_results chunks (split per lot) for the other wafers.
+    Memory is bounded by the chunk size, not by the number of dies.
+    """
+    from columnar_store import iter_parametric_results
+    lot_pks = list(lot_pks)
+    store = MatrixStore.for_db(str(session.get_bind().url))
+    if store is None:
+        calls = [(lot_pks, None)]
+    else:
+        rest = {}   # lot_pk -> [wafer_pk or None (package dies), ...] not served by a matrix
+        for (lot_pk, wafer_pk), load_ids in sorted(_die_loads(session, lot_pks=lot_pks).items()):
+            m = store.read(lot_pk, wafer_pk, load_ids)
+            if m is None:
+                rest.setdefault(lot_pk, []).append(wafer_pk or None)
+                continue
+            values = m.column(test_num)
+            if values is not None and values.size:
+                yield lot_pk, values[~np.isnan(values)]
+        # one query for lots whose package dies fall back, one for the others (wafer ids are unique across lots)
+        groups = {}
+        for lot_pk, wafers in rest.items():
+            lots, wafer_pks = groups.setdefault(None in wafers, ([], []))
+            lots.append(lot_pk)
+            wafer_pks += wafers
+        calls = list(groups.values())
+    for lots, wafer_pks in calls:
+        for lot_arr, results in iter_parametric_results(session, test_num, lots, chunk_rows, wafer_pks=wafer_pks):
+            for lot_pk in np.unique(lot_arr):
+                yield int(lot_pk), results[lot_arr == lot_pk].astype(np.float32)
+
+
+def lot_test_values(session: Session, lot_pks, test_num):
+    """
+    Measured values (float32, NaN dropped) of one PTR test per lot: {lot_pk: array}. Holds every value;
+    aggregates should consume iter_lot_test_values instead.
+    """
+    lot_pks = list(lot_pks)
+    parts = {pk: [] for pk in lot_pks}
+    for lot_pk, values in iter_lot_test_values(session, lot_pks, test_num):
+        parts[lot_pk].append(values)
+    return {pk: np.concatenate(p) if p else np.empty(0, np.float32) for pk, p in parts.items()}
+
+
+def wafer_test_frame(session: Session, wafer_pks, test_num):
+    """
+    Results of one PTR test on the given wafers as a fetch_parametric frame (lot_pk, wafer_pk, die_id, x, y,
+    result, pass_fail; measured dies only). Wafers whose matrix file covers their loads are read from it, the
+    rest via fetch_parametric.
+    """
+    from columnar_store import PARAMETRIC_COLUMNS, fetch_parametric
+    wafer_pks = list(wafer_pks)
+    store = MatrixStore.for_db(str(session.get_bind().url))
+    frames, rest = [], []
+    loads = _die_loads(session, wafer_pks=wafer_pks) if store is not None else {}
+    lots = {wafer_pk: lot_pk for lot_pk, wafer_pk in loads}
+    for wafer_pk in wafer_pks:
+        lot_pk = lots.get(wafer_pk)
+        m = store.read(lot_pk, wafer_pk, loads[lot_pk, wafer_pk]) if lot_pk is not None else None
+        values = m.column(test_num) if m is not None else None
+        if m is None:
+            rest.append(wafer_pk)
+            continue
+        if values is None:
+            continue
+        keep = ~np.isnan(values)
+        frames.append(pd.DataFrame({
+            "lot_pk": lot_pk, "wafer_pk": wafer_pk, "die_id": m.die_id[keep],
+            "x": np.where(m.x[keep] == INVALID_XY, np.nan, m.x[keep]),
+            "y": np.where(m.y[keep] == INVALID_XY, np.nan, m.y[keep]),
+            "result": values[keep].astype(np.float64), "pass_fail": m.fail_column(test_num)[keep].astype(np.int64),
+        }))
+    if rest:
+        frames.append(fetch_parametric(session, test_num, wafer_pks=rest))
+    frames = [f for f in frames if len(f)]
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=PARAMETRIC_COLUMNS)